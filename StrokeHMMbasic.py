@@ -1,10 +1,10 @@
 import xml.dom.minidom
 import copy
 import guid
+import itertools
 import math
 import os
 import operator
-from compiler.ast import flatten
 
 # A couple contants
 CONTINUOUS = 0
@@ -536,7 +536,7 @@ class StrokeLabeler:
         self.classifications = []
         for oneFilestrokes in self.allStrokes:
             self.classifications.append(self.labelStrokes(oneFilestrokes))
-        self.confusion(flatten(self.allLabels),flatten(self.classifications))
+        self.confusion(list(itertools.chain(*self.allLabels)),list(itertools.chain(*self.classifications)))
 
 
 
@@ -1,19 +1,167 @@
-import xml.dom.minidom
+import xml.etree.cElementTree as ElementTree
+import xml.parsers.expat as expat
+import collections
+import array
+import bisect
 import copy
 import guid
+import logging
+import itertools
+import simplify
+import sketchcache
+import spatialindex
+import stats
 import math
+import modelfile
+import multiprocessing
 import os
-import operator
-from compiler.ast import flatten
+import numpy
+
+# All output goes through this logger.  Where it goes is up to the program
+# (the command line tools call logging.basicConfig); setVerbosity changes
+# the level (DEBUG adds the model and label dumps, WARNING keeps only
+# problems).
+log = logging.getLogger("StrokeHmm")
+log.addHandler(logging.NullHandler())
+
+def setVerbosity( level ):
+    ''' Set the level (e.g. logging.DEBUG) of the StrokeHmm logger '''
+    log.setLevel(level)
 
 # A couple contants
 CONTINUOUS = 0
 DISCRETE = 1
 
+# viterbi only looks at the possible transitions, instead of every pair of
+# states, when at most this fraction of the pairs is possible
+SPARSE_DENSITY = 0.5
+
+# Features of a stroke's neighborhood in its sketch, set by
+# StrokeLabeler.setNeighborhoodFeatures (see useNeighborhoodFeatures)
+NEIGHBORHOOD_FEATURES = ['nearestStroke', 'overlaps', 'localDensity']
+
+# Observations are only coded (see ObservationCodebook) when there are at
+# most this many combinations of feature values; beyond that the emission
+# table would be too big, and observations stay feature dictionaries
+MAX_CODEBOOK_SIZE = 4096
+
+# label_many decodes at most this many padded steps (sequences times the
+# longest length) at once; the padded arrays take about numStates * 16
+# bytes per step for Viterbi and three times that for forward-backward
+MAX_BATCH_STEPS = 1 << 16
+
+# The smallest variance a continuous feature's Gaussian may have, so that a
+# feature that is (nearly) constant in training can not give infinite
+# densities
+VARIANCE_FLOOR = 1e-4
+
+def log2( p ):
+    ''' math.log(p, 2), but a zero probability maps to -inf instead of
+        raising, so impossible states simply never win in Viterbi '''
+    return math.log(p, 2) if p > 0 else float('-inf')
+
+def xlog2x( c ):
+    ''' c * log2(c) elementwise for an array of counts, with 0 log 0 = 0 '''
+    c = numpy.asarray(c, dtype=float)
+    return c * numpy.log2(numpy.where(c > 0, c, 1))
+
+def logSumExp2( x, axis ):
+    ''' log2(sum(2**x)) along axis, without overflow; a slice that is all
+        -inf gives -inf '''
+    m = x.max(axis=axis)
+    m = numpy.where(numpy.isfinite(m), m, 0)
+    return m + numpy.log2(numpy.exp2(x - numpy.expand_dims(m, axis)).sum(axis=axis))
+
+def roundSignificant( values, digits ):
+    ''' Round an array of values to digits significant digits '''
+    values = numpy.asarray(values, dtype=float)
+    magnitude = numpy.floor(numpy.log10(numpy.abs(numpy.where(values == 0, 1, values))))
+    scale = 10.0 ** (digits - 1 - magnitude)
+    return numpy.round(values * scale) / scale
+
+def mergeMoments( a, b, weight = 1 ):
+    ''' Combine two (count, mean, M2) summaries of samples, where M2 is the
+        sum of squared differences from the mean, into the summary of the
+        samples of a plus weight times those of b (Chan et al.).  With
+        weight -1 this takes out samples b that are part of a.  No sums of
+        squares are ever formed, so large values do not lose the variance
+        to cancellation. '''
+    n, mean, m2 = a
+    nB, meanB, m2B = b
+    nB = weight * nB
+    total = n + nB
+    if total == 0:
+        return 0, 0.0, 0.0
+    delta = meanB - mean
+    mean = mean + delta * nB / float(total)
+    m2 = m2 + weight * m2B + delta * delta * n * nB / float(total)
+    return total, mean, max(m2, 0.0)
+
+def addCounts( a, b, weight = 1 ):
+    ''' Return a + weight*b for two count structures of the same shape
+        (numbers, or lists and dictionaries of them).  HMM counts also
+        hold moments, which do not add up; use HMM.combineCounts for
+        those. '''
+    if isinstance(a, dict):
+        return dict((k, addCounts(a[k], b[k], weight)) for k in a)
+    if isinstance(a, list):
+        return [addCounts(x, y, weight) for x, y in zip(a, b)]
+    return a + weight*b
+
+class ObservationCodebook:
+    ''' Maps a dictionary of discrete feature values to one integer code
+        and back, so that an observation can index a table directly.
+        Codes are mixed radix with the first feature as the most
+        significant digit. '''
+
+    def __init__(self, featureNames, numVals):
+        self.featureNames = list(featureNames)
+        self.strides = []
+        self.size = 1
+        for f in reversed(self.featureNames):
+            self.strides.insert(0, self.size)
+            self.size *= numVals[f]
+        # The decoded dictionaries are shared, callers must not change them
+        self.decoded = []
+        for code in range(self.size):
+            d = {}
+            for f, stride in zip(self.featureNames, self.strides):
+                d[f] = code // stride % numVals[f]
+            self.decoded.append(d)
+
+    def encode( self, features ):
+        ''' Return the code of a feature dictionary '''
+        code = 0
+        for f, stride in zip(self.featureNames, self.strides):
+            code += features[f] * stride
+        return code
+
+    def decode( self, code ):
+        ''' Return the feature dictionary for a code '''
+        return self.decoded[code]
+
+
+def codebookFor( featureNames, contOrDisc, numVals ):
+    ''' Return an ObservationCodebook over the features, or None if any
+        feature is continuous (and so can not be enumerated) or there are
+        more than MAX_CODEBOOK_SIZE combinations of values '''
+    if len(featureNames) == 0:
+        return None
+    size = 1
+    for f in featureNames:
+        if contOrDisc[f] != DISCRETE:
+            return None
+        size *= numVals[f]
+    if size > MAX_CODEBOOK_SIZE:
+        return None
+    return ObservationCodebook(featureNames, numVals)
+
+
 class HMM:
     ''' Code for a hidden Markov Model '''
 
-    def __init__(self, states = [], features = [], contOrDisc = {}, numVals = {}):
+    def __init__(self, states = [], features = [], contOrDisc = {}, numVals = {},
+                 minTransitionCount = None):
         ''' Initialize the HMM.
             Input:
                 states: a list of the hidden state possible values
@@ -21,111 +169,299 @@ class HMM:
                 contOrDisc: a dictionary mapping feature names to integers
                     representing whether the feature is continuous or discrete
                 numVals: a dictionary mapping names of discrete features to
-                    the number of values that feature can take on. '''
+                    the number of values that feature can take on.
+                minTransitionCount: None smooths the transitions so that
+                    every one is possible.  Otherwise transitions seen fewer
+                    times than this in training are impossible, which gives
+                    a sparse transition matrix for models with many states. '''
         self.states = states 
         self.isTrained = False
         self.featureNames = features
         self.featuresCorD = contOrDisc
         self.numVals = numVals
+        self.minTransitionCount = minTransitionCount
+        # Decoding normally finds the exact best path.  Setting topK (keep
+        # that many states per step) or beam (keep the states within beam,
+        # in log2 units, of the best one) prunes the search instead.
+        self.topK = None
+        self.beam = None
+        self.varianceFloor = VARIANCE_FLOOR
 
         # All the probabilities start uninitialized until training
         self.priors = None
         self.emissions = None   #evidence model
         self.transitions = None #transition model
+        self.priorCounts = None # and the counts they come from
+        self.codebook = self.makeCodebook()
 
     def train(self, trainingData, trainingLabels):
         ''' Train the HMM on the fully observed data using MLE '''
-        print "Training the HMM... "
+        log.info("Training the HMM... ")
         self.isTrained = True
         self.trainPriors( trainingData, trainingLabels )
         self.trainTransitions( trainingData, trainingLabels )
         self.trainEmissions( trainingData, trainingLabels ) 
-        print "HMM trained"
-        print "Prior probabilities are:", self.priors
-        print "Transition model is:", self.transitions
-        print "Evidence model is:", self.emissions
+        log.info("HMM trained")
+        log.debug("Prior probabilities are: %s", self.priors)
+        log.debug("Transition model is: %s", self.transitions)
+        log.debug("Evidence model is: %s", self.emissions)
+
+    # The model is kept as raw counts (sufficient statistics) next to the
+    # probabilities, so that data can be added or removed later without
+    # going over the old data again.  Each train* function resets its
+    # counts, counts the data and then rebuilds its probabilities.
+
+    def partial_fit(self, observations, labels):
+        ''' Add more labeled sequences to an already trained (or new) model '''
+        self.updateCounts( observations, labels, 1 )
+
+    def forget(self, observations, labels):
+        ''' Remove labeled sequences that were trained on earlier.  Only
+            counts are kept, not the sequences, so forget can only tell
+            that it was given the wrong data when that would make a count
+            negative: callers must not forget data that was never added,
+            or forget the same data twice. '''
+        self.updateCounts( observations, labels, -1 )
+
+    def updateCounts(self, observations, labels, weight):
+        ''' Add weight times the counts of the data to the model counts, then
+            rebuild the probabilities and refresh the compiled log tables '''
+        if self.priorCounts is None:
+            self.resetPriorCounts()
+            self.resetTransitionCounts()
+            self.resetEmissionCounts()
+        # taking out moments that are not there loses them, so keep a copy
+        # to put back rather than adding the data back in
+        saved = self.getCounts()
+        self.countPriors( labels, weight )
+        self.countTransitions( labels, weight )
+        self.countEmissions( observations, labels, weight )
+        if self.hasNegativeCounts():
+            # put the counts back before complaining
+            for name, value in saved.items():
+                setattr(self, name, value)
+            raise ValueError("forget was given data that the model was not trained on")
+        self.isTrained = True
+        self.makePriors()
+        self.makeTransitions()
+        self.makeEmissions()
+        self.refreshLogTables()
+
+    def getCounts(self):
+        ''' Return a copy of the model counts '''
+        return copy.deepcopy({'priorCounts': self.priorCounts, 'numSequences': self.numSequences,
+                              'transitionCounts': self.transitionCounts,
+                              'featureCounts': self.featureCounts,
+                              'emissionCounts': self.emissionCounts})
+
+    def setCounts(self, counts):
+        ''' Replace the model counts (as returned by getCounts) and rebuild
+            the probabilities from them '''
+        for name, value in copy.deepcopy(counts).items():
+            setattr(self, name, value)
+        self.isTrained = True
+        self.makePriors()
+        self.makeTransitions()
+        self.makeEmissions()
+        self.refreshLogTables()
+
+    def combineCounts(self, a, b, weight = 1):
+        ''' Return the counts a plus weight times the counts b (both as
+            returned by getCounts), merging the moments of continuous
+            features properly '''
+        ret = addCounts(a, b, weight)
+        for s in self.states:
+            for f in self.featureNames:
+                if self.featuresCorD[f] == CONTINUOUS:
+                    n, mean, m2 = mergeMoments(
+                        [a['featureCounts'][s][f]] + list(a['emissionCounts'][s][f]),
+                        [b['featureCounts'][s][f]] + list(b['emissionCounts'][s][f]), weight)
+                    ret['emissionCounts'][s][f] = [mean, m2]
+        return ret
+
+    def countsFor(self, observations, labels):
+        ''' Return the counts that observations and labels alone would
+            give, without touching this model '''
+        hmm = HMM(self.states, self.featureNames, self.featuresCorD, self.numVals,
+                  self.minTransitionCount)
+        hmm.resetPriorCounts()
+        hmm.resetTransitionCounts()
+        hmm.resetEmissionCounts()
+        hmm.countPriors( labels, 1 )
+        hmm.countTransitions( labels, 1 )
+        hmm.countEmissions( observations, labels, 1 )
+        return hmm.getCounts()
+
+    def hasNegativeCounts(self):
+        if self.numSequences < 0 or min(self.priorCounts.values()) < 0:
+            return True
+        for s in self.states:
+            if min(self.transitionCounts[s].values()) < 0:
+                return True
+            for f in self.featureNames:
+                if self.featureCounts[s][f] < 0:
+                    return True
+                if self.featuresCorD[f] == DISCRETE and min(self.emissionCounts[s][f]) < 0:
+                    return True
+        return False
 
     def trainPriors( self, trainingData, trainingLabels ):
         ''' Train the priors based on the data and labels '''
-        # Set the prior probabilities
-        priorCounts = {}
+        self.resetPriorCounts()
+        self.countPriors( trainingLabels, 1 )
+        self.makePriors()
+
+    def resetPriorCounts( self ):
+        self.priorCounts = {}
         for s in self.states:
-            priorCounts[s] = 0
+            self.priorCounts[s] = 0
+        self.numSequences = 0
+
+    def countPriors( self, trainingLabels, weight ):
         for labels in trainingLabels:
-            priorCounts[labels[0]] += 1
+            self.priorCounts[labels[0]] += weight
+            self.numSequences += weight
 
+    def makePriors( self ):
+        # Set the prior probabilities
         self.priors = {}
         for s in self.states:
-            self.priors[s] = max(1.0,float(priorCounts[s]))/len(trainingLabels)
+            self.priors[s] = max(1.0,float(self.priorCounts[s]))/max(self.numSequences, 1)
         
 
     def trainTransitions( self, trainingData, trainingLabels ):
         ''' Give training data and labels, train the transition model '''
-        # Set the transition probabilities
+        self.resetTransitionCounts()
+        self.countTransitions( trainingLabels, 1 )
+        self.makeTransitions()
+
+    def resetTransitionCounts( self ):
         # First initialize the transition counts
-        transitionCounts = {}
+        self.transitionCounts = {}
         for s in self.states:
-            transitionCounts[s] = {}
+            self.transitionCounts[s] = {}
             for s2 in self.states:
-                transitionCounts[s][s2] = 0
-                
+                self.transitionCounts[s][s2] = 0
+
+    def countTransitions( self, trainingLabels, weight ):
         for labels in trainingLabels:
             if len(labels) > 1:
                 lab1 = labels[0]
                 for lab2 in labels[1:]:
-                    transitionCounts[lab1][lab2] += 1
+                    self.transitionCounts[lab1][lab2] += weight
                     lab1 = lab2
-                    
+
+    def makeTransitions( self ):
+        # Set the transition probabilities
         self.transitions = {}
-        for s in transitionCounts.keys():
+        for s in self.transitionCounts.keys():
             self.transitions[s] = {}
-            totForS = sum(transitionCounts[s].values())
-            for s2 in transitionCounts[s].keys():
-                self.transitions[s][s2] = max(1.0,float(transitionCounts[s][s2]))/float(totForS)
+            if self.minTransitionCount is not None:
+                # only the transitions seen often enough are possible; a
+                # state with none of those can go anywhere
+                kept = dict((s2, c) for s2, c in self.transitionCounts[s].items()
+                            if c >= self.minTransitionCount and c > 0)
+                totKept = float(sum(kept.values()))
+                for s2 in self.transitionCounts[s].keys():
+                    if totKept > 0:
+                        self.transitions[s][s2] = kept.get(s2, 0) / totKept
+                    else:
+                        self.transitions[s][s2] = 1.0 / len(self.transitionCounts[s])
+                continue
+            totForS = max(sum(self.transitionCounts[s].values()), 1)
+            for s2 in self.transitionCounts[s].keys():
+                self.transitions[s][s2] = max(1.0,float(self.transitionCounts[s][s2]))/float(totForS)
 
 
     def trainEmissions( self, trainingData, trainingLabels ):
         ''' given training data and labels, train the evidence model.  '''
-        self.emissions = {}
-        featureVals = {}
+        self.resetEmissionCounts()
+        self.countEmissions( trainingData, trainingLabels, 1 )
+        self.makeEmissions()
+
+        # Rebuild the compiled tables, including the emission table
+        if self.priors is not None and self.transitions is not None:
+            self.compileLogTables()
+
+    def resetEmissionCounts( self ):
+        # featureCounts[s][f] is how many observations of state s have
+        # feature f.  emissionCounts[s][f] is a list of counts per value for
+        # discrete features, and [mean, M2] (see mergeMoments) for
+        # continuous ones.
+        self.featureCounts = {}
+        self.emissionCounts = {}
         for s in self.states:
-            self.emissions[s] = {}
-            featureVals[s] = {}
+            self.featureCounts[s] = {}
+            self.emissionCounts[s] = {}
             for f in self.featureNames:
                 # there might be no instance in continuous case
-                featureVals[s][f] = []
+                self.featureCounts[s][f] = 0
+                if self.featuresCorD[f] == DISCRETE:
+                    self.emissionCounts[s][f] = [0]*self.numVals[f]
+                else:
+                    self.emissionCounts[s][f] = [0.0, 0.0]
 
-        # Now gather the features for each state
+    def countEmissions( self, trainingData, trainingLabels, weight ):
+        # Now gather the features for each state.  The values of continuous
+        # features are collected and merged in as one batch per state
+        samples = {}
         for i in range(len(trainingData)):
             oneSketchFeatures = trainingData[i]
             oneSketchLabels = trainingLabels[i]
             
             for j in range(len(oneSketchFeatures)):
                 features = oneSketchFeatures[j]
+                if not isinstance(features, dict):
+                    features = self.codebook.decode(features)
+                s = oneSketchLabels[j]
                 for f in features.keys():
-                    featureVals[oneSketchLabels[j]][f].append(features[f])
-
+                    fval = features[f]
+                    if self.featuresCorD[f] == DISCRETE:
+                        self.emissionCounts[s][f][fval] += weight
+                        self.featureCounts[s][f] += weight
+                    else:
+                        samples.setdefault((s, f), []).append(fval)
+        for (s, f), values in samples.items():
+            self.addSamples(s, f, values, weight)
+
+    def addSamples( self, s, f, values, weight = 1 ):
+        ''' Add (or with weight -1 take out) values of the continuous
+            feature f to the count and moments of state s.  The moments of
+            the values are found with two passes and then merged in. '''
+        values = numpy.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        batchMean = values.mean()
+        batch = (len(values), batchMean, float(((values - batchMean)**2).sum()))
+        mean, m2 = self.emissionCounts[s][f]
+        n, mean, m2 = mergeMoments((self.featureCounts[s][f], mean, m2), batch, weight)
+        self.featureCounts[s][f] = n
+        self.emissionCounts[s][f] = [float(mean), float(m2)]
+
+    def makeEmissions( self ):
+        self.emissions = {}
         # Do a slightly different thing for conituous vs. discrete features
-        for s in featureVals.keys():
-            for f in featureVals[s].keys():
+        for s in self.states:
+            self.emissions[s] = {}
+            for f in self.featureNames:
+                n = self.featureCounts[s][f]
                 if self.featuresCorD[f] == CONTINUOUS:
                     # Use a gaussian representation, so just find the mean and standard dev of the data
-                    # mean is just the sample mean
-                    mean = sum(featureVals[s][f])/len(featureVals[s][f])
-                    sigmasq = sum([(x - mean)**2 for x in featureVals[s][f]]) / len(featureVals[s][f])
+                    mean, m2 = self.emissionCounts[s][f]
+                    sigmasq = max(m2/max(n, 1), self.varianceFloor)
                     sigma = math.sqrt(sigmasq)
                     self.emissions[s][f] = [mean, sigma]
                 if self.featuresCorD[f] == DISCRETE:
                     # If the feature is discrete then the CPD is a list
                     # We assume that feature values are integer, starting
                     # at 0.  This assumption could be generalized.
-                    counter = 0
-                    self.emissions[s][f] = [1]*self.numVals[f]  # Use add 1 smoothing
-                    for fval in featureVals[s][f]:
-                        self.emissions[s][f][fval] += 1
-                    # Now we have counts of each feature and we need to normalize
-                    for i in range(len(self.emissions[s][f])):
-                        self.emissions[s][f][i] = max(1.0,self.emissions[s][f][i]) / float(len(featureVals[s][f])+self.numVals[f])
+                    # Use add 1 smoothing
+                    self.emissions[s][f] = [max(1.0,1+c) / float(n+self.numVals[f])
+                                            for c in self.emissionCounts[s][f]]
+
+    def makeCodebook( self ):
+        ''' Return a codebook over the features, or None (see codebookFor) '''
+        return codebookFor(self.featureNames, self.featuresCorD, self.numVals)
 
     # Part 1 Viterbi Testing Example
     def testViterbi(self):
@@ -137,55 +473,394 @@ class HMM:
         self.priors = {'Sunny':0.63,'Cloudy':0.17,'Rainy':0.2}
         self.emissions = {'Sunny':{'Evidence':[0.6,0.2,0.15,0.05]},'Cloudy':{'Evidence':[0.25,0.25,0.25,0.25]},'Rainy':{'Evidence':[0.05,0.10,0.35,0.50]}}
         self.transitions = {'Sunny':{'Sunny':0.5,'Cloudy':0.375,'Rainy':0.125},'Cloudy':{'Sunny':0.25,'Cloudy':0.125,'Rainy':0.625},'Rainy':{'Sunny':0.25,'Cloudy':0.375,'Rainy':0.375}}
-        print 'result test label sequence is: ' + str(self.label([{'Evidence':0},{'Evidence':2},{'Evidence':3}]))
+        labels = self.label([{'Evidence':0},{'Evidence':2},{'Evidence':3}])
+        log.info('result test label sequence is: %s', labels)
+        return labels
                   
     def label( self, data ):
         ''' Find the most likely labels for the sequence of data
             This is an implementation of the Viterbi algorithm  '''
-        # You will implement this function
-        #list of 'text' and 'drawing'
-        labelList = []
-        transitionList = []
-        prevPartialProb = {}
-        finalState = ''
-       
-        for fIndex in range(len(data)):
-            feature = data[fIndex]
-            tempPartialProb = {}
-            tempPrevState = {} 
-            for prior in self.priors:
-                # calculate emission probability
-                emissionProb = math.log(self.getEmissionProb(prior, feature),2)
-                # 1st state calculation 
-                if fIndex == 0:
-                    tempPartialProb[prior] = math.log(self.priors[prior],2) + emissionProb
-                # other state calculation
-                else:
-                    tempPartialProb[prior] = float('-inf');
-                    for prevState in self.transitions:
-                        tempProb = prevPartialProb[prevState] + math.log(self.transitions[prevState][prior],2) + emissionProb
-                        if tempProb > tempPartialProb[prior]:
-                            tempPartialProb[prior] = tempProb
-                            tempPrevState[prior] = prevState
-
-            #update previous state partial prob
-            prevPartialProb = tempPartialProb
-            #update transition list
-            if fIndex != 0:
-                transitionList.append(tempPrevState)
-        finalState = max(prevPartialProb.iteritems(), key=operator.itemgetter(1))[0]
-
-        labelList.append(finalState)
-        #fill labelList from the final state 
-        # print transitionList
-        for prev in reversed(transitionList):
-            labelList.insert(0,prev[finalState])
-            finalState = prev[finalState]
-        # print "final state partial probability: " + str(prevPartialProb)
-        # print "label sequence generated: " + str(labelList)
         #return a list of labels
-        return labelList
-    
+        return self.label_many([data])[0]
+
+    def label_many( self, dataList ):
+        ''' Label many sequences at once.  Returns a list with one label
+            list per sequence, the same as calling label on each of them.
+            The sequences are decoded in chunks of similar length (see
+            paddedBatches), and within a chunk every Viterbi step works on
+            a contiguous block of the sequences still running. '''
+        ret = [[] for data in dataList]
+        for order, lengths, logEmissions in self.paddedBatches(dataList):
+            paths = self.viterbi(logEmissions, lengths)
+            for b in range(len(order)):
+                ret[order[b]] = [self.stateOrder[k] for k in paths[b, :lengths[b]]]
+        return ret
+
+    def label_with_posteriors( self, data ):
+        ''' Return (labels, posteriors) for one sequence; see
+            label_many_with_posteriors '''
+        labels, posteriors = self.label_many_with_posteriors([data])
+        return labels[0], posteriors[0]
+
+    def label_many_with_posteriors( self, dataList ):
+        ''' Label many sequences and also return the posterior marginals
+            P(state at t|whole sequence) from forward-backward.  Returns
+            (labels, posteriors): labels is what label_many gives and
+            posteriors[i] is a (len(dataList[i]), numStates) array whose
+            columns follow self.stateOrder.  Both come from the same
+            padded log emissions, one chunk at a time. '''
+        labels = [[] for data in dataList]
+        posteriors = [numpy.zeros((0, len(self.states))) for data in dataList]
+        for order, lengths, logEmissions in self.paddedBatches(dataList):
+            paths = self.viterbi(logEmissions, lengths)
+            gamma = self.forwardBackward(logEmissions, lengths)
+            for b in range(len(order)):
+                labels[order[b]] = [self.stateOrder[k] for k in paths[b, :lengths[b]]]
+                posteriors[order[b]] = gamma[b, :lengths[b]]
+        return labels, posteriors
+
+    def paddedBatches( self, dataList ):
+        ''' Generate (order, lengths, logEmissions) for the non-empty
+            sequences of dataList in chunks: the indices of a chunk's
+            sequences longest first, their lengths, and their log
+            emissions padded into a (len(order), maxLength, numStates)
+            block.  The sequences are sorted by length and cut into chunks
+            of at most MAX_BATCH_STEPS padded steps (a longer sequence is
+            a chunk of its own), so sequences of similar length are padded
+            together and one long sequence does not pad the whole list. '''
+        indices = sorted([i for i in range(len(dataList)) if len(dataList[i]) > 0],
+                         key=lambda i: -len(dataList[i]))
+        if len(indices) == 0:
+            return
+        self.compileLogTables()
+        first = 0
+        while first < len(indices):
+            size = max(MAX_BATCH_STEPS // len(dataList[indices[first]]), 1)
+            order = indices[first:first + size]
+            first += size
+            lengths = numpy.array([len(dataList[i]) for i in order])
+            allData = []
+            for i in order:
+                allData.extend(dataList[i])
+            flat = self.logEmissionMatrix(allData)
+            logEmissions = numpy.zeros((len(order), lengths[0], len(self.stateOrder)))
+            start = 0
+            for b in range(len(order)):
+                logEmissions[b, :lengths[b]] = flat[start:start + lengths[b]]
+                start += lengths[b]
+            yield order, lengths, logEmissions
+
+    def compileLogTables( self ):
+        ''' Turn the priors and transitions into log2 arrays indexed by
+            state position.  The tables are only rebuilt when the model
+            dictionaries have been replaced (by train or testViterbi). '''
+        model = (self.priors, self.transitions, self.emissions)
+        if getattr(self, 'compiledFrom', None) is not None and \
+           all(a is b for a, b in zip(self.compiledFrom, model)):
+            return
+        # Rows and columns follow the order the old dict based loops used,
+        # so ties are broken exactly the same way
+        self.stateOrder = list(self.transitions)
+        self.stateIndex = dict((s, i) for i, s in enumerate(self.stateOrder))
+        self.finalOrder = numpy.array([self.stateIndex[s] for s in dict.fromkeys(list(self.priors))])
+        self.logPriors = numpy.array([log2(self.priors[s]) for s in self.stateOrder])
+        self.logTransitions = numpy.array([[log2(self.transitions[s][s2]) for s2 in self.stateOrder]
+                                           for s in self.stateOrder])
+        self.compileTransitionLists()
+        self.compileEmissionConstants()
+        # log2 P(observation code|state) for every code, when there is a
+        # codebook: the sum over the features of the log table row for the
+        # feature's digit of the code
+        self.codebook = self.makeCodebook()
+        self.logEmissionTable = None
+        if self.codebook is not None:
+            codes = numpy.arange(self.codebook.size)
+            self.logEmissionTable = numpy.zeros((self.codebook.size, len(self.stateOrder)))
+            for f, stride in zip(self.codebook.featureNames, self.codebook.strides):
+                self.logEmissionTable += self.discreteLogTables[f][codes // stride % self.numVals[f]]
+        self.compiledFrom = model
+
+    def refreshLogTables( self ):
+        ''' Recompute the compiled log tables from the current model.  The
+            existing arrays are overwritten in place when the states have
+            not changed, so anything holding on to them (such as a
+            StreamingLabeler) picks up the new model. '''
+        if getattr(self, 'compiledFrom', None) is None:
+            self.compileLogTables()
+            return
+        old = (self.stateOrder, self.logPriors, self.logTransitions, self.logEmissionTable)
+        self.compiledFrom = None
+        self.compileLogTables()
+        if old[0] != self.stateOrder or old[3] is None or self.logEmissionTable is None \
+           or old[3].shape != self.logEmissionTable.shape or not old[3].flags.writeable:
+            return
+        for oldTable, name in zip(old[1:], ('logPriors', 'logTransitions', 'logEmissionTable')):
+            oldTable[...] = getattr(self, name)
+            setattr(self, name, oldTable)
+
+    def compileTransitionLists( self ):
+        ''' List the possible (finite) transitions of logTransitions for
+            the sparse decoders.  transitionsByTarget is (sources, logs,
+            targets, starts, segments), sorted by target and then source:
+            the transitions into targets[i] are at starts[i]:starts[i+1]
+            and segments gives each transition's index in targets.
+            transitionsBySource is (starts, targets, logs), sorted by
+            source, with the transitions out of state i at
+            starts[i]:starts[i+1]. '''
+        S = len(self.logTransitions)
+        possible = numpy.isfinite(self.logTransitions)
+        self.transitionDensity = possible.mean() if S else 1.0
+        targets, sources = numpy.nonzero(possible.T)
+        segmentTargets, segmentStarts, segments = numpy.unique(targets, return_index=True,
+                                                               return_inverse=True)
+        self.transitionsByTarget = (sources, self.logTransitions[sources, targets],
+                                    segmentTargets, segmentStarts, segments)
+        sources, targets = numpy.nonzero(possible)
+        self.transitionsBySource = (numpy.searchsorted(sources, numpy.arange(S + 1)), targets,
+                                    self.logTransitions[sources, targets])
+
+    def getModelData( self ):
+        ''' Return the model as (header, arrays) for modelfile.write: the
+            probabilities and counts go in the header, the compiled log
+            tables in the arrays '''
+        self.compileLogTables()
+        header = {'states': self.states, 'featureNames': self.featureNames,
+                  'featuresCorD': self.featuresCorD, 'numVals': self.numVals,
+                  'minTransitionCount': self.minTransitionCount,
+                  'varianceFloor': self.varianceFloor, 'priors': self.priors, 'transitions': self.transitions,
+                  'emissions': self.emissions, 'stateOrder': self.stateOrder,
+                  'counts': None}
+        if self.priorCounts is not None:
+            header['counts'] = self.getCounts()
+        arrays = {'logPriors': self.logPriors, 'logTransitions': self.logTransitions,
+                  'finalOrder': self.finalOrder}
+        if self.logEmissionTable is not None:
+            arrays['logEmissionTable'] = self.logEmissionTable
+        return header, arrays
+
+    def setModelData( self, header, arrays ):
+        ''' Restore a model from the result of getModelData, using the
+            stored log tables as they are instead of compiling them '''
+        self.states = header['states']
+        self.featureNames = header['featureNames']
+        self.featuresCorD = header['featuresCorD']
+        self.numVals = header['numVals']
+        self.minTransitionCount = header.get('minTransitionCount')
+        self.varianceFloor = header.get('varianceFloor', VARIANCE_FLOOR)
+        self.priors = header['priors']
+        self.transitions = header['transitions']
+        self.emissions = header['emissions']
+        self.priorCounts = None
+        if header['counts'] is not None:
+            for name, value in header['counts'].items():
+                setattr(self, name, value)
+        self.isTrained = True
+        self.codebook = self.makeCodebook()
+        self.stateOrder = header['stateOrder']
+        self.stateIndex = dict((s, i) for i, s in enumerate(self.stateOrder))
+        self.finalOrder = numpy.array(arrays['finalOrder'])
+        self.logPriors = arrays['logPriors']
+        self.logTransitions = arrays['logTransitions']
+        self.compileTransitionLists()
+        self.compileEmissionConstants()
+        self.logEmissionTable = arrays.get('logEmissionTable')
+        self.compiledFrom = (self.priors, self.transitions, self.emissions)
+
+    def compileEmissionConstants( self ):
+        ''' Cache what featureLogEmissions needs: for every continuous
+            feature the per state (mean, -log2(sqrt(2 pi) sigma),
+            -log2(e)/(2 sigma^2)), with the variance floored, and for every
+            discrete feature a (numVals, numStates) log2 probability table '''
+        self.continuousConstants = {}
+        self.discreteLogTables = {}
+        for f in self.featureNames:
+            if self.featuresCorD[f] == CONTINUOUS:
+                means = numpy.array([self.emissions[s][f][0] for s in self.stateOrder], dtype=float)
+                sigmas = numpy.array([self.emissions[s][f][1] for s in self.stateOrder], dtype=float)
+                variances = numpy.maximum(sigmas**2, self.varianceFloor)
+                self.continuousConstants[f] = (means, -0.5*numpy.log2(2*math.pi*variances),
+                                               -1.0/(2*variances*math.log(2)))
+            else:
+                with numpy.errstate(divide='ignore'):
+                    self.discreteLogTables[f] = numpy.log2(numpy.array(
+                        [self.emissions[s][f] for s in self.stateOrder], dtype=float).T)
+
+    def featureLogEmissions( self, data ):
+        ''' logEmissionMatrix for feature dictionaries when some features
+            are continuous.  Each feature's log density is computed for
+            all the observations at once and the features are summed, so
+            nothing is multiplied in the linear domain and outliers do not
+            underflow to log(0). '''
+        ret = numpy.zeros((len(data), len(self.stateOrder)))
+        for f in self.featureNames:
+            present = numpy.array([f in features for features in data], dtype=bool)
+            if not present.any():
+                continue
+            values = numpy.array([features.get(f, 0) for features in data], dtype=float)
+            if self.featuresCorD[f] == CONTINUOUS:
+                means, logNorms, scales = self.continuousConstants[f]
+                logDensities = logNorms + scales * (values[:, None] - means)**2
+            else:
+                logDensities = self.discreteLogTables[f][values.astype(numpy.intp)]
+            logDensities[~present] = 0
+            ret += logDensities
+        return ret
+
+    def logEmissionMatrix( self, data ):
+        ''' Return a (len(data), numStates) array of log2 P(features|state).
+            Observations are either codebook codes, which index the
+            emission table, or feature dictionaries, whose rows are
+            computed by featureLogEmissions. '''
+        isCode = numpy.array([not isinstance(features, dict) for features in data], dtype=bool)
+        if isCode.all():
+            return self.logEmissionTable[numpy.asarray(data, dtype=numpy.intp)]
+        if not isCode.any():
+            return self.featureLogEmissions(data)
+        ret = numpy.empty((len(data), len(self.stateOrder)))
+        codes = [data[t] for t in numpy.flatnonzero(isCode)]
+        ret[isCode] = self.logEmissionTable[numpy.asarray(codes, dtype=numpy.intp)]
+        ret[~isCode] = self.featureLogEmissions([data[t] for t in numpy.flatnonzero(~isCode)])
+        return ret
+
+    def viterbi( self, logEmissions, lengths ):
+        ''' Run the Viterbi recursion over a padded (B, T, numStates) log
+            emission array.  lengths must be sorted longest first.  Returns
+            a (B, T) array of state indices, valid up to each length.
+            With a sparse transition matrix each step only looks at the
+            possible transitions; the result is the same either way. '''
+        if self.topK is not None or self.beam is not None:
+            return self.viterbiPruned(logEmissions, lengths)
+        sparse = self.transitionDensity <= SPARSE_DENSITY
+        B, T, S = logEmissions.shape
+        delta = self.logPriors + logEmissions[:, 0]
+        backPointers = numpy.zeros((B, T, S), dtype=numpy.intp)
+        rows = numpy.arange(B)[:, None]
+        cols = numpy.arange(S)[None, :]
+        # active[t] is how many sequences are still running at step t
+        active = [int((lengths > t).sum()) for t in range(T)]
+        for t in range(1, T):
+            k = active[t]
+            if sparse:
+                backPointers[:k, t], delta[:k] = self.sparseStep(delta[:k], logEmissions[:k, t])
+                continue
+            # scores[b][i][j] is the best score of being in i then moving to j
+            scores = delta[:k, :, None] + self.logTransitions + logEmissions[:k, t, None, :]
+            backPointers[:k, t] = scores.argmax(axis=1)
+            delta[:k] = scores[rows[:k], backPointers[:k, t], cols]
+        paths = numpy.zeros((B, T), dtype=numpy.intp)
+        state = self.finalOrder[delta[:, self.finalOrder].argmax(axis=1)]
+        paths[numpy.arange(B), lengths - 1] = state
+        for t in range(T - 1, 0, -1):
+            k = active[t]
+            state[:k] = backPointers[numpy.arange(k), t, state[:k]]
+            paths[:k, t - 1] = state[:k]
+        return paths
+
+    def sparseStep( self, delta, logEmission ):
+        ''' One Viterbi step for a (k, numStates) block of deltas that only
+            visits the possible transitions.  Returns (backPointers,
+            newDelta).  Ties go to the lowest source state, as in the
+            dense step. '''
+        sources, logs, segmentTargets, segmentStarts, segments = self.transitionsByTarget
+        backPointer = numpy.zeros(delta.shape, dtype=numpy.intp)
+        newDelta = numpy.empty(delta.shape)
+        newDelta.fill(float('-inf'))
+        if len(sources) == 0:
+            return backPointer, newDelta
+        scores = delta[:, sources] + logs
+        best = numpy.maximum.reduceat(scores, segmentStarts, axis=1)
+        position = numpy.where(scores == best[:, segments], numpy.arange(len(sources)), len(sources))
+        first = numpy.minimum.reduceat(position, segmentStarts, axis=1)
+        backPointer[:, segmentTargets] = sources[first]
+        newDelta[:, segmentTargets] = best + logEmission[:, segmentTargets]
+        return backPointer, newDelta
+
+    def viterbiPruned( self, logEmissions, lengths ):
+        ''' Viterbi with beam pruning (see topK and beam in __init__),
+            taking the same arguments and giving the same kind of result
+            as viterbi.  Each step only follows the transitions out of the
+            states that survived the last one, so it costs about topK
+            times the number of successors per state rather than
+            numStates^2.  The best path can be pruned away, in which case
+            the result differs from viterbi. '''
+        B, T, S = logEmissions.shape
+        starts, outTargets, outLogs = self.transitionsBySource
+        paths = numpy.zeros((B, T), dtype=numpy.intp)
+        for b in range(B):
+            n = lengths[b]
+            delta = self.logPriors + logEmissions[b, 0]
+            backPointers = numpy.zeros((n, S), dtype=numpy.intp)
+            for t in range(1, n):
+                alive = self.survivingStates(delta)
+                counts = starts[alive + 1] - starts[alive]
+                total = counts.sum()
+                edges = numpy.repeat(starts[alive] - (numpy.cumsum(counts) - counts), counts) \
+                        + numpy.arange(total)
+                sources = numpy.repeat(alive, counts)
+                targets = outTargets[edges]
+                scores = delta[sources] + outLogs[edges]
+                # the best source for each target comes first: ties go to
+                # the lowest source, as in viterbi
+                order = numpy.lexsort((sources, -scores, targets))
+                targets, sources, scores = targets[order], sources[order], scores[order]
+                first = numpy.ones(total, dtype=bool)
+                first[1:] = targets[1:] != targets[:-1]
+                delta = numpy.empty(S)
+                delta.fill(float('-inf'))
+                delta[targets[first]] = scores[first] + logEmissions[b, t, targets[first]]
+                backPointers[t, targets[first]] = sources[first]
+            state = self.finalOrder[delta[self.finalOrder].argmax()]
+            paths[b, n - 1] = state
+            for t in range(n - 1, 0, -1):
+                state = backPointers[t, state]
+                paths[b, t - 1] = state
+        return paths
+
+    def survivingStates( self, delta ):
+        ''' The sorted indices of the states that viterbiPruned extends '''
+        alive = numpy.nonzero(numpy.isfinite(delta))[0]
+        if self.beam is not None and len(alive):
+            alive = alive[delta[alive] >= delta[alive].max() - self.beam]
+        if self.topK is not None and len(alive) > self.topK:
+            alive = alive[numpy.argsort(-delta[alive], kind='mergesort')[:self.topK]]
+        return numpy.sort(alive)
+
+    def forwardBackward( self, logEmissions, lengths ):
+        ''' Run forward-backward in the log domain over a padded (B, T,
+            numStates) log emission array, with lengths sorted longest
+            first as for viterbi.  Returns a (B, T, numStates) array of
+            posterior state probabilities; the padding is all zero. '''
+        B, T, S = logEmissions.shape
+        active = [int((lengths > t).sum()) for t in range(T)]
+        # alpha[b, t, j] = log2 P(observations up to t, state j at t)
+        alpha = numpy.zeros((B, T, S))
+        alpha[:, 0] = self.logPriors + logEmissions[:, 0]
+        for t in range(1, T):
+            k = active[t]
+            alpha[:k, t] = logSumExp2(alpha[:k, t - 1, :, None] + self.logTransitions, 1) \
+                           + logEmissions[:k, t]
+        # beta[b, t, i] = log2 P(observations after t|state i at t); it
+        # stays 0 at the last step of each sequence
+        beta = numpy.zeros((B, T, S))
+        for t in range(T - 2, -1, -1):
+            k = active[t + 1]
+            beta[:k, t] = logSumExp2(self.logTransitions +
+                                     (logEmissions[:k, t + 1] + beta[:k, t + 1])[:, None, :], 2)
+        logLikelihood = logSumExp2(alpha[numpy.arange(B), lengths - 1], 1)
+        gamma = numpy.exp2(alpha + beta - logLikelihood[:, None, None])
+        gamma[numpy.arange(T)[None, :] >= lengths[:, None]] = 0
+        return gamma
+
+    def viterbiStep( self, delta, logEmission ):
+        ''' Advance the Viterbi recursion by one observation.  delta is
+            None for the first observation.  Returns the new delta and the
+            back pointers for this step (None for the first one). '''
+        if delta is None:
+            return self.logPriors + logEmission, None
+        scores = delta[:, None] + self.logTransitions + logEmission[None, :]
+        backPointer = scores.argmax(axis=0)
+        return scores[backPointer, numpy.arange(len(delta))], backPointer
+
     def getEmissionProb( self, state, features ):
         ''' Get P(features|state).
             Consider each feature independent so
@@ -209,8 +884,10 @@ class HMM:
 
 
 class StrokeLabeler:
-    def __init__(self):
-        ''' Inialize a stroke labeler. '''
+    def __init__(self, compact = False):
+        ''' Inialize a stroke labeler.  With compact set, loaded strokes
+            are CompactStrokes, which take much less memory. '''
+        self.strokeClass = CompactStroke if compact else Stroke
         self.labels = ['text', 'drawing']
         # a map from labels in files to labels we use here
         drawingLabels = ['Wire', 'AND', 'OR', 'XOR', 'NAND', 'NOT']
@@ -222,6 +899,8 @@ class StrokeLabeler:
             self.labelDict[l] = 'drawing'
         for l in textLabels:
             self.labelDict[l] = 'text'
+        # Set to a count to train sparse transitions (see HMM.__init__)
+        self.minTransitionCount = None
 
         # Define the features to be used in the featurefy function
         # if you change the featurefy function, you must also change
@@ -238,14 +917,32 @@ class StrokeLabeler:
         for featureName in self.featureNames:
             self.contOrDisc[featureName] = DISCRETE
             self.numFVals[featureName] = 2
+        # Parsed sketches are only cached on disk after useCache is called
+        self.cache = None
+        # (method, tolerance) to reduce the points of strokes before their
+        # features are computed (see useSimplification)
+        self.simplification = None
+        # Replace with a stats.StatsCollector to time the pipeline stages
+        self.stats = stats.NULL_STATS
+        # With deterministicIds, saveFile derives each shape id from its
+        # stroke id, so labeling the same file twice gives identical output
+        self.deterministicIds = False
+
+        # featurefy gives each stroke a single observation code from this
+        self.codebook = codebookFor(self.featureNames, self.contOrDisc, self.numFVals)
 
         
+    @stats.timed('featurize')
     def featurefy( self, strokes):
-        ''' Converts the list of strokes into a list of feature dictionaries
-            suitable for the HMM
+        ''' Converts the list of strokes into a list of observations
+            suitable for the HMM: one codebook code per stroke, or a
+            feature dictionary per stroke if some features are continuous
             The names of features used here have to match the names
             passed into the HMM'''
         ret = []
+        if self.needsNeighborhoodFeatures(strokes):
+            self.setNeighborhoodFeatures(strokes)
+        continuous = [f for f in self.featureNames if self.contOrDisc[f] == CONTINUOUS]
         for s in strokes:
             d = {}  # The feature dictionary to be returned for one stroke
 
@@ -268,10 +965,14 @@ class StrokeLabeler:
             '''
             With this two line of codes, we import all features we want to use from the self.featureNames list
             Then we use the already-calculated values to classify continous features, which also means that we don't have any discrete values to give to HMM model
+            The value of a feature is the number of its thresholds that are below the continuous value
             The calculation of those classification values are in 'generateFeatureIntervals' function
             '''
             for featureName,featureInterval in self.featureIntervals.items():
-                    d[featureName] = 1 if s.featureValues[featureName] > featureInterval else 0 
+                    d[featureName] = bisect.bisect_left(featureInterval, s.featureValues[featureName])
+            # continuous features are given to the HMM as they are
+            for featureName in continuous:
+                d[featureName] = s.featureValues[featureName]
             # We can add more features here just by adding them to the dictionary
             # d as we did with length.  Remember that when you add features,
             # you also need to add them to the three member data structures
@@ -279,77 +980,227 @@ class StrokeLabeler:
             #    self.numFVals (for discrete features only)
 
 
-            ret.append(d)  # append the feature dictionary to the list
+            # append the observation code (or the feature dictionary if
+            # some features are continuous) to the list
+            ret.append(d if self.codebook is None else self.codebook.encode(d))
             
         return ret
     
-    def generateFeatureIntervals(self,allStrokes,allLabels,intervalNums = 10):
-        result = {}
+    def generateFeatureIntervals(self,allStrokes,allLabels):
+        ''' Find the thresholds that bin each discrete feature into numFVals values.
+            For every feature the values are sorted once, and the split with
+            the least conditional entropy of the labels is found among all
+            distinct split points using prefix counts.  More than 2 bins are
+            made by repeatedly splitting the bin that gains the most. '''
+        labelIndex = dict((l, i) for i, l in enumerate(self.labels))
+        labelIds = numpy.array([labelIndex[l] for labels in allLabels for l in labels], dtype=numpy.intp)
         for featureName in self.featureNames:
-            result[featureName] = {'text':[],'drawing':[]}
-        for i in range(len(allStrokes)):
-            for j in range(len(allStrokes[i])):
-                for featureName in self.featureNames:
-                    result[featureName][allLabels[i][j]].append(allStrokes[i][j].featureValues[featureName])
-        # self.result =  result
-        for featureName in self.featureNames:
-            textList = result[featureName]['text']
-            drawingList = result[featureName]['drawing']
-            averText = 0 if len(textList) == 0 else float(sum(textList))/len(textList)
-            averDrawing = 0 if len(drawingList) == 0 else float(sum(drawingList))/len(drawingList)
-            target = (averText,2)
-            step = float(averDrawing-averText)/intervalNums
-            dPoint = averText
-            for i in range(1,intervalNums): 
-                dPoint += step
-                list1 = ['drawing' for v in drawingList if v>dPoint] + ['text' for v in textList if v>dPoint]
-                list2 = ['drawing' for v in drawingList if v<=dPoint] + ['text' for v in textList if v<=dPoint]
-                entropy = self.calculateEntropy(list1,list2)
-                if entropy<target[1]:
-                    target = (dPoint,entropy)
-            self.featureIntervals[featureName] = target[0]
-
-
-
-
-    def calculateEntropy(self, list1, list2):
-        prob1 = float(len(list1))/(len(list1) + len(list2))
-        prob2 = float(len(list2))/(len(list1) + len(list2))  
-        numText1 = 0
-        numText2 = 0        
-        for l1 in list1:
-            if l1 == 'text':
-                numText1 += 1
-        probText1 = float(numText1)/len(list1)
-        probDrawing1 = 1 - probText1
-        for l2 in list2:
-            if l2 == 'text':
-                numText2 += 1
-        probText2 = float(numText2)/len(list2)
-        probDrawing2 = 1 - probText2
-        list1Entropy = 0 if probText1 * probDrawing1 == 0 else -probText1*math.log(probText1,2) - probDrawing1*math.log(probDrawing1,2)
-        list2Entropy = 0 if probText2 * probDrawing2 == 0 else -probText2*math.log(probText2,2) - probDrawing2*math.log(probDrawing2,2)
-        conditionEntropy = prob1 * list1Entropy + prob2 * list2Entropy
-
-    def trainHMM( self, trainingFiles ):
-        ''' Train the HMM '''
-        self.hmm = HMM( self.labels, self.featureNames, self.contOrDisc, self.numFVals )
+            if self.contOrDisc[featureName] == CONTINUOUS:
+                # continuous features are not binned
+                self.featureIntervals.pop(featureName, None)
+                continue
+            values = numpy.array([stroke.featureValues[featureName] for strokes in allStrokes
+                                  for stroke in strokes], dtype=float)
+            # per distinct value, how many strokes of each label have it
+            distinct, inverse = numpy.unique(values, return_inverse=True)
+            counts = numpy.zeros((len(distinct), len(self.labels)))
+            numpy.add.at(counts, (inverse, labelIds), 1)
+            self.featureIntervals[featureName] = self.findThresholds(distinct, counts, self.numFVals[featureName])
+
+    def findThresholds(self, values, counts, numBins):
+        ''' Given sorted distinct feature values and a (len(values), numLabels)
+            array of label counts for each value, return up to numBins-1
+            sorted thresholds that split the values into low entropy bins.
+            Each threshold is halfway between two neighbouring values. '''
+        cum = numpy.vstack([numpy.zeros((1, counts.shape[1])), numpy.cumsum(counts, axis=0)])
+
+        def weightedEntropy(c):
+            # n * H(c) for rows of counts c
+            n = c.sum(axis=-1)
+            return xlog2x(n) - xlog2x(c).sum(axis=-1)
+
+        def bestSplit(a, b):
+            # best split of values[a:b] as (gain, k): values[a:k] | values[k:b]
+            if b - a < 2:
+                return None
+            k = numpy.arange(a + 1, b)
+            left = cum[k] - cum[a]
+            right = cum[b] - cum[k]
+            cost = weightedEntropy(left) + weightedEntropy(right)
+            best = cost.argmin()
+            return weightedEntropy(cum[b] - cum[a]) - cost[best], k[best]
+
+        segments = [(0, len(values))]
+        splits = [bestSplit(0, len(values))]
+        thresholds = []
+        while len(thresholds) < numBins - 1:
+            candidates = [i for i in range(len(splits)) if splits[i] is not None]
+            if len(candidates) == 0:
+                break
+            i = max(candidates, key=lambda i: splits[i][0])
+            (a, b), k = segments[i], splits[i][1]
+            thresholds.append(float(values[k - 1] + values[k]) / 2.0)
+            segments[i:i+1] = [(a, k), (k, b)]
+            splits[i:i+1] = [bestSplit(a, k), bestSplit(k, b)]
+        thresholds.sort()
+        return thresholds
+
+    def useFineLabels( self, fileLabels = None ):
+        ''' Learn the shape types of the files ('Wire', 'AND', ... 'Label')
+            as labels of their own instead of just drawing and text.
+            fileLabels lists the types to learn (default: all the types
+            the labeler knows); strokes of other types are skipped, as
+            before.  Must be called before training. '''
+        if fileLabels is None:
+            fileLabels = sorted(self.labelDict)
+        self.labels = list(fileLabels)
+        self.labelDict = dict((l, l) for l in fileLabels)
+
+    def trainHMM( self, trainingFiles, workers = 1 ):
+        ''' Train the HMM.  With workers > 1 the files are loaded by a pool
+            of that many processes; results come back in file order, so the
+            model is the same as with a serial load. '''
+        self.hmm = HMM( self.labels, self.featureNames, self.contOrDisc, self.numFVals,
+                        self.minTransitionCount )
+        # numFVals may have changed since __init__, so use the HMM's codebook
+        self.codebook = self.hmm.codebook
         allStrokes = []
         allLabels = []
-        for f in trainingFiles:
-            print "Loading file", f, "for training"
-            strokes, labels = self.loadLabeledFile( f )
-            allStrokes.append(strokes)
-            allLabels.append(labels)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initLoaderWorker,
+                                        (self.labelDict, self.cache, self.featureNames,
+                                         self.simplification))
+            try:
+                results = pool.map(loadLabeledFileData, trainingFiles, 1)
+            finally:
+                pool.close()
+                pool.join()
+            for f, (strokeData, labels) in zip(trainingFiles, results):
+                log.info("Loaded file %s for training", f)
+                allStrokes.append([self.strokeClass.fromData(d) for d in strokeData])
+                allLabels.append(labels)
+        else:
+            for f in trainingFiles:
+                log.info("Loading file %s for training", f)
+                strokes, labels = self.loadLabeledFile( f )
+                allStrokes.append(strokes)
+                allLabels.append(labels)
         self.allStrokes = allStrokes
         self.allLabels = allLabels
         self.generateFeatureIntervals(allStrokes,allLabels)
         allObservations = [self.featurefy(s) for s in allStrokes]
-        print "original labels:" + str(labels)
+        self.allObservations = allObservations
+        log.debug("original labels: %s", allLabels)
         self.hmm.train(allObservations, allLabels)
 
-    def trainHMMDir( self, trainingDir ):
-        ''' train the HMM on all the files in a training directory '''
+    def save_model( self, filename ):
+        ''' Save the trained HMM and the feature thresholds in a model file
+            that load_model can read back without any training '''
+        header, arrays = self.hmm.getModelData()
+        header = {'hmm': header, 'labels': self.labels, 'labelDict': self.labelDict,
+                  'featureNames': self.featureNames, 'contOrDisc': self.contOrDisc,
+                  'numFVals': self.numFVals, 'featureIntervals': self.featureIntervals,
+                  'simplification': self.simplification}
+        modelfile.write(filename, header, arrays)
+
+    def load_model( self, filename, mmap = True ):
+        ''' Load a model saved by save_model.  With mmap the log tables
+            are mapped from the file rather than read. '''
+        header, arrays = modelfile.read(filename, mmap)
+        self.labels = header['labels']
+        self.labelDict = header['labelDict']
+        self.featureNames = header['featureNames']
+        self.contOrDisc = header['contOrDisc']
+        self.numFVals = header['numFVals']
+        self.featureIntervals = header['featureIntervals']
+        simplification = header.get('simplification')
+        self.simplification = tuple(simplification) if simplification else None
+        self.hmm = HMM()
+        self.hmm.setModelData(header['hmm'], arrays)
+        self.codebook = self.hmm.codebook
+        self.minTransitionCount = self.hmm.minTransitionCount
+
+    def trainHMMStream( self, examples, digits = 4 ):
+        ''' Train the HMM in a single pass over examples, an iterable of
+            (strokes, labels) such as iterLabeledFiles(files).  Only
+            counts are kept: the prior and transition counts, running means
+            and variances for continuous features, and for each discrete feature a
+            histogram of label counts over its values rounded to digits
+            significant digits.  The thresholds are then found on the
+            histograms and the emission counts read off them, so memory
+            does not grow with the number of strokes.  The thresholds can
+            differ slightly from trainHMM's because of the rounding.
+            Nothing is kept per stroke, so validateAll and crossValidate
+            can not be used on a model trained this way. '''
+        self.hmm = HMM( self.labels, self.featureNames, self.contOrDisc, self.numFVals,
+                        self.minTransitionCount )
+        hmm = self.hmm
+        hmm.resetPriorCounts()
+        hmm.resetTransitionCounts()
+        hmm.resetEmissionCounts()
+        labelIndex = dict((l, i) for i, l in enumerate(self.labels))
+        discrete = [f for f in self.featureNames if self.contOrDisc[f] == DISCRETE]
+        continuous = [f for f in self.featureNames if self.contOrDisc[f] == CONTINUOUS]
+        # histograms[f] maps a rounded value to an array of counts per label
+        histograms = dict((f, {}) for f in discrete)
+        numStrokes = 0
+        for strokes, labels in examples:
+            if len(labels) == 0:
+                continue
+            if self.needsNeighborhoodFeatures(strokes):
+                self.setNeighborhoodFeatures(strokes)
+            hmm.countPriors( [labels], 1 )
+            hmm.countTransitions( [labels], 1 )
+            labelIds = numpy.array([labelIndex[l] for l in labels], dtype=numpy.intp)
+            for f in discrete:
+                values = roundSignificant([stroke.featureValues[f] for stroke in strokes], digits)
+                keys, inverse = numpy.unique(values, return_inverse=True)
+                counts = numpy.zeros((len(keys), len(self.labels)), dtype=numpy.int64)
+                numpy.add.at(counts, (inverse, labelIds), 1)
+                histogram = histograms[f]
+                for key, row in zip(keys.tolist(), counts):
+                    if key in histogram:
+                        histogram[key] += row
+                    else:
+                        histogram[key] = row
+            for f in continuous:
+                byLabel = {}
+                for stroke, label in zip(strokes, labels):
+                    byLabel.setdefault(label, []).append(stroke.featureValues[f])
+                for label, values in byLabel.items():
+                    hmm.addSamples(label, f, values)
+            numStrokes += len(labels)
+        log.info("Counted %d strokes", numStrokes)
+
+        for f in discrete:
+            keys = numpy.array(sorted(histograms[f]), dtype=float)
+            counts = numpy.array([histograms[f][key] for key in keys.tolist()],
+                                 dtype=numpy.int64).reshape((len(keys), len(self.labels)))
+            self.featureIntervals[f] = self.findThresholds(keys, counts, self.numFVals[f])
+            bins = numpy.searchsorted(self.featureIntervals[f], keys, 'left')  # as bisect_left
+            for label, i in labelIndex.items():
+                hmm.featureCounts[label][f] = int(counts[:, i].sum())
+                hmm.emissionCounts[label][f] = [int(c) for c in numpy.bincount(
+                    bins, weights=counts[:, i], minlength=self.numFVals[f])]
+        for f in continuous:
+            self.featureIntervals.pop(f, None)
+        hmm.isTrained = True
+        hmm.makePriors()
+        hmm.makeTransitions()
+        hmm.makeEmissions()
+        hmm.refreshLogTables()
+        self.codebook = hmm.codebook
+
+    def iterLabeledFiles( self, filenames ):
+        ''' Yield (strokes, labels) for each labeled file in turn, loading
+            each one only when it is asked for '''
+        for f in filenames:
+            log.info("Loading file %s for training", f)
+            yield self.loadLabeledFile( f )
+
+    def trainHMMDir( self, trainingDir, workers = 1 ):
+        ''' train the HMM on all the files in a training directory,
+            loading them with workers processes '''
 
         for fFileObj in os.walk(trainingDir):
             lFileList = fFileObj[2]
@@ -360,122 +1211,160 @@ class StrokeLabeler:
                 goodList.append(x)
         
         tFiles = [ trainingDir + "/" + f for f in goodList ] 
-        self.trainHMM(tFiles)
+        self.trainHMM(tFiles, workers)
 
     def featureTest( self, strokeFile ):
         ''' Loads a stroke file and tests the feature functions '''
         strokes, labels = self.loadLabeledFile( strokeFile )
         for i in range(len(strokes)):
-            print " "
-            print strokes[i].substrokeIds[0]
-            print "Label is", labels[i]
-            print "Length is", strokes[i].length()
-            print "Curvature is", strokes[i].sumOfCurvature(abs)
+            log.info(" ")
+            log.info(strokes[i].substrokeIds[0])
+            log.info("Label is %s", labels[i])
+            log.info("Length is %s", strokes[i].length())
+            log.info("Curvature is %s", strokes[i].sumOfCurvature(abs))
     
     def labelFile( self, strokeFile, outFile ):
         ''' Label the strokes in the file strokeFile and save the labels
-            (with the strokes) in the outFile '''
-        print "Labeling file", strokeFile
+            (with the strokes) in the outFile.  Returns the labels. '''
+        log.info("Labeling file %s", strokeFile)
         strokes = self.loadStrokeFile( strokeFile )
         labels = self.labelStrokes( strokes )
-        print "Labeling done, saving file as", outFile
-        print "output labels: " + str(labels)
+        log.info("Labeling done, saving file as %s", outFile)
+        log.debug("output labels: %s", labels)
         self.saveFile( strokes, labels, strokeFile, outFile )
+        return labels
 
     def labelStrokes( self, strokes ):
         ''' return a list of labels for the given list of strokes '''
         if self.hmm == None:
-            print "HMM must be trained first"
+            log.error("HMM must be trained first")
             return []
         strokeFeatures = self.featurefy(strokes)
-        # print strokeFeatures
-        return self.hmm.label(strokeFeatures)
+        with self.stats.stage('decode'):
+            return self.hmm.label(strokeFeatures)
+
+    def labelStrokesMany( self, strokeLists ):
+        ''' return a list of label lists, one for each list of strokes,
+            decoding all of them in one batch '''
+        if self.hmm == None:
+            log.error("HMM must be trained first")
+            return [[] for strokes in strokeLists]
+        observations = [self.featurefy(strokes) for strokes in strokeLists]
+        with self.stats.stage('decode'):
+            return self.hmm.label_many(observations)
+
+    def labelStrokesWithConfidence( self, strokes ):
+        ''' return (labels, confidences) for the given list of strokes:
+            the labels labelStrokes gives, and for each stroke the
+            posterior probability of its label given the whole sketch '''
+        if self.hmm == None:
+            log.error("HMM must be trained first")
+            return [], []
+        strokeFeatures = self.featurefy(strokes)
+        with self.stats.stage('decode'):
+            labels, posteriors = self.hmm.label_with_posteriors(strokeFeatures)
+        columns = [self.hmm.stateIndex[label] for label in labels]
+        return labels, [float(p) for p in posteriors[numpy.arange(len(labels)), columns]]
 
+    @stats.timed('save')
     def saveFile( self, strokes, labels, originalFile, outFile ):
         ''' Save the labels of the stroke objects and the stroke objects themselves
             in an XML format that can be visualized by the labeler.
             Need to input the original file from which the strokes were read
-            so that we can retrieve a lot of data that we don't store here'''
-        sketch = xml.dom.minidom.parse(originalFile)
-        # copy most of the data, including all points, substrokes, strokes
-        # then just add the shapes onto the end
-        impl =  xml.dom.minidom.getDOMImplementation()
-        
-        newdoc = impl.createDocument(sketch.namespaceURI, "sketch", sketch.doctype)
-        top_element = newdoc.documentElement
-
-        # Add the attibutes from the sketch document
-        for attrib in sketch.documentElement.attributes.keys():
-            top_element.setAttribute(attrib, sketch.documentElement.getAttribute(attrib))
-
-        # Now add all the children from sketch as long as they are points, strokes
-        # or substrokes
-        sketchElem = sketch.getElementsByTagName("sketch")[0]
-        for child in sketchElem.childNodes:
-            if child.nodeType == xml.dom.Node.ELEMENT_NODE:
-                if child.tagName == "point":
-                    top_element.appendChild(child)
-                elif child.tagName == "shape":
-                    if child.getAttribute("type") == "substroke" or \
-                       child.getAttribute("type") == "stroke":
-                        top_element.appendChild(child)    
-
-        # Finally, add the new elements for the labels
+            so that we can retrieve a lot of data that we don't store here.
+            The original file is copied through byte for byte, except for
+            the top level elements other than points, substrokes and strokes
+            (the old labels), and the new label shapes are written before
+            the end of the sketch.  Nothing is re-serialized and memory use
+            does not grow with the file size.'''
+        # xml.sax.saxutils pulls in urllib and friends, so it is only
+        # imported when a file is actually saved
+        from xml.sax.saxutils import escape, quoteattr
+        rootName, encoding, keep, rootEnd = self.scanSegments(originalFile)
+        # the new elements go in the same namespace as the sketch
+        prefix = rootName[:len(rootName) - len(localName(rootName))]
+        if self.deterministicIds:
+            ids = [guid.derive(stroke.strokeId) for stroke in strokes]
+        else:
+            ids = guid.generate_batch(len(strokes))
+        shapes = []
         for i in range(len(strokes)):
-            # make a new element
-            newElem = newdoc.createElement("shape")
-            # Required attributes are type, name, id and time
-            newElem.setAttribute("type", labels[i])
-            newElem.setAttribute("name", "shape")
-            newElem.setAttribute("id", guid.generate() )
-            newElem.setAttribute("time", str(strokes[i].points[-1][2]))  # time is finish time
-
-            # Now add the children
-            for ss in strokes[i].substrokeIds:
-                ssElem = newdoc.createElement("arg")
-                ssElem.setAttribute("type", "substroke")
-                ssElem.appendChild(newdoc.createTextNode(ss))
-                newElem.appendChild(ssElem)
-                
-            top_element.appendChild(newElem)
-            
-
-        # Write to the file
-        filehandle = open(outFile, "w")
-        newdoc.writexml(filehandle)
-        filehandle.close()
-
-        # unlink the docs
-        newdoc.unlink()
-        sketch.unlink()
+            # Required attributes are type, name, id and time (the finish time)
+            args = [u'<%sarg type="substroke">%s</%sarg>' % (prefix, escape(ss), prefix)
+                    for ss in strokes[i].substrokeIds]
+            shapes.append(u'<%sshape id=%s name="shape" time="%s" type=%s>%s</%sshape>'
+                          % (prefix, quoteattr(ids[i]), strokes[i].endTime(),
+                             quoteattr(labels[i]), u''.join(args), prefix))
+        newElements = u''.join(shapes).encode(encoding, 'xmlcharrefreplace')
+
+        source = open(originalFile, 'rb')
+        try:
+            filehandle = open(outFile, 'wb')
+            try:
+                for start, end in keep:
+                    source.seek(start)
+                    copyBytes(source, filehandle, end - start)
+                filehandle.write(newElements)
+                source.seek(rootEnd)
+                copyBytes(source, filehandle)
+            finally:
+                filehandle.close()
+        finally:
+            source.close()
+
+    def scanSegments( self, filename ):
+        ''' Find what saveFile copies from a sketch file.  Returns
+            (rootName, encoding, keep, rootEnd): the tag of the root as
+            written (with any prefix), the declared encoding, the byte
+            ranges (start, end) to copy and the offset of the root's end
+            tag.  The ranges are everything before the first top level
+            element, and each point, substroke and stroke up to the start
+            of the next top level element. '''
+        parser = expat.ParserCreate()
+        found = {'root': None, 'encoding': 'utf-8', 'depth': 0, 'rootEnd': None}
+        starts = []    # (offset, keep) of each top level element
+        def xmlDecl( version, encoding, standalone ):
+            if encoding:
+                found['encoding'] = encoding
+        def startElement( name, attrs ):
+            depth = found['depth']
+            if depth == 0:
+                found['root'] = name
+            elif depth == 1:
+                tag = localName(name)
+                starts.append((parser.CurrentByteIndex, tag == "point" or
+                               (tag == "shape" and attrs.get("type") in ("substroke", "stroke"))))
+            found['depth'] = depth + 1
+        def endElement( name ):
+            found['depth'] -= 1
+            if found['depth'] == 0:
+                found['rootEnd'] = parser.CurrentByteIndex
+        parser.XmlDeclHandler = xmlDecl
+        parser.StartElementHandler = startElement
+        parser.EndElementHandler = endElement
+        f = open(filename, 'rb')
+        try:
+            parser.ParseFile(f)
+        finally:
+            f.close()
+
+        rootEnd = found['rootEnd']
+        boundaries = [offset for offset, k in starts] + [rootEnd]
+        keep = [(0, boundaries[0])]
+        for i in range(len(starts)):
+            if not starts[i][1]:
+                continue
+            if keep[-1][1] == boundaries[i]:
+                # runs of kept elements are copied in one go
+                keep[-1] = (keep[-1][0], boundaries[i+1])
+            else:
+                keep.append((boundaries[i], boundaries[i+1]))
+        return found['root'], found['encoding'], keep, rootEnd
 
     def loadStrokeFile( self, filename ):
         ''' Read in a file containing strokes and return a list of stroke
             objects '''
-        sketch = xml.dom.minidom.parse(filename)
-        # get the points
-        points = sketch.getElementsByTagName("point")
-        pointsDict = self.buildDict(points)
-    
-        # now get the strokes by first getting all shapes
-        allShapes = sketch.getElementsByTagName("shape")
-        shapesDict = self.buildDict(allShapes)
-
-        strokes = []
-        left,right = float('inf'),float('-inf')
-        for shape in allShapes:
-            if shape.getAttribute("type") == "stroke":
-                stroke = self.buildStroke( shape, shapesDict, pointsDict )
-                left,right = min(stroke.minX,left),max(stroke.maxX,right)
-                strokes.append(self.buildStroke( shape, shapesDict, pointsDict ))
-
-        for stroke in strokes:
-            stroke.featureValues['toSide'] = stroke.toSide(left,right)
-        # I THINK the strokes will be loaded in order, but make sure
-        if not self.verifyStrokeOrder(strokes):
-            print "WARNING: Strokes out of order"
-
-        sketch.unlink()
+        strokes, substrokeLabels = self.parseSketch(filename)
         return strokes
 
     def verifyStrokeOrder( self, strokes ):
@@ -484,93 +1373,208 @@ class StrokeLabeler:
         time = 0
         ret = True
         for s in strokes:
-            if s.points[0][2] < time:
+            if s.startTime() < time:
                 ret = False
                 break
-            time = s.points[0][2]
+            time = s.startTime()
         return ret
 
-    def buildDict( self, nodesWithIdAttrs ):
-        ret = {}
-        for n in nodesWithIdAttrs:
-            idAttr = n.getAttribute("id")
-            ret[idAttr] = n
-        
-        return ret
+    def useCache( self, cacheDir, maxBytes = 256*1024*1024, keyBy = 'hash' ):
+        ''' Keep parsed sketches in cacheDir so that files which have not
+            changed are not parsed again.  See sketchcache.SketchCache for
+            maxBytes and keyBy.  Passing None turns the cache off. '''
+        if cacheDir is None:
+            self.cache = None
+        else:
+            self.cache = sketchcache.SketchCache(cacheDir, maxBytes, keyBy)
+
+    def cacheVariant( self ):
+        ''' The settings that change the strokes stored in the cache '''
+        return repr(self.simplification) if self.simplification else ''
+
+    def useSimplification( self, method, tolerance ):
+        ''' Reduce the points of every stroke before its features are
+            computed, which bounds the cost of the features and the memory
+            of strokes from high rate digitizers.  method is 'resample'
+            (points tolerance apart along the stroke) or 'rdp'
+            (Ramer-Douglas-Peucker, dropping points within tolerance of the
+            simplified line); see the simplify module.  Passing None turns
+            it off.  The setting is saved with the model, so files are
+            labeled with the reduction the model was trained with.  The
+            points before and after are counted in stats, and each stroke's
+            reduction is logged at DEBUG. '''
+        if method is None:
+            self.simplification = None
+            return
+        if method not in simplify.METHODS:
+            raise ValueError("method must be one of %s" % ', '.join(sorted(simplify.METHODS)))
+        if tolerance <= 0:
+            raise ValueError("tolerance must be positive")
+        self.simplification = (method, tolerance)
+
+    def parseSketch( self, filename ):
+        ''' Return (strokes, substrokeLabels) for a sketch file.
+            strokes are the stroke objects in file order, with toSide set.
+            substrokeLabels maps a substroke id to the type of the (last)
+            non-stroke shape that lists it.  Uses the cache if there is one. '''
+        if self.cache is not None:
+            cached = self.cache.get(filename, self.cacheVariant())
+            if cached is not None:
+                self.stats.count('cacheHits')
+                strokeData, substrokeLabels = cached
+                strokes = [self.strokeClass.fromData(d) for d in strokeData]
+                if self.needsNeighborhoodFeatures(strokes):
+                    self.setNeighborhoodFeatures(strokes)
+                return strokes, substrokeLabels
+        strokes, substrokeLabels = self.readSketch(filename)
+        if self.needsNeighborhoodFeatures(strokes):
+            self.setNeighborhoodFeatures(strokes)
+        if self.cache is not None:
+            self.cache.put(filename, ([stroke.toData() for stroke in strokes], substrokeLabels),
+                           self.cacheVariant())
+        return strokes, substrokeLabels
+
+    def readSketch( self, filename ):
+        ''' Stream through a sketch file once and return (strokes,
+            substrokeLabels) as described in parseSketch. '''
+        with self.stats.stage('parse'):
+            pointDict, substrokeDict, strokeShapes, substrokeLabels = self.scanSketch(filename)
+        with self.stats.stage('buildStroke'):
+            strokes = self.buildStrokes(strokeShapes, substrokeDict, pointDict)
+        self.stats.count('files')
+        self.stats.count('strokes', len(strokes))
+        self.stats.count('points', len(pointDict))
 
-    def buildStroke( self, shape, shapesDict, pointDict ):
-        ''' build and return a stroke object by finding the substrokes and points
-            in the shape object '''
-        ret = Stroke( shape.getAttribute("id") )
-        points = []
-        # Get the children of the stroke
-        last = None
-        for ss in shape.childNodes:
-            if ss.nodeType != xml.dom.Node.ELEMENT_NODE \
-               or ss.getAttribute("type") != "substroke":
+        # I THINK the strokes will be loaded in order, but make sure
+        if not self.verifyStrokeOrder(strokes):
+            log.warning("WARNING: Strokes out of order")
+        return strokes, substrokeLabels
+
+    def scanSketch( self, filename ):
+        ''' Stream through a sketch file and return (pointDict,
+            substrokeDict, strokeShapes, substrokeLabels): the points by id,
+            the point ids of each substroke, the (id, substroke ids) of
+            each stroke in file order, and substrokeLabels (see
+            parseSketch).  Elements are reduced to ids and tuples as soon
+            as they end and then dropped, so the whole document is never
+            held in memory. '''
+        pointDict = {}       # point id -> (x, y, time)
+        substrokeDict = {}   # substroke id -> list of point ids
+        strokeShapes = []    # (stroke id, list of substroke ids) in file order
+        substrokeLabels = {}
+        root = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(filename, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
                 continue
+            depth -= 1
+            tag = elem.tag
+            if tag[0] == '{':
+                # namespaced: compare the local name
+                tag = localName(tag)
+            if tag == "point":
+                pointDict[elem.get("id", "")] = (int(elem.get("x")), int(elem.get("y")), int(elem.get("time")))
+            elif tag == "shape":
+                shapeType = elem.get("type", "")
+                if shapeType == "substroke":
+                    substrokeDict[elem.get("id", "")] = [child.text for child in elem
+                                                        if child.get("type") == "point"]
+                else:
+                    ssids = [child.text for child in elem if child.get("type") == "substroke"]
+                    if shapeType == "stroke":
+                        strokeShapes.append((elem.get("id", ""), ssids))
+                    else:
+                        # If it's a shape, then just store the label on the substrokes
+                        for ssid in ssids:
+                            substrokeLabels[ssid] = shapeType
+            if depth == 1:
+                # everything under this top level element has been consumed
+                root.clear()
+        return pointDict, substrokeDict, strokeShapes, substrokeLabels
+
+    def buildStrokes( self, strokeShapes, substrokeDict, pointDict, withFeatures = True ):
+        ''' build the strokes found by scanSketch.  With withFeatures the
+            feature values are computed too, including toSide, which needs
+            all the strokes of the sketch. '''
+        strokes = [self.buildStroke( strokeId, ssids, substrokeDict, pointDict, withFeatures )
+                   for strokeId, ssids in strokeShapes]
+        if withFeatures:
+            self.setToSide(strokes)
+        return strokes
+
+    def setToSide( self, strokes ):
+        ''' set the toSide feature of strokes from the page bounds '''
+        left,right = float('inf'),float('-inf')
+        for stroke in strokes:
+            left,right = min(stroke.minX,left),max(stroke.maxX,right)
+        for stroke in strokes:
+            stroke.featureValues['toSide'] = stroke.toSide(left,right)
 
+    def useNeighborhoodFeatures( self ):
+        ''' Add the NEIGHBORHOOD_FEATURES (as discrete features with 2
+            values) to the features the labeler uses.  Must be called
+            before training. '''
+        for f in NEIGHBORHOOD_FEATURES:
+            if f not in self.featureNames:
+                self.featureNames.append(f)
+                self.contOrDisc[f] = DISCRETE
+                self.numFVals[f] = 2
+        self.codebook = codebookFor(self.featureNames, self.contOrDisc, self.numFVals)
+
+    def needsNeighborhoodFeatures( self, strokes ):
+        ''' True if the labeler uses neighborhood features that strokes
+            do not have yet '''
+        for f in NEIGHBORHOOD_FEATURES:
+            if f in self.featureNames and strokes and f not in strokes[0].featureValues:
+                return True
+        return False
+
+    def setNeighborhoodFeatures( self, strokes ):
+        ''' set the neighborhood features of the strokes of one sketch from
+            a spatial index of their bounding boxes: the distance to the
+            nearest other stroke (-1 if there is none), the number of other
+            strokes whose boxes overlap, and the number of strokes centered
+            nearby (see spatialindex.GridIndex) '''
+        index = spatialindex.GridIndex([strokeBox(s) for s in strokes])
+        for i, stroke in enumerate(strokes):
+            setStrokeNeighborhood(stroke, index, i, 2 * index.cellSize)
+
+    def buildStroke( self, strokeId, substrokeIds, substrokeDict, pointDict, withFeatures = True ):
+        ''' build and return a stroke object from its substroke ids, using
+            the substroke and point maps collected by scanSketch '''
+        ret = self.strokeClass( strokeId )
+        points = []
+        last = None
+        for ssid in substrokeIds:
             # Add the substroke id to the stroke object
-            ret.addSubstroke(ss.firstChild.data)
-            
-            # Find the shape with the id of this substroke
-            ssShape = shapesDict[ss.firstChild.data]
+            ret.addSubstroke(ssid)
 
             # now get all the points associated with this substroke
             # We'll filter points that don't move here
-            for ptObj in ssShape.childNodes:
-                if ptObj.nodeType != xml.dom.Node.ELEMENT_NODE \
-                   or ptObj.getAttribute("type") != "point":
-                    continue
-                pt = pointDict[ptObj.firstChild.data]
-                x = int(pt.getAttribute("x"))
-                y = int(pt.getAttribute("y"))
-                time = int(pt.getAttribute("time"))
+            for ptId in substrokeDict[ssid]:
+                x, y, time = pointDict[ptId]
                 if last == None or last[0] != x or last[1] != y:  # at least x or y is different
                     points.append((x, y, time))
                     last = (x, y, time)
+        if self.simplification is not None and len(points) > 2:
+            method, tolerance = self.simplification
+            before = len(points)
+            points = simplify.METHODS[method](points, tolerance)
+            self.stats.count('pointsBeforeSimplify', before)
+            self.stats.count('pointsAfterSimplify', len(points))
+            log.debug("%s: %d of %d points kept by %s", strokeId, len(points), before, method)
         ret.setPoints(points)
-        ret.featureValues['length'] = ret.length()
-        ret.featureValues['sumOfCurvature'] = ret.sumOfCurvature()
-        ret.featureValues['ratioOfWidthHeight'] = ret.ratioOfWidthHeight()
-        ret.featureValues['timeDuration'] = ret.timeDuration()
+        if withFeatures:
+            ret.computeFeatures()
         return ret
-                
 
     def loadLabeledFile( self, filename ):
         ''' load the strokes and the labels for the strokes from a labeled file.
             return the strokes and the labels as a tuple (strokes, labels) '''
-        sketch = xml.dom.minidom.parse(filename)
-        # get the points
-        points = sketch.getElementsByTagName("point")
-        pointsDict = self.buildDict(points)
-    
-        # now get the strokes by first getting all shapes
-        allShapes = sketch.getElementsByTagName("shape")
-        shapesDict = self.buildDict(allShapes)
-
-        strokes = []
-        substrokeIdDict = {}
-        left,right = float('inf'),float('-inf')
-        for shape in allShapes:
-            if shape.getAttribute("type") == "stroke":
-                stroke = self.buildStroke( shape, shapesDict, pointsDict )
-                left,right = min(stroke.minX,left),max(stroke.maxX,right)
-                strokes.append(stroke)
-                substrokeIdDict[stroke.strokeId] = stroke
-            else:
-                # If it's a shape, then just store the label on the substrokes
-                for child in shape.childNodes:
-                    if child.nodeType != xml.dom.Node.ELEMENT_NODE \
-                       or child.getAttribute("type") != "substroke":
-                        continue
-                    substrokeIdDict[child.firstChild.data] = shape.getAttribute("type")
-        for stroke in strokes:
-            stroke.featureValues['toSide'] = stroke.toSide(left,right)
-
-        # I THINK the strokes will be loaded in order, but make sure
-        if not self.verifyStrokeOrder(strokes):
-            print "WARNING: Strokes out of order"
+        strokes, substrokeLabels = self.parseSketch(filename)
 
         # Now put labels on the strokes
         labels = []
@@ -578,44 +1582,288 @@ class StrokeLabeler:
         for stroke in strokes:
             # Just give the stroke the label of the first substroke in the stroke
             ssid = stroke.substrokeIds[0]
-            if not self.labelDict.has_key(substrokeIdDict[ssid]):
+            if not self.labelDict.has_key(substrokeLabels[ssid]):
                 # If there is no label, flag the stroke for removal
                 noLabels.append(stroke)
             else:
-                labels.append(self.labelDict[substrokeIdDict[ssid]])
+                labels.append(self.labelDict[substrokeLabels[ssid]])
 
         for stroke in noLabels:
             strokes.remove(stroke)
             
-        sketch.unlink()
         if len(strokes) != len(labels):
-            print "PROBLEM: number of strokes and labels must match"
-            print "numStrokes is", len(strokes), "numLabels is", len(labels)
+            log.warning("PROBLEM: number of strokes and labels must match")
+            log.warning("numStrokes is %d numLabels is %d", len(strokes), len(labels))
         return strokes, labels
 
-    def confusion(self,trueLabels, classifications):
-        result = {'drawing':{'drawing':0,'text':0},'text':{'drawing':0,'text':0}}
+    def confusionTable(self, trueLabels, classifications):
+        ''' Return the confusion table result[trueLabel][classification] '''
+        result = dict((l, dict((l2, 0) for l2 in self.labels)) for l in self.labels)
         for i in range(len(trueLabels)):
             result[trueLabels[i]][classifications[i]] += 1    
-        print "confusion table: " + str(result)
-        print "accuracy: " + str(float(result['drawing']['drawing']+result['text']['text'])/(result['drawing']['drawing']+result['text']['text']+result['text']['drawing']+result['drawing']['text']))
         return result
 
-    def validateAll(self):
-        self.classifications = []
-        for oneFilestrokes in self.allStrokes:
-            self.classifications.append(self.labelStrokes(oneFilestrokes))
-        self.confusion(flatten(self.allLabels),flatten(self.classifications))
+    def accuracy(self, result):
+        ''' Return the fraction of a confusion table on the diagonal '''
+        total = sum([sum(row.values()) for row in result.values()])
+        return float(sum([result[l][l] for l in result]))/total if total else 0.0
 
+    def confusion(self,trueLabels, classifications):
+        result = self.confusionTable(trueLabels, classifications)
+        log.info("confusion table: %s", result)
+        log.info("accuracy: %s", self.accuracy(result))
+        return result
 
-class Stroke:
+    def validateAll(self):
+        ''' Label the training sketches with the trained model (from the
+            observations trainHMM already computed), log the confusion
+            table and return it.  This is accuracy on the training data;
+            see crossValidate for held out numbers. '''
+        with self.stats.stage('decode'):
+            self.classifications = self.hmm.label_many(self.allObservations)
+        return self.confusion(list(itertools.chain(*self.allLabels)),list(itertools.chain(*self.classifications)))
+
+    def crossValidate(self, folds = None, workers = 1):
+        ''' Cross-validate over the training files of the last trainHMM.
+            folds = None leaves one file out at a time, otherwise file i is
+            held out in fold i % folds.  Each file's counts are computed
+            once and a fold's model is the total counts minus the fold's
+            counts, so no fold is trained from scratch.  The same goes for
+            the feature thresholds: each discrete feature's histogram of
+            label counts over its values is kept per file, and a fold's
+            thresholds are found on the histogram of its training files,
+            as generateFeatureIntervals would.  The fold's discrete
+            emission counts are read off that histogram and its held out
+            files are featurized with its thresholds, so every fold is a
+            true held out result, the same as retraining on the other
+            files.  Returns (foldTables, pooledTable) confusion tables. '''
+        numFiles = len(self.allObservations)
+        if folds is None:
+            folds = numFiles
+        fileCounts = [self.hmm.countsFor([obs], [labels])
+                      for obs, labels in zip(self.allObservations, self.allLabels)]
+        total = self.hmm.getCounts()
+        histograms = FileHistograms(self, self.allStrokes, self.allLabels)
+        tasks = []
+        for k in range(folds):
+            heldOut = range(k, numFiles, folds)
+            counts = copy.deepcopy(total)
+            for i in heldOut:
+                counts = self.hmm.combineCounts(counts, fileCounts[i], -1)
+            intervals = histograms.setFoldCounts(heldOut, counts)
+            saved = self.featureIntervals
+            self.featureIntervals = dict(saved, **intervals)
+            try:
+                observations = [self.featurefy(self.allStrokes[i]) for i in heldOut]
+            finally:
+                self.featureIntervals = saved
+            tasks.append((self.hmm.states, self.hmm.featureNames, self.hmm.featuresCorD, self.hmm.numVals,
+                          self.hmm.minTransitionCount, counts, observations))
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(labelFold, tasks, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(labelFold, tasks)
+
+        foldTables = []
+        allTrue, allClassified = [], []
+        for k in range(folds):
+            trueLabels = list(itertools.chain(*[self.allLabels[i] for i in range(k, numFiles, folds)]))
+            classifications = list(itertools.chain(*results[k]))
+            foldTables.append(self.confusionTable(trueLabels, classifications))
+            log.info("fold %d accuracy: %s", k, self.accuracy(foldTables[-1]))
+            allTrue.extend(trueLabels)
+            allClassified.extend(classifications)
+        return foldTables, self.confusion(allTrue, allClassified)
+
+
+class FileHistograms:
+    ''' For crossValidate: the label counts over the values of each
+        discrete feature, kept per file so that a fold's histogram is the
+        total minus its held out files' '''
+
+    def __init__(self, labeler, allStrokes, allLabels):
+        self.labeler = labeler
+        self.labels = labeler.labels
+        labelIndex = dict((l, i) for i, l in enumerate(self.labels))
+        self.fileLabelIds = [numpy.array([labelIndex[l] for l in labels], dtype=numpy.intp)
+                             for labels in allLabels]
+        labelIds = numpy.concatenate(self.fileLabelIds) if allLabels else numpy.zeros(0, numpy.intp)
+        ends = numpy.cumsum([len(labels) for labels in allLabels])[:-1]
+        self.features = [f for f in labeler.featureNames if labeler.contOrDisc[f] == DISCRETE]
+        # per feature: the distinct values, each file's strokes' indices
+        # into them, and the total histogram
+        self.distinct = {}
+        self.fileValues = {}
+        self.totals = {}
+        for f in self.features:
+            values = numpy.array([stroke.featureValues[f] for strokes in allStrokes
+                                  for stroke in strokes], dtype=float)
+            self.distinct[f], inverse = numpy.unique(values, return_inverse=True)
+            self.fileValues[f] = numpy.split(inverse, ends)
+            self.totals[f] = self.histogram(f, inverse, labelIds)
+
+    def histogram( self, f, valueIds, labelIds ):
+        counts = numpy.zeros((len(self.distinct[f]), len(self.labels)))
+        numpy.add.at(counts, (valueIds, labelIds), 1)
+        return counts
+
+    def setFoldCounts( self, heldOut, counts ):
+        ''' Find the thresholds of the fold that holds out the files
+            heldOut, set the discrete emission and feature counts of counts
+            (as from HMM.getCounts) to the ones they give, and return the
+            thresholds '''
+        intervals = {}
+        for f in self.features:
+            histogram = self.totals[f].copy()
+            for i in heldOut:
+                histogram -= self.histogram(f, self.fileValues[f][i], self.fileLabelIds[i])
+            # values only the held out files have are not training values
+            present = histogram.sum(axis=1) > 0
+            values, histogram = self.distinct[f][present], histogram[present]
+            numVals = self.labeler.numFVals[f]
+            intervals[f] = self.labeler.findThresholds(values, histogram, numVals)
+            bins = numpy.searchsorted(intervals[f], values, 'left')  # as bisect_left
+            for i, label in enumerate(self.labels):
+                counts['featureCounts'][label][f] = int(histogram[:, i].sum())
+                counts['emissionCounts'][label][f] = [int(c) for c in numpy.bincount(
+                    bins, weights=histogram[:, i], minlength=numVals)]
+        return intervals
+
+
+# The labeler used by the processes of trainHMM's loading pool
+workerLabeler = None
+
+def initLoaderWorker( labelDict, cache, featureNames, simplification ):
+    ''' Set up a loading pool process with the parent labeler's settings '''
+    global workerLabeler
+    workerLabeler = StrokeLabeler()
+    workerLabeler.labelDict = labelDict
+    workerLabeler.cache = cache
+    workerLabeler.featureNames = featureNames
+    workerLabeler.simplification = simplification
+
+def loadLabeledFileData( filename ):
+    ''' Load a labeled file in a pool process.  The strokes are sent back
+        as plain data, which is cheaper to pickle than Stroke objects. '''
+    strokes, labels = workerLabeler.loadLabeledFile( filename )
+    return [stroke.toData() for stroke in strokes], labels
+
+
+def labelFold( task ):
+    ''' Build one cross-validation fold's HMM from its counts and label
+        the held out observations (run in a pool process by crossValidate) '''
+    states, featureNames, featuresCorD, numVals, minTransitionCount, counts, observations = task
+    hmm = HMM(states, featureNames, featuresCorD, numVals, minTransitionCount)
+    hmm.setCounts(counts)
+    return hmm.label_many(observations)
+
+
+def strokeBox( stroke ):
+    return (stroke.minX, stroke.minY, stroke.maxX, stroke.maxY)
+
+def setStrokeNeighborhood( stroke, index, i, radius ):
+    ''' Set the neighborhood features of stroke, box i of a GridIndex (see
+        StrokeLabeler.setNeighborhoodFeatures) '''
+    nearest = index.nearestDistance(i)
+    stroke.featureValues['nearestStroke'] = nearest if nearest != float('inf') else -1.0
+    stroke.featureValues['overlaps'] = index.overlapCount(i)
+    stroke.featureValues['localDensity'] = index.density(i, radius)
+
+
+class StreamingLabeler:
+    ''' Labels strokes one at a time as they are drawn, using fixed-lag
+        Viterbi on a trained StrokeLabeler.  A stroke's label is committed
+        once lag more strokes have arrived; the strokes after that only
+        have provisional labels.  Each stroke costs O(states^2) plus a
+        backtrack over at most lag steps.
+        The page bounds used by toSide grow as strokes arrive, so each
+        stroke's toSide is measured against the strokes seen so far.  In
+        the same way, if the labeler uses neighborhood features, each
+        stroke's are those setNeighborhoodFeatures would give it in a
+        sketch of the strokes seen so far; a GridIndex of their boxes is
+        kept and added to. '''
+
+    def __init__(self, labeler, lag = 3):
+        self.labeler = labeler
+        self.hmm = labeler.hmm
+        self.hmm.compileLogTables()
+        self.lag = lag
+        self.labels = []            # committed labels, one per stroke
+        self.numStrokes = 0
+        self.left, self.right = float('inf'), float('-inf')
+        self.neighborhood = [f for f in NEIGHBORHOOD_FEATURES if f in labeler.featureNames]
+        self.index = None
+        self.boxes = []
+        self.delta = None
+        # back pointers for the steps after the last committed stroke
+        self.backPointers = collections.deque()
+
+    def addStroke( self, stroke ):
+        ''' Add the next stroke.  Returns (committed, provisional) where
+            committed are the labels that became final with this stroke and
+            provisional are the current best labels for the rest. '''
+        if 'length' not in stroke.featureValues:
+            stroke.computeFeatures()
+        self.left, self.right = min(stroke.minX, self.left), max(stroke.maxX, self.right)
+        stroke.featureValues['toSide'] = stroke.toSide(self.left, self.right)
+        if self.neighborhood:
+            self.addToIndex(stroke)
+        observation = self.labeler.featurefy([stroke])[0]
+        logEmission = self.hmm.logEmissionMatrix([observation])[0]
+        self.delta, backPointer = self.hmm.viterbiStep(self.delta, logEmission)
+        self.numStrokes += 1
+        if backPointer is not None and self.numStrokes - len(self.labels) > 1:
+            self.backPointers.append(backPointer)
+        return self.commit(self.numStrokes - len(self.labels) - self.lag)
+
+    def addToIndex( self, stroke ):
+        ''' Set the neighborhood features of the newest stroke against the
+            strokes seen so far '''
+        box = strokeBox(stroke)
+        self.boxes.append(box)
+        cellSize = spatialindex.defaultCellSize(self.boxes)
+        if self.index is None or not self.index.cellSize / 2 <= cellSize <= self.index.cellSize * 2:
+            # the strokes have grown or shrunk: the cells are rebuilt to
+            # keep queries fast (the answers do not depend on them)
+            self.index = spatialindex.GridIndex(self.boxes, cellSize)
+            i = len(self.boxes) - 1
+        else:
+            i = self.index.add(box)
+        setStrokeNeighborhood(stroke, self.index, i, 2 * cellSize)
+
+    def finish( self ):
+        ''' Commit the labels of all remaining strokes and return them '''
+        return self.commit(self.numStrokes - len(self.labels))[0]
+
+    def commit( self, count ):
+        ''' Commit the first count uncommitted strokes on the current best
+            path.  Returns (committed, provisional) labels. '''
+        if self.delta is None:
+            return [], []
+        finalOrder = self.hmm.finalOrder
+        path = [finalOrder[self.delta[finalOrder].argmax()]]
+        for backPointer in reversed(self.backPointers):
+            path.append(backPointer[path[-1]])
+        path.reverse()
+        committed = [self.hmm.stateOrder[k] for k in path[:max(count, 0)]]
+        self.labels.extend(committed)
+        # Only the steps between uncommitted strokes need back pointers
+        while len(self.backPointers) > max(self.numStrokes - len(self.labels) - 1, 0):
+            self.backPointers.popleft()
+        return committed, [self.hmm.stateOrder[k] for k in path[len(committed):]]
+
+
+class BaseStroke(object):
     ''' A class to represent a stroke (series of xyt points).
-        This class also has various functions for computing stroke features. '''
-    def __init__(self, strokeId):
-        self.strokeId = strokeId
-        self.substrokeIds = []   # Keep around the substroke ids for writing back to file
-        self.featureValues = {}
-        
+        This class also has various functions for computing stroke features.
+        Stroke and CompactStroke differ only in how they store their data. '''
+    __slots__ = ()
+
     def __repr__(self):
         ''' Return a string representation of the stroke '''
         return "[Stroke " + self.strokeId + "]"
@@ -624,9 +1872,30 @@ class Stroke:
         ''' Add a substroke Id to the stroke '''
         self.substrokeIds.append(substrokeId)
 
-    def setPoints( self, points ):
-        ''' Set the points for the stroke '''
-        self.points = points
+    def toData( self ):
+        ''' Return the stroke as plain data (for caching) '''
+        return (self.strokeId, list(self.substrokeIds), self.points, self.featureValues,
+                (self.minX, self.minY, self.maxX, self.maxY))
+
+    def fromData( cls, data ):
+        ''' Rebuild a stroke from the result of toData '''
+        strokeId, substrokeIds, points, featureValues, bounds = data
+        ret = cls(strokeId)
+        for ssid in substrokeIds:
+            ret.addSubstroke(ssid)
+        ret.setPoints(points)
+        ret.featureValues = featureValues
+        ret.minX, ret.minY, ret.maxX, ret.maxY = bounds
+        return ret
+    fromData = classmethod(fromData)
+
+    def computeFeatures( self ):
+        ''' Fill in featureValues for the features that only depend on this
+            stroke.  toSide needs the page bounds, so it is set by the loader. '''
+        self.featureValues['length'] = self.length()
+        self.featureValues['sumOfCurvature'] = self.sumOfCurvature()
+        self.featureValues['ratioOfWidthHeight'] = self.ratioOfWidthHeight()
+        self.featureValues['timeDuration'] = self.timeDuration()
 
 
     # Feature functions follow this line
@@ -653,6 +1922,12 @@ class Stroke:
     def toSide(self,left,right):
         return min(right-self.maxX,self.minX-left)
 
+    def startTime(self):
+        return self.points[0][2]
+
+    def endTime(self):
+        return self.points[-1][2]
+
     def timeDuration(self):
         minT,maxT = float('inf'),float('-inf')
         for p in self.points:
@@ -666,12 +1941,13 @@ class Stroke:
                 you could pass in abs
             skip is a smoothing constant (how many points to skip)
         '''
-        if len(self.points) < 2*skip+1:
+        points = self.points
+        if len(points) < 2*skip+1:
             return 0
         ret = 0
-        second = self.points[0]
-        third = self.points[1*skip]
-        for p in self.points[2*skip::skip]:
+        second = points[0]
+        third = points[1*skip]
+        for p in points[2*skip::skip]:
             
             first = second
             second = third
@@ -705,8 +1981,109 @@ class Stroke:
                 curv *= -1
             ret += func(curv)
 
-        return ret / len(self.points)
+        return ret / len(points)
 
     # You can (and should) define more features here
 
 
+class Stroke(BaseStroke):
+    ''' A stroke with its points in a list of (x, y, time) tuples '''
+    def __init__(self, strokeId):
+        self.strokeId = strokeId
+        self.substrokeIds = []   # Keep around the substroke ids for writing back to file
+        self.featureValues = {}
+
+    def setPoints( self, points ):
+        ''' Set the points for the stroke '''
+        self.points = points
+
+
+def localName( tag ):
+    ''' A tag without its namespace, whether ElementTree ("{uri}shape") or
+        expat ("sk:shape") gave it '''
+    if tag[0] == '{':
+        return tag[tag.index('}') + 1:]
+    return tag[tag.find(':') + 1:]
+
+def copyBytes( source, dest, count = None, blockSize = 1 << 16 ):
+    ''' Copy count bytes (or the rest) from one open file to another '''
+    while count is None or count > 0:
+        block = source.read(blockSize if count is None else min(count, blockSize))
+        if not block:
+            break
+        dest.write(block)
+        if count is not None:
+            count -= len(block)
+
+def internId( strokeId ):
+    ''' Return the shared copy of an id string.  Stroke and substroke ids
+        are long strings that repeat between strokes, caches and output
+        files.  Python's intern table does not keep its strings alive, so
+        the ids of strokes that are gone are dropped from it too. '''
+    if type(strokeId) is str:
+        return intern(strokeId)
+    return strokeId
+
+class CompactStroke(BaseStroke):
+    ''' A stroke that keeps its coordinates and times in typed arrays and
+        has no instance dictionary, for holding large corpora in memory.
+        Points must be integers.  points still reads as a list of
+        (x, y, time) tuples, but it is built on every access, so code that
+        uses it more than once should read it into a local first.
+        Times are kept as doubles, which hold epoch milliseconds exactly
+        on every platform (a C long is only 32 bits on Windows). '''
+    __slots__ = ('strokeId', 'substrokeIds', 'featureValues', 'xs', 'ys', 'times',
+                 'minX', 'minY', 'maxX', 'maxY')
+
+    def __init__(self, strokeId):
+        self.strokeId = internId(strokeId)
+        self.substrokeIds = []
+        self.featureValues = {}
+        self.setPoints([])
+
+    def addSubstroke( self, substrokeId ):
+        ''' Add a substroke Id to the stroke '''
+        self.substrokeIds.append(internId(substrokeId))
+
+    def setPoints( self, points ):
+        ''' Set the points for the stroke '''
+        self.xs = array.array('i', [p[0] for p in points])
+        self.ys = array.array('i', [p[1] for p in points])
+        self.times = array.array('d', [p[2] for p in points])
+
+    def getPoints( self ):
+        ''' Return the points as a list of (x, y, time) tuples '''
+        return zip(self.xs, self.ys, [int(t) for t in self.times])
+
+    points = property(getPoints, setPoints)
+
+    # The features below give the same values as the BaseStroke versions,
+    # but read the arrays instead of building the point list
+    def length( self ):
+        ''' Returns the length of the stroke '''
+        ret = 0
+        xs, ys = self.xs, self.ys
+        for i in range(1, len(xs)):
+            xdiff = xs[i] - xs[i-1]
+            ydiff = ys[i] - ys[i-1]
+            ret += math.sqrt(xdiff**2 + ydiff**2)
+        return ret
+
+    def ratioOfWidthHeight(self):
+        '''this is the ratio of stroke boundary's width to height'''
+        self.minX,self.minY = float(min(self.xs)),float(min(self.ys))
+        self.maxX,self.maxY = float(max(self.xs)),float(max(self.ys))
+        bWidth,bHeight = self.maxX-self.minX,self.maxY-self.minY
+        return 0 if bWidth*bHeight == 0 else min(bWidth/bHeight,bHeight/bWidth)
+
+    def timeDuration(self):
+        return float(max(self.times))-float(min(self.times))
+
+    def startTime(self):
+        return int(self.times[0])
+
+    def endTime(self):
+        return int(self.times[-1])
+
+
+
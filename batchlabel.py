@@ -0,0 +1,171 @@
+''' Label every sketch file in a directory with a saved model.
+
+        python batchlabel.py model.skhmm inputDir outputDir --workers 8
+
+    Each file in inputDir is labeled and written under the same name in
+    outputDir.  Files are handed to a pool of processes largest first, so
+    one big file does not finish alone at the end of the run.  Every
+    worker loads (memory maps) the model file once when it starts, and
+    the tasks themselves are just file names.  Outputs that are newer than
+    both their input and the model are skipped unless --force is given.
+'''
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import StrokeHmm
+
+log = StrokeHmm.log
+
+
+def findWork( modelFile, inputDir, outputDir, force = False ):
+    ''' Return (todo, skipped): todo is a list of (inputPath, outputPath,
+        size) sorted largest first, skipped the number of files whose
+        output is already up to date '''
+    modelTime = os.path.getmtime(modelFile)
+    todo = []
+    skipped = 0
+    for name in sorted(os.listdir(inputDir)):
+        inPath = os.path.join(inputDir, name)
+        if name.startswith('.') or not os.path.isfile(inPath):
+            continue
+        outPath = os.path.join(outputDir, name)
+        st = os.stat(inPath)
+        if not force and os.path.exists(outPath) and \
+               os.path.getmtime(outPath) >= max(st.st_mtime, modelTime):
+            skipped += 1
+            continue
+        todo.append((inPath, outPath, st.st_size))
+    todo.sort(key = lambda item: -item[2])
+    return todo, skipped
+
+
+# The labeler of a batch pool process, loaded once by initBatchWorker, or
+# the error that stopped it from loading
+batchLabeler = None
+batchError = None
+
+def initBatchWorker( modelFile, compact, deterministicIds, level ):
+    ''' Load the model in a batch pool process (or in this process).  An
+        exception here would make the pool start new processes forever,
+        so in a pool process it is kept and reported by labelOne. '''
+    global batchLabeler, batchError
+    StrokeHmm.setVerbosity(level)
+    batchLabeler = None
+    try:
+        loadBatchLabeler(modelFile, compact, deterministicIds)
+    except Exception, e:
+        batchError = "%s: %s" % (e.__class__.__name__, e)
+
+def loadBatchLabeler( modelFile, compact, deterministicIds ):
+    global batchLabeler
+    labeler = StrokeHmm.StrokeLabeler(compact)
+    labeler.load_model(modelFile)
+    labeler.deterministicIds = deterministicIds
+    batchLabeler = labeler
+
+def labelOne( task ):
+    ''' Label one file.  The output is written to a temporary file and
+        renamed into place, so an interrupted run never leaves a partial
+        output that looks up to date.  Returns (inputPath, strokes,
+        seconds, error). '''
+    inPath, outPath, size = task
+    if batchLabeler is None:
+        return inPath, 0, 0.0, "model not loaded: %s" % batchError
+    start = time.time()
+    tmpPath = "%s.%d.tmp" % (outPath, os.getpid())
+    try:
+        labels = batchLabeler.labelFile(inPath, tmpPath)
+        os.rename(tmpPath, outPath)
+    except Exception, e:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        return inPath, 0, time.time() - start, "%s: %s" % (e.__class__.__name__, e)
+    return inPath, len(labels), time.time() - start, None
+
+
+def labelDirectory( modelFile, inputDir, outputDir, workers = None, force = False,
+                    compact = False, deterministicIds = False ):
+    ''' Label the files of inputDir into outputDir with workers processes
+        (all CPUs by default) and return a report dictionary with the
+        counts and throughput.  outputDir must not be inputDir, which would
+        overwrite the inputs. '''
+    if os.path.realpath(inputDir) == os.path.realpath(outputDir):
+        raise ValueError("the output directory must not be the input directory")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # load the model here first, so a bad model file fails the run before
+    # any pool process starts
+    loadBatchLabeler(modelFile, compact, deterministicIds)
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    todo, skipped = findWork(modelFile, inputDir, outputDir, force)
+    log.info("%d files to label, %d up to date", len(todo), skipped)
+
+    start = time.time()
+    strokes = 0
+    failed = []
+    done = 0
+    if workers > 1 and len(todo) > 1:
+        # pool processes only print problems; progress is reported here
+        pool = multiprocessing.Pool(min(workers, len(todo)), initBatchWorker,
+                                    (modelFile, compact, deterministicIds, logging.WARNING))
+        results = pool.imap_unordered(labelOne, todo, 1)
+    else:
+        pool = None
+        results = itertools.imap(labelOne, todo)
+    try:
+        for inPath, n, seconds, error in results:
+            done += 1
+            if error:
+                log.error("Failed to label %s: %s", inPath, error)
+                failed.append(inPath)
+            else:
+                strokes += n
+                log.info("[%d/%d] %s: %d strokes in %.2fs", done, len(todo), inPath, n, seconds)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    seconds = time.time() - start
+
+    labeled = len(todo) - len(failed)
+    failedSet = set(failed)
+    inputBytes = sum([size for inPath, outPath, size in todo if inPath not in failedSet])
+    report = {'labeled': labeled, 'skipped': skipped, 'failed': failed, 'strokes': strokes,
+              'bytes': inputBytes, 'seconds': seconds, 'workers': workers,
+              'filesPerSecond': labeled / seconds if seconds > 0 else None,
+              'strokesPerSecond': strokes / seconds if seconds > 0 else None}
+    log.info("Labeled %d files (%d strokes, %.1f MB) in %.2fs: %.1f files/s, %.0f strokes/s; "
+             "%d skipped, %d failed", labeled, strokes, inputBytes / 1e6, seconds,
+             report['filesPerSecond'] or 0, report['strokesPerSecond'] or 0, skipped, len(failed))
+    return report
+
+
+def main( argv = None ):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('model', help = 'model file written by StrokeLabeler.save_model')
+    parser.add_argument('inputDir', help = 'directory of sketch files to label')
+    parser.add_argument('outputDir', help = 'directory for the labeled files')
+    parser.add_argument('--workers', type = int, default = None,
+                        help = 'number of processes (default: one per CPU)')
+    parser.add_argument('--force', action = 'store_true', help = 'relabel files that are up to date')
+    parser.add_argument('--compact', action = 'store_true', help = 'use compact strokes to save memory')
+    parser.add_argument('--deterministic-ids', action = 'store_true',
+                        help = 'derive shape ids from stroke ids so reruns give identical output')
+    args = parser.parse_args(argv)
+    try:
+        report = labelDirectory(args.model, args.inputDir, args.outputDir, args.workers,
+                                args.force, args.compact, args.deterministic_ids)
+    except (EnvironmentError, ValueError), e:
+        parser.error(str(e))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = '%(message)s', stream = sys.stdout)
+    sys.exit(main())
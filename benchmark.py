@@ -0,0 +1,231 @@
+''' End-to-end benchmark of the stroke labeling pipeline on synthetic data.
+
+    Generates a deterministic corpus of labeled sketch files in the format
+    StrokeLabeler.loadLabeledFile reads, then times each stage of the
+    pipeline and prints a JSON report, e.g.
+
+        python benchmark.py --files 50 --strokes 80 --points 60 --output bench.json
+
+    It also times how long a fresh interpreter takes to start and import
+    the labeler modules, which is most of the life of a short batch worker.
+'''
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+import StrokeHmm
+
+# File labels the generator draws from: the drawing labels get long,
+# fairly straight strokes and 'Label' (text) gets short, wiggly ones
+DRAWING_LABELS = ['Wire', 'Wire', 'AND', 'OR', 'XOR', 'NAND', 'NOT']
+TEXT_LABEL = 'Label'
+
+
+def makeId( rand ):
+    ''' A random id in the same 8-4-4-4-12 hex layout as guid.generate '''
+    h = '%032x' % rand.getrandbits(128)
+    return '-'.join([h[0:8], h[8:12], h[12:16], h[16:20], h[20:32]])
+
+
+def generateSketch( filename, seed, numStrokes, pointsPerStroke ):
+    ''' Write one labeled sketch file.  The same arguments always give the
+        same file. '''
+    rand = random.Random(seed)
+    points = []
+    shapes = []
+    t = 1000000 + rand.randrange(100000)
+    for i in range(numStrokes):
+        label = TEXT_LABEL if rand.random() < 0.3 else rand.choice(DRAWING_LABELS)
+        x, y = rand.randrange(50, 2000), rand.randrange(50, 1500)
+        angle = rand.uniform(0, 6.2832)
+        pointIds = []
+        for j in range(pointsPerStroke):
+            if label == TEXT_LABEL:
+                x += rand.randrange(-6, 9)
+                y += rand.randrange(-6, 7)
+            else:
+                x += int(round(8 * numpy.cos(angle))) + rand.randrange(-1, 2)
+                y += int(round(8 * numpy.sin(angle))) + rand.randrange(-1, 2)
+                angle += rand.uniform(-0.05, 0.05)
+            t += rand.randrange(5, 15)
+            pointId = makeId(rand)
+            pointIds.append(pointId)
+            points.append('<point id="%s" name="p" x="%d" y="%d" time="%d"/>' % (pointId, x, y, t))
+        substrokeId, strokeId, shapeId = makeId(rand), makeId(rand), makeId(rand)
+        shapes.append('<shape id="%s" name="substroke" type="substroke" time="%d">%s</shape>'
+                      % (substrokeId, t, ''.join(['<arg type="point">%s</arg>' % p for p in pointIds])))
+        shapes.append('<shape id="%s" name="stroke" type="stroke" time="%d"><arg type="substroke">%s</arg></shape>'
+                      % (strokeId, t, substrokeId))
+        shapes.append('<shape id="%s" name="shape" type="%s" time="%d"><arg type="substroke">%s</arg></shape>'
+                      % (shapeId, label, t, substrokeId))
+        t += rand.randrange(200, 2000)
+    f = open(filename, 'w')
+    try:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<sketch id="%s" units="pixel">\n' % makeId(rand))
+        f.write('\n'.join(points + shapes))
+        f.write('\n</sketch>\n')
+    finally:
+        f.close()
+
+
+def generateCorpus( directory, numFiles, numStrokes, pointsPerStroke, seed = 0 ):
+    ''' Write numFiles sketches into directory and return their paths '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = []
+    for i in range(numFiles):
+        filename = os.path.join(directory, 'sketch%04d.labeled.xml' % i)
+        generateSketch(filename, seed * 1000003 + i, numStrokes, pointsPerStroke)
+        files.append(filename)
+    return files
+
+
+def timeStage( report, name, items, func ):
+    ''' Run func, record its time and throughput under name, and return
+        its result '''
+    start = time.time()
+    result = func()
+    seconds = time.time() - start
+    report['stages'][name] = {'seconds': seconds, 'items': items,
+                              'itemsPerSecond': items / seconds if seconds > 0 else None}
+    return result
+
+
+def runPipeline( files, workDir ):
+    ''' Time every stage of the pipeline once on files and return the
+        report dictionary '''
+    sl = StrokeHmm.StrokeLabeler()
+    report = {'stages': {}}
+    scans = timeStage(report, 'parse', len(files),
+                      lambda: [sl.scanSketch(f) for f in files])
+    numStrokes = sum([len(scan[2]) for scan in scans])
+    report['strokes'] = numStrokes
+    allStrokes = timeStage(report, 'buildStroke', numStrokes,
+                           lambda: [sl.buildStrokes(scan[2], scan[1], scan[0], False) for scan in scans])
+
+    def features():
+        for strokes in allStrokes:
+            for stroke in strokes:
+                stroke.computeFeatures()
+            sl.setToSide(strokes)
+    timeStage(report, 'features', numStrokes, features)
+
+    # labels the same way loadLabeledFile does
+    allLabels = []
+    for strokes, scan in zip(allStrokes, scans):
+        substrokeLabels = scan[3]
+        keep = [s for s in strokes if substrokeLabels[s.substrokeIds[0]] in sl.labelDict]
+        strokes[:] = keep
+        allLabels.append([sl.labelDict[substrokeLabels[s.substrokeIds[0]]] for s in keep])
+
+    timeStage(report, 'generateFeatureIntervals', numStrokes,
+              lambda: sl.generateFeatureIntervals(allStrokes, allLabels))
+    observations = timeStage(report, 'featurefy', numStrokes,
+                             lambda: [sl.featurefy(strokes) for strokes in allStrokes])
+
+    def train():
+        sl.hmm = StrokeHmm.HMM(sl.labels, sl.featureNames, sl.contOrDisc, sl.numFVals)
+        sl.hmm.train(observations, allLabels)
+    timeStage(report, 'train', numStrokes, train)
+    timeStage(report, 'label', numStrokes,
+              lambda: [sl.hmm.label(obs) for obs in observations])
+    classifications = timeStage(report, 'label_many', numStrokes,
+                                lambda: sl.hmm.label_many(observations))
+
+    outDir = os.path.join(workDir, 'out')
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    def save():
+        for f, strokes, labels in zip(files, allStrokes, classifications):
+            sl.saveFile(strokes, labels, f, os.path.join(outDir, os.path.basename(f)))
+    timeStage(report, 'saveFile', len(files), save)
+    return report
+
+
+# Modules whose import time is measured, each in a fresh interpreter
+STARTUP_MODULES = ['guid', 'StrokeHmm']
+
+
+def timeStartup( runs ):
+    ''' Return the fastest of runs wall-clock times for starting a fresh
+        interpreter, alone and then importing each of STARTUP_MODULES.
+        importSeconds is the time beyond the bare interpreter start. '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    def fastest( code ):
+        times = []
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code], cwd = here)
+            times.append(time.time() - start)
+        return min(times)
+    interpreter = fastest('pass')
+    modules = {}
+    for name in STARTUP_MODULES:
+        seconds = fastest('import ' + name)
+        modules[name] = {'seconds': seconds, 'importSeconds': max(seconds - interpreter, 0.0)}
+    return {'runs': runs, 'interpreterSeconds': interpreter, 'modules': modules}
+
+
+def main( argv = None ):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('--files', type = int, default = 20, help = 'number of sketch files')
+    parser.add_argument('--strokes', type = int, default = 50, help = 'strokes per file')
+    parser.add_argument('--points', type = int, default = 40, help = 'points per stroke')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed for the generator')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'run the pipeline this many times and keep the fastest of each stage')
+    parser.add_argument('--startup-runs', type = int, default = 5,
+                        help = 'time interpreter start and module import this many times (0 to skip)')
+    parser.add_argument('--keep', metavar = 'DIR', help = 'generate the corpus in DIR and keep it')
+    parser.add_argument('--output', help = 'write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+    # keep the pipeline's progress messages out of the timings and report
+    StrokeHmm.setVerbosity(logging.WARNING)
+
+    startup = timeStartup(args.startup_runs) if args.startup_runs > 0 else None
+
+    workDir = args.keep or tempfile.mkdtemp(prefix = 'sketchbench')
+    try:
+        start = time.time()
+        files = generateCorpus(os.path.join(workDir, 'corpus'), args.files, args.strokes,
+                               args.points, args.seed)
+        report = {'config': {'files': args.files, 'strokesPerFile': args.strokes,
+                             'pointsPerStroke': args.points, 'seed': args.seed,
+                             'repeat': args.repeat, 'startupRuns': args.startup_runs},
+                  'environment': {'python': sys.version.split()[0], 'numpy': numpy.__version__,
+                                  'platform': sys.platform},
+                  'generateSeconds': time.time() - start,
+                  'corpusBytes': sum([os.path.getsize(f) for f in files])}
+        runs = [runPipeline(files, workDir) for i in range(max(args.repeat, 1))]
+        report['startup'] = startup
+        report['strokes'] = runs[0]['strokes']
+        report['stages'] = {}
+        for name in runs[0]['stages']:
+            report['stages'][name] = min([run['stages'][name] for run in runs],
+                                         key = lambda stage: stage['seconds'])
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, True)
+
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(text + '\n')
+        f.close()
+    else:
+        print text
+
+
+if __name__ == '__main__':
+    # stdout is for the report, so log messages go to stderr
+    logging.basicConfig(format = '%(message)s')
+    main()
@@ -72,7 +72,11 @@
 #                    for IP when we make it up (when it's no accessible)
 # November 21, 2005  Added better IP-finding code.  It finds IP address better now.
 # January 5, 2006    Fixed a small bug caused in old versions of python (random module use)
+# October 17, 2026   Added generate_batch, which reserves a block of counters with one
+#                    lock acquisition, and derive, which makes reproducible guids from
+#                    other ids.  The IP is now looked up on first use instead of on import.
 
+import hashlib
 import math
 import socket
 import random
@@ -93,16 +97,31 @@ counter = 0L
 firstcounter = MAX_COUNTER
 lasttime = 0
 ip = ''
+hexip = ''
 lock = threading.RLock()
-try:  # only need to get the IP addresss once
-  ip = socket.getaddrinfo(socket.gethostname(),0)[-1][-1][0]
-  hexip = make_hexip(ip)
-except: # if we don't have an ip, default to someting in the 10.x.x.x private range
-  ip = '10'
-  rand = random.Random()
-  for i in range(3):
-    ip += '.' + str(rand.randrange(1, 0xffff))  # might as well use IPv6 range if we're making it up
-  hexip = make_hexip(ip)
+
+
+def get_hexip():
+  '''Returns the IP part of the guids made on this machine.  The IP is only looked
+     up the first time this is called (normally by the first generate), not when
+     the module is imported, since name resolution can be slow or even hang.
+  '''
+  global ip, hexip
+  lock.acquire()
+  try:
+    if not hexip:
+      try:  # only need to get the IP addresss once
+        ip = socket.getaddrinfo(socket.gethostname(),0)[-1][-1][0]
+        hexip = make_hexip(ip)
+      except: # if we don't have an ip, default to someting in the 10.x.x.x private range
+        ip = '10'
+        rand = random.Random()
+        for i in range(3):
+          ip += '.' + str(rand.randrange(1, 0xffff))  # might as well use IPv6 range if we're making it up
+        hexip = make_hexip(ip)
+    return hexip
+  finally:
+    lock.release()
 
   
 #################################
@@ -139,7 +158,7 @@ def generate(ip=None):
     parts.append("%08x" % (counter)) 
 
     # ip part
-    parts.append(hexip)
+    parts.append(get_hexip())
 
     partsStr = ''.join(parts)
     partsStr = partsStr[0:8] + '-' + partsStr[8:12] + '-' + partsStr[12:16] + \
@@ -148,7 +167,62 @@ def generate(ip=None):
     return partsStr
   finally:
     lock.release()
-    
+
+
+def generate_batch(n, ip=None):
+  '''Generates a list of n new guids.  The lock is taken once for the whole batch
+     rather than once per guid: a block of n counters is reserved in the current
+     millisecond, so the guids share the time part and have consecutive counters.
+     They are exactly what n calls of generate would give if nothing else were
+     generating guids at the same time.
+  '''
+  global counter, firstcounter, lasttime
+  if n <= 0:
+    return []
+  if n > MAX_COUNTER:  # more than one millisecond can hold
+    return generate_batch(MAX_COUNTER, ip) + generate_batch(n - MAX_COUNTER, ip)
+  lock.acquire()
+  try:
+    now = long(time.time() * 1000)
+    if lasttime != now:
+      firstcounter = long(random.uniform(1, MAX_COUNTER))
+      counter = firstcounter
+    # wait for the next millisecond if there are not n counters left in this one
+    while (counter - firstcounter) % (MAX_COUNTER + 1) + n > MAX_COUNTER:
+      time.sleep(.01)
+      now = long(time.time() * 1000)
+      if lasttime != now:
+        firstcounter = long(random.uniform(1, MAX_COUNTER))
+        counter = firstcounter
+    first = counter + 1
+    counter = (counter + n) % (MAX_COUNTER + 1)
+    lasttime = now
+  finally:
+    lock.release()
+
+  # the layout is the same as generate's: time (16 hex digits, split 8-4-4),
+  # counter (8 hex digits, split 4-4) and the start of the ip
+  timeStr = "%016x" % now
+  prefix = timeStr[0:8] + '-' + timeStr[8:12] + '-' + timeStr[12:16] + '-'
+  suffix = get_hexip()[0:8]
+  guids = []
+  for c in xrange(first, first + n):
+    c %= MAX_COUNTER + 1
+    guids.append("%s%04x-%04x%s" % (prefix, c >> 16, c & 0xffff, suffix))
+  return guids
+
+
+def derive(*names):
+  '''Derives a guid from one or more names (for example another guid) instead of
+     the time and counter.  The same names always give the same guid, so output
+     that uses derived guids is reproducible from run to run.  Different names
+     give different guids with the same (tiny) chance of collision as sha1.
+     Unicode names are hashed as utf-8, so u'abc' and 'abc' give the same guid.
+  '''
+  parts = [name.encode('utf-8') if isinstance(name, unicode) else str(name) for name in names]
+  h = hashlib.sha1('\0'.join(parts)).hexdigest()
+  return h[0:8] + '-' + h[8:12] + '-' + h[12:16] + '-' + h[16:20] + '-' + h[20:32]
+
 
 """  These functions no longer work since I added dashes into the guid
 def extract_time(guid):
@@ -0,0 +1,360 @@
+''' A long-running labeling service that keeps a trained model in memory.
+
+        python labelserver.py model.skhmm --port 8765
+
+    It serves HTTP on the loopback interface (there is no authentication,
+    so only bind it elsewhere on a trusted network):
+
+      POST /label    a sketch XML document, or JSON of the form
+                     {"strokes": [[[x, y, time], ...], ...]}
+                     Answers {"strokeIds": [...], "labels": [...]}.
+      GET  /stats    request, batch and rejection counters as JSON.
+
+    Parsing and feature extraction happen in the request threads.  The
+    decodes are done by one batching thread: requests that arrive within
+    --window-ms of each other are labeled together with one
+    HMM.label_many call.  Requests beyond --max-inflight, or that find the
+    decode queue full, are turned away at once with 503 and Retry-After
+    rather than queued without bound.  Connections beyond
+    --max-connections are answered 503 without starting a thread, and a
+    request body is only read once the request has an in-flight slot, so
+    threads and buffered bodies are both bounded.
+'''
+import argparse
+import BaseHTTPServer
+import Queue
+import SocketServer
+import cStringIO
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+
+import StrokeHmm
+
+log = StrokeHmm.log
+
+
+class Overloaded(Exception):
+    ''' Raised when a request is turned away by admission control '''
+    pass
+
+
+class Job:
+    ''' One request's observations waiting for a decode '''
+    def __init__( self, observations ):
+        self.observations = observations
+        self.labels = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    ''' Collects the observation sequences of concurrent requests and
+        labels them in batches on one thread.  A batch is started by the
+        first waiting job and closed after window seconds or maxBatch
+        jobs, whichever comes first.  At most maxQueue jobs wait. '''
+
+    def __init__( self, hmm, window = 0.005, maxBatch = 64, maxQueue = 256 ):
+        self.hmm = hmm
+        self.window = window
+        self.maxBatch = maxBatch
+        self.queue = Queue.Queue(maxQueue)
+        self.stopping = threading.Event()
+        self.counters = {'jobs': 0, 'batches': 0, 'largestBatch': 0, 'decodeSeconds': 0.0}
+        self.thread = None
+
+    def start( self ):
+        self.thread = threading.Thread(target = self.run, name = 'MicroBatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop( self ):
+        ''' Finish the batch being decoded and fail the jobs still queued '''
+        self.stopping.set()
+        try:
+            # wake the thread if it is waiting; a full queue wakes it anyway
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        self.thread.join()
+
+    def submit( self, observations, timeout ):
+        ''' Label one sequence of observations and return its labels.
+            Raises Overloaded if the queue is full and RuntimeError if no
+            answer comes within timeout seconds. '''
+        job = Job(observations)
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            raise Overloaded("decode queue is full")
+        if not job.done.wait(timeout):
+            job.cancelled = True
+            raise RuntimeError("no answer within %g seconds" % timeout)
+        if job.error is not None:
+            raise job.error
+        return job.labels
+
+    def run( self ):
+        while not self.stopping.is_set():
+            job = self.queue.get()
+            if job is None:
+                continue
+            batch = [job]
+            deadline = time.time() + self.window
+            while len(batch) < self.maxBatch and not self.stopping.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self.queue.get(True, remaining)
+                except Queue.Empty:
+                    break
+                if job is None:
+                    break
+                batch.append(job)
+            self.decode([job for job in batch if not job.cancelled])
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if job is not None:
+                job.error = RuntimeError("the labeling service is stopping")
+                job.done.set()
+
+    def decode( self, batch ):
+        if not batch:
+            return
+        start = time.time()
+        try:
+            results = self.hmm.label_many([job.observations for job in batch])
+        except Exception, e:
+            log.exception("Batch decode failed")
+            for job in batch:
+                job.error = e
+                job.done.set()
+            return
+        self.counters['jobs'] += len(batch)
+        self.counters['batches'] += 1
+        self.counters['largestBatch'] = max(self.counters['largestBatch'], len(batch))
+        self.counters['decodeSeconds'] += time.time() - start
+        for job, labels in zip(batch, results):
+            job.labels = labels
+            job.done.set()
+
+
+# What a connection over LabelServer's limit is sent before it is closed
+BUSY_BODY = json.dumps({'error': 'too many connections'})
+BUSY_RESPONSE = ('HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+                 'Content-Length: %d\r\nRetry-After: 1\r\nConnection: close\r\n\r\n%s'
+                 % (len(BUSY_BODY), BUSY_BODY))
+
+
+class LabelServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' The HTTP server: one thread per connection, sharing one labeler
+        and one MicroBatcher '''
+    daemon_threads = True
+    allow_reuse_address = True
+    # connections waiting to be accepted; beyond this the kernel refuses them
+    request_queue_size = 128
+
+    def __init__( self, address, labeler, window = 0.005, maxBatch = 64, maxQueue = 256,
+                  maxInFlight = 32, maxBodyBytes = 16*1024*1024, timeout = 30.0,
+                  maxConnections = 128 ):
+        BaseHTTPServer.HTTPServer.__init__(self, address, LabelHandler)
+        self.labeler = labeler
+        self.batcher = MicroBatcher(labeler.hmm, window, maxBatch, maxQueue)
+        self.inFlight = threading.BoundedSemaphore(maxInFlight)
+        self.connections = threading.BoundedSemaphore(maxConnections)
+        self.maxBodyBytes = maxBodyBytes
+        self.requestTimeout = timeout
+        self.counterLock = threading.Lock()
+        self.counters = {'requests': 0, 'rejected': 0, 'failed': 0, 'strokes': 0}
+
+    def count( self, name, n = 1 ):
+        with self.counterLock:
+            self.counters[name] += n
+
+    def process_request( self, request, clientAddress ):
+        ''' Handle the connection on a new thread, or if maxConnections
+            are open already, answer 503 at once and close it '''
+        if not self.connections.acquire(False):
+            self.count('rejected')
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request, clientAddress)
+        except:
+            self.connections.release()
+            raise
+
+    def process_request_thread( self, request, clientAddress ):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, clientAddress)
+        finally:
+            self.connections.release()
+
+    def serve_forever( self, *args ):
+        self.batcher.start()
+        try:
+            BaseHTTPServer.HTTPServer.serve_forever(self, *args)
+        finally:
+            self.batcher.stop()
+
+    def strokesFromXml( self, body ):
+        ''' Build the strokes of a sketch document '''
+        pointDict, substrokeDict, strokeShapes, substrokeLabels = \
+            self.labeler.scanSketch(cStringIO.StringIO(body))
+        return self.labeler.buildStrokes(strokeShapes, substrokeDict, pointDict)
+
+    def strokesFromPoints( self, pointLists ):
+        ''' Build strokes from lists of [x, y, time] points.  They go
+            through the same code as strokes read from a file, with made
+            up ids. '''
+        pointDict = {}
+        substrokeDict = {}
+        strokeShapes = []
+        for i, points in enumerate(pointLists):
+            if not points:
+                raise ValueError("stroke %d has no points" % i)
+            ptIds = []
+            for j, (x, y, t) in enumerate(points):
+                ptId = "p%d.%d" % (i, j)
+                pointDict[ptId] = (int(x), int(y), int(t))
+                ptIds.append(ptId)
+            substrokeDict["ss%d" % i] = ptIds
+            strokeShapes.append(("s%d" % i, ["ss%d" % i]))
+        return self.labeler.buildStrokes(strokeShapes, substrokeDict, pointDict)
+
+
+class LabelHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET( self ):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'not found'})
+        server = self.server
+        with server.counterLock:
+            report = dict(server.counters)
+        report.update(server.batcher.counters)
+        report['queued'] = server.batcher.queue.qsize()
+        self.reply(200, report)
+
+    def do_POST( self ):
+        server = self.server
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # without a length the body can not be skipped, so the
+            # connection can not be used for another request
+            self.close_connection = True
+            return self.reply(400, {'error': 'bad Content-Length'})
+        if length > server.maxBodyBytes:
+            self.close_connection = True
+            return self.reply(413, {'error': 'request body is over %d bytes' % server.maxBodyBytes})
+        # a request that is turned away has its body read and dropped, so
+        # the client sees the answer rather than a reset connection
+        if self.path != '/label':
+            self.discardBody(length)
+            return self.reply(404, {'error': 'not found'})
+        # admission control: never block waiting for a slot, and only hold
+        # the bodies of requests that have one
+        if not server.inFlight.acquire(False):
+            server.count('rejected')
+            self.discardBody(length)
+            return self.reply(503, {'error': 'too many requests in flight'}, {'Retry-After': '1'})
+        try:
+            body = self.rfile.read(length)
+            server.count('requests')
+            try:
+                if body.lstrip().startswith('<'):
+                    strokes = server.strokesFromXml(body)
+                else:
+                    strokes = server.strokesFromPoints(json.loads(body)['strokes'])
+            except Exception, e:
+                server.count('failed')
+                return self.reply(400, {'error': "could not read the strokes: %s" % e})
+            labels = []
+            if strokes:
+                try:
+                    labels = server.batcher.submit(server.labeler.featurefy(strokes),
+                                                   server.requestTimeout)
+                except Overloaded, e:
+                    server.count('rejected')
+                    return self.reply(503, {'error': str(e)}, {'Retry-After': '1'})
+                except Exception, e:
+                    server.count('failed')
+                    return self.reply(500, {'error': str(e)})
+            server.count('strokes', len(strokes))
+            self.reply(200, {'strokeIds': [stroke.strokeId for stroke in strokes],
+                             'labels': labels})
+        finally:
+            server.inFlight.release()
+
+    def discardBody( self, length, blockSize = 1 << 16 ):
+        while length > 0:
+            block = self.rfile.read(min(length, blockSize))
+            if not block:
+                break
+            length -= len(block)
+
+    def reply( self, code, data, headers = {} ):
+        text = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message( self, format, *args ):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+def main( argv = None ):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('model', help = 'model file written by StrokeLabeler.save_model')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on (default: loopback)')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--window-ms', type = float, default = 5.0,
+                        help = 'how long a batch waits for more requests')
+    parser.add_argument('--max-batch', type = int, default = 64, help = 'most requests in one decode')
+    parser.add_argument('--max-queue', type = int, default = 256, help = 'most requests waiting to decode')
+    parser.add_argument('--max-inflight', type = int, default = 32,
+                        help = 'most requests being handled at once')
+    parser.add_argument('--max-connections', type = int, default = 128,
+                        help = 'most open connections; more are answered 503 at once')
+    parser.add_argument('--max-body-mb', type = float, default = 16.0, help = 'largest request body')
+    parser.add_argument('--timeout', type = float, default = 30.0,
+                        help = 'seconds a request waits for its decode')
+    parser.add_argument('--compact', action = 'store_true', help = 'use compact strokes to save memory')
+    args = parser.parse_args(argv)
+
+    labeler = StrokeHmm.StrokeLabeler(args.compact)
+    labeler.load_model(args.model)
+    server = LabelServer((args.host, args.port), labeler, args.window_ms / 1000.0, args.max_batch,
+                         args.max_queue, args.max_inflight, int(args.max_body_mb * 1024 * 1024),
+                         args.timeout, args.max_connections)
+    log.info("Labeling service for %s listening on http://%s:%d/", args.model, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = '%(message)s', stream = sys.stdout)
+    main()
@@ -0,0 +1,94 @@
+import json
+import struct
+import numpy
+
+# A model file is laid out as:
+#   MAGIC, then the format version and the header length as two
+#   little-endian uint32s, then the header (JSON), then the raw arrays.
+# The header holds whatever the caller stores plus an "arrays" table
+# giving the dtype, shape and file offset of every array.  Arrays start
+# on ALIGN byte boundaries so they can be memory mapped straight from the
+# file.
+MAGIC = "SKHMM\0\0\0"
+VERSION = 1
+ALIGN = 64
+
+def write( filename, header, arrays ):
+    ''' Write a model file.  header is a JSON-able dictionary and arrays
+        maps names to numpy arrays. '''
+    names = sorted(arrays.keys())
+    arrays = dict((name, numpy.ascontiguousarray(arrays[name])) for name in names)
+    # The offsets depend on the header length, which depends on the
+    # offsets, so lay the arrays out relative to the start of the data and
+    # move them along until the header fits in front of them
+    table = {}
+    offset = 0
+    for name in names:
+        a = arrays[name]
+        table[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset = roundUp(offset + a.nbytes)
+    header = dict(header)
+    header['arrays'] = table
+    relative = dict((name, table[name]['offset']) for name in names)
+    start = 0
+    while True:
+        for name in names:
+            table[name]['offset'] = relative[name] + start
+        text = json.dumps(header)
+        prefix = len(MAGIC) + 8 + len(text)
+        if prefix <= start:
+            break
+        start = roundUp(prefix)
+
+    f = open(filename, 'wb')
+    try:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', VERSION, len(text)))
+        f.write(text)
+        f.write('\0' * (start - prefix))
+        for name in names:
+            a = arrays[name]
+            f.write('\0' * (table[name]['offset'] - f.tell()))
+            f.write(a.tostring())
+    finally:
+        f.close()
+
+def read( filename, mmap = True ):
+    ''' Read a model file and return (header, arrays).  With mmap the
+        arrays are read-only views of the file, so only the pages that are
+        used are ever loaded. '''
+    f = open(filename, 'rb')
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a model file" % filename)
+        version, length = struct.unpack('<II', f.read(8))
+        if version != VERSION:
+            raise ValueError("%s has model format version %d, expected %d" % (filename, version, VERSION))
+        header = asStr(json.loads(f.read(length)))
+        arrays = {}
+        for name, info in header.pop('arrays').items():
+            dtype = numpy.dtype(info['dtype'])
+            shape = tuple(info['shape'])
+            if mmap and numpy.prod(shape) > 0:
+                arrays[name] = numpy.memmap(filename, dtype, 'r', info['offset'], shape)
+            else:
+                f.seek(info['offset'])
+                count = int(numpy.prod(shape))
+                arrays[name] = numpy.fromfile(f, dtype, count).reshape(shape)
+    finally:
+        f.close()
+    return header, arrays
+
+def roundUp( n ):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def asStr( value ):
+    ''' json gives back unicode strings; turn them into plain strings so
+        labels and feature names compare and print as before '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [asStr(v) for v in value]
+    if isinstance(value, dict):
+        return dict((asStr(k), asStr(v)) for k, v in value.items())
+    return value
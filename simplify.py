@@ -0,0 +1,71 @@
+''' Point reduction for strokes from high rate digitizers, applied by
+    StrokeLabeler before the features are computed (see
+    StrokeLabeler.useSimplification).  Points are (x, y, time) tuples of
+    integers, and so are the points returned. '''
+import math
+import numpy
+
+def resample( points, spacing ):
+    ''' Resample a stroke to points spacing apart along its path (the
+        last gap is shorter).  The first and last points are kept; x, y
+        and time are interpolated linearly and rounded to integers. '''
+    if len(points) < 2:
+        return list(points)
+    pts = numpy.array(points, dtype=float)
+    steps = numpy.sqrt(((pts[1:, :2] - pts[:-1, :2])**2).sum(axis=1))
+    along = numpy.concatenate(([0.0], numpy.cumsum(steps)))
+    total = along[-1]
+    targets = numpy.arange(0.0, total, spacing)
+    if len(targets) == 0 or targets[-1] < total:
+        targets = numpy.append(targets, total)
+    columns = [numpy.rint(numpy.interp(targets, along, pts[:, i])).astype(int) for i in range(3)]
+    return dropRepeats(zip(*[c.tolist() for c in columns]))
+
+def rdp( points, tolerance ):
+    ''' Simplify a stroke with Ramer-Douglas-Peucker: keep a subset of the
+        points such that no dropped point is more than tolerance from the
+        line between the kept points around it.  The first and last points
+        are always kept. '''
+    n = len(points)
+    if n < 3:
+        return list(points)
+    xs = numpy.array([p[0] for p in points], dtype=float)
+    ys = numpy.array([p[1] for p in points], dtype=float)
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    # an explicit stack instead of recursion, since strokes can have
+    # thousands of points
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = xs[last] - xs[first], ys[last] - ys[first]
+        px, py = xs[first+1:last] - xs[first], ys[first+1:last] - ys[first]
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            # the ends coincide: use the distance to that point
+            distances = numpy.sqrt(px**2 + py**2)
+        else:
+            distances = numpy.abs(px*dy - py*dx) / norm
+        i = distances.argmax()
+        if distances[i] > tolerance:
+            middle = first + 1 + i
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return dropRepeats([points[i] for i in numpy.flatnonzero(keep)])
+
+def dropRepeats( points ):
+    ''' Drop points at the same x and y as the point before them, as
+        StrokeLabeler.buildStroke does, so no segment has zero length '''
+    ret = []
+    last = None
+    for p in points:
+        if last is None or last[0] != p[0] or last[1] != p[1]:
+            ret.append(tuple(p))
+            last = p
+    return ret
+
+# The methods StrokeLabeler.useSimplification accepts
+METHODS = {'resample': resample, 'rdp': rdp}
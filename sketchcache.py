@@ -0,0 +1,148 @@
+import cPickle
+import hashlib
+import os
+import tempfile
+
+# Change this whenever the layout of the cached data changes, so that old
+# entries are simply never looked up again (and age out of the cache)
+CACHE_VERSION = 1
+
+# Fraction of maxBytes that an eviction frees the cache down to
+LOW_WATER = 0.9
+
+class SketchCache:
+    ''' An on-disk cache of parsed sketch files.
+        Each entry is a pickle of whatever the loader stored for a file, in
+        a file named after a key of the sketch file.  The key is either a
+        hash of the file contents (keyBy = 'hash') or of its path, size and
+        modification time (keyBy = 'mtime', cheaper but trusts the clock),
+        so a changed file never hits a stale entry.  A variant string (the
+        settings the data was built with) is part of the key too, so data
+        built one way is never returned for another.
+        The cache is kept under maxBytes by removing the least recently
+        used entries; a hit refreshes the entry's modification time.  The
+        total size is tracked as entries are written, and the directory is
+        only scanned when that total goes over maxBytes; eviction then
+        frees down to LOW_WATER of maxBytes so the next scan is a while
+        off. '''
+
+    def __init__(self, cacheDir, maxBytes = 256*1024*1024, keyBy = 'hash'):
+        if keyBy not in ('hash', 'mtime'):
+            raise ValueError("keyBy must be 'hash' or 'mtime'")
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.keyBy = keyBy
+        self.hits = 0
+        self.misses = 0
+        # bytes in the cache as far as this process knows, None until the
+        # directory has been scanned
+        self.size = None
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def key( self, filename, variant = '' ):
+        ''' Return the cache key for a sketch file '''
+        h = hashlib.sha1(str(CACHE_VERSION))
+        if variant:
+            h.update("\0%s\0" % variant)
+        if self.keyBy == 'mtime':
+            st = os.stat(filename)
+            h.update("%s\0%d\0%r" % (os.path.abspath(filename), st.st_size, st.st_mtime))
+        else:
+            f = open(filename, 'rb')
+            try:
+                for block in iter(lambda: f.read(1 << 16), ''):
+                    h.update(block)
+            finally:
+                f.close()
+        return h.hexdigest()
+
+    def entryPath( self, key ):
+        return os.path.join(self.cacheDir, key + ".pickle")
+
+    def get( self, filename, variant = '' ):
+        ''' Return the data stored for filename, or None on a miss '''
+        path = self.entryPath(self.key(filename, variant))
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # a damaged entry is just a miss
+            self.remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put( self, filename, data, variant = '' ):
+        ''' Store data for filename, then evict old entries if needed '''
+        path = self.entryPath(self.key(filename, variant))
+        if self.size is None:
+            self.evict()
+        # write to a temporary file first so readers never see half an entry
+        fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            size = os.path.getsize(tmpPath)
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.rename(tmpPath, path)
+        except:
+            self.remove(tmpPath)
+            raise
+        self.size += size
+        if self.size > self.maxBytes:
+            self.evict()
+
+    def evict( self ):
+        ''' Scan the cache and, if it is over maxBytes, remove the least
+            recently used entries until it is down to LOW_WATER of
+            maxBytes '''
+        entries = []
+        total = 0
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith(".pickle"):
+                continue
+            path = os.path.join(self.cacheDir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        if total > self.maxBytes:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.maxBytes * LOW_WATER:
+                    break
+                self.remove(path)
+                total -= size
+        self.size = total
+
+    def remove( self, path ):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear( self ):
+        ''' Remove every entry '''
+        for name in os.listdir(self.cacheDir):
+            if name.endswith(".pickle"):
+                self.remove(os.path.join(self.cacheDir, name))
+        self.size = 0
@@ -0,0 +1,144 @@
+import math
+
+class GridIndex:
+    ''' A uniform grid over axis aligned boxes (minX, minY, maxX, maxY)
+        for neighborhood queries between the strokes of a sketch.
+        Each box is listed in every grid cell it covers, so a query only
+        looks at the boxes in the cells near it instead of at every box.
+        The cell size defaults to defaultCellSize(boxes), so a typical
+        box covers a few cells.  Boxes that would cover more than maxCells
+        cells (long wires across the page) are kept in a separate list
+        that every query checks.  More boxes can be added later; the cell
+        size only affects speed, never the answers. '''
+
+    def __init__( self, boxes, cellSize = None, maxCells = 64 ):
+        if cellSize is None:
+            cellSize = defaultCellSize(boxes)
+        self.cellSize = float(cellSize)
+        self.maxCells = maxCells
+        self.boxes = []
+        self.cells = {}
+        self.large = []
+        self.bounds = (0, 0, -1, -1)
+        for box in boxes:
+            self.add(box)
+
+    def add( self, box ):
+        ''' Add a box and return its index '''
+        i = len(self.boxes)
+        box = tuple(map(float, box))
+        self.boxes.append(box)
+        x0, y0, x1, y1 = self.cellRange(box)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > self.maxCells:
+            self.large.append(i)
+            return i
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                self.cells.setdefault((cx, cy), []).append(i)
+        if self.bounds[0] > self.bounds[2]:
+            self.bounds = (x0, y0, x1, y1)
+        else:
+            self.bounds = (min(x0, self.bounds[0]), min(y0, self.bounds[1]),
+                           max(x1, self.bounds[2]), max(y1, self.bounds[3]))
+        return i
+
+    def cellRange( self, box ):
+        ''' The (x0, y0, x1, y1) cells covered by a box, inclusive '''
+        size = self.cellSize
+        return (int(math.floor(box[0] / size)), int(math.floor(box[1] / size)),
+                int(math.floor(box[2] / size)), int(math.floor(box[3] / size)))
+
+    def candidates( self, x0, y0, x1, y1 ):
+        ''' The indices of the boxes listed in the given range of cells, and
+            of all the large boxes '''
+        found = set(self.large)
+        cells = self.cells
+        for cx in range(max(x0, self.bounds[0]), min(x1, self.bounds[2]) + 1):
+            for cy in range(max(y0, self.bounds[1]), min(y1, self.bounds[3]) + 1):
+                found.update(cells.get((cx, cy), ()))
+        return found
+
+    def overlapCounts( self ):
+        ''' For every box, the number of other boxes that intersect it
+            (touching counts) '''
+        return [self.overlapCount(i) for i in range(len(self.boxes))]
+
+    def overlapCount( self, i ):
+        box = self.boxes[i]
+        if i in self.large:
+            others = range(len(self.boxes))
+        else:
+            others = self.candidates(*self.cellRange(box))
+        count = 0
+        for j in others:
+            if j != i and boxDistance(box, self.boxes[j]) == 0:
+                count += 1
+        return count
+
+    def nearestDistances( self ):
+        ''' For every box, the distance to the nearest other box (0 if they
+            touch), or inf if there is no other box.  The search grows one
+            ring of cells at a time and stops once no unseen box can be
+            closer than the best one found. '''
+        return [self.nearestDistance(i) for i in range(len(self.boxes))]
+
+    def nearestDistance( self, i ):
+        box = self.boxes[i]
+        best = float('inf')
+        for j in self.large:
+            if j != i:
+                best = min(best, boxDistance(box, self.boxes[j]))
+        x0, y0, x1, y1 = self.cellRange(box)
+        seen = set()
+        r = 0
+        while True:
+            # every box not seen yet is more than r cells away
+            for j in self.candidates(x0 - r, y0 - r, x1 + r, y1 + r) - seen:
+                seen.add(j)
+                if j != i:
+                    best = min(best, boxDistance(box, self.boxes[j]))
+            if best <= r * self.cellSize or (x0 - r <= self.bounds[0] and y0 - r <= self.bounds[1] and
+                                             x1 + r >= self.bounds[2] and y1 + r >= self.bounds[3]):
+                return best
+            r += 1
+
+    def densities( self, radius = None ):
+        ''' For every box, the number of other boxes whose center is within
+            radius (default: twice the cell size) of its center '''
+        return [self.density(i, radius) for i in range(len(self.boxes))]
+
+    def density( self, i, radius = None ):
+        if radius is None:
+            radius = 2 * self.cellSize
+        x, y = center(self.boxes[i])
+        # a box with its center in the circle overlaps the circle's
+        # bounding square
+        others = self.candidates(*self.cellRange((x - radius, y - radius, x + radius, y + radius)))
+        count = 0
+        for j in others:
+            cx, cy = center(self.boxes[j])
+            if j != i and (cx - x)**2 + (cy - y)**2 <= radius**2:
+                count += 1
+        return count
+
+
+def defaultCellSize( boxes ):
+    ''' The median box extent, or if the boxes are all points or lines, a
+        size that gives about as many cells as boxes '''
+    extents = sorted([max(maxX - minX, maxY - minY) for minX, minY, maxX, maxY in boxes])
+    cellSize = extents[len(extents) // 2] if extents else 1.0
+    if cellSize <= 0:
+        extent = max(max([b[2] for b in boxes]) - min([b[0] for b in boxes]),
+                     max([b[3] for b in boxes]) - min([b[1] for b in boxes]))
+        cellSize = max(extent / math.sqrt(len(boxes)), 1.0)
+    return float(cellSize)
+
+def center( box ):
+    return (box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0
+
+
+def boxDistance( a, b ):
+    ''' The distance between two boxes, 0 if they touch or overlap '''
+    dx = max(a[0] - b[2], b[0] - a[2], 0)
+    dy = max(a[1] - b[3], b[1] - a[3], 0)
+    return math.sqrt(dx*dx + dy*dy)
@@ -0,0 +1,127 @@
+import math
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # there is no resource module on Windows; memory tracking is then
+    # just skipped
+    resource = None
+
+# ru_maxrss is in kilobytes, except on Mac OS X where it is in bytes
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def maxResidentBytes():
+    ''' The peak resident set size of this process so far, in bytes '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+class NullStats:
+    ''' The default stats collector: every call does nothing, so an
+        uninstrumented labeler pays only for a method call per stage. '''
+
+    def count( self, name, n = 1 ):
+        pass
+
+    def stage( self, name ):
+        return NULL_STAGE
+
+    def record( self, name, seconds, peakGrowthBytes = None ):
+        pass
+
+    def report( self ):
+        return {}
+
+class NullStage:
+    def __enter__( self ):
+        return self
+    def __exit__( self, *args ):
+        return False
+
+NULL_STAGE = NullStage()
+NULL_STATS = NullStats()
+
+
+class StatsCollector(NullStats):
+    ''' Collects counters, and for every stage (parse, buildStroke,
+        featurize, decode, save) the number of calls, total time and a
+        latency histogram.  Histogram bucket i counts the calls that took
+        less than 2**i microseconds (and at least 2**(i-1)).
+        With trackMemory (where the resource module exists, so not on
+        Windows) each stage also records peakGrowthBytes, the most that
+        one call raised the peak resident size of the process.  The peak
+        never goes down, so a call that stays under an earlier peak adds
+        nothing: this shows which stages push memory to new highs, not
+        what each one allocates. '''
+
+    def __init__( self, trackMemory = False ):
+        self.counters = {}
+        self.stages = {}
+        self.trackMemory = trackMemory and resource is not None
+
+    def count( self, name, n = 1 ):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def stage( self, name ):
+        ''' Return a context manager that times the code it wraps '''
+        return Stage(self, name)
+
+    def record( self, name, seconds, peakGrowthBytes = None ):
+        s = self.stages.get(name)
+        if s is None:
+            s = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'min': None, 'max': None,
+                                     'histogram': {}, 'peakGrowthBytes': None}
+        s['calls'] += 1
+        s['seconds'] += seconds
+        s['min'] = seconds if s['min'] is None else min(s['min'], seconds)
+        s['max'] = seconds if s['max'] is None else max(s['max'], seconds)
+        micros = seconds * 1e6
+        bucket = 0 if micros < 1 else int(math.floor(math.log(micros, 2))) + 1
+        s['histogram'][bucket] = s['histogram'].get(bucket, 0) + 1
+        if peakGrowthBytes is not None:
+            if s['peakGrowthBytes'] is None:
+                s['peakGrowthBytes'] = peakGrowthBytes
+            else:
+                s['peakGrowthBytes'] = max(s['peakGrowthBytes'], peakGrowthBytes)
+
+    def report( self ):
+        ''' Return everything collected as a dictionary (JSON-able) '''
+        stages = {}
+        for name, s in self.stages.items():
+            stages[name] = dict(s)
+            stages[name]['mean'] = s['seconds'] / s['calls']
+            stages[name]['histogram'] = dict((str(b), c) for b, c in s['histogram'].items())
+        return {'counters': dict(self.counters), 'stages': stages}
+
+class Stage:
+    ''' Times one call of a stage for a StatsCollector '''
+
+    def __init__( self, collector, name ):
+        self.collector = collector
+        self.name = name
+
+    def __enter__( self ):
+        if self.collector.trackMemory:
+            self.startBytes = maxResidentBytes()
+        self.start = time.time()
+        return self
+
+    def __exit__( self, *args ):
+        seconds = time.time() - self.start
+        peakGrowthBytes = None
+        if self.collector.trackMemory:
+            peakGrowthBytes = maxResidentBytes() - self.startBytes
+        self.collector.record(self.name, seconds, peakGrowthBytes)
+        return False
+
+def timed( name ):
+    ''' Method decorator that times every call as stage name of the
+        instance's stats collector (self.stats) '''
+    def decorate( method ):
+        def wrapper( self, *args, **kwargs ):
+            with self.stats.stage(name):
+                return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorate
@@ -1,3 +1,3 @@
-execfile("StrokeHMMbasic.py")
+from StrokeHMMbasic import *
 hmm = HMM()
 hmm.testViterbi()
\ No newline at end of file
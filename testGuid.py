@@ -0,0 +1,64 @@
+''' Behaviour tests for guid generation.  Run with
+
+        python -m unittest testGuid
+'''
+import re
+import unittest
+
+import guid
+
+LAYOUT = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+def timeAndCounter( g ):
+    ''' The time and counter parts of a generated guid '''
+    h = g.replace('-', '')
+    return long(h[0:16], 16), long(h[16:24], 16)
+
+
+class GuidTest(unittest.TestCase):
+
+    def assertFollowOn( self, guids ):
+        ''' Each guid must come after the one before it: a later
+            millisecond, or the next counter in the same one '''
+        for a, b in zip(guids, guids[1:]):
+            (timeA, counterA), (timeB, counterB) = timeAndCounter(a), timeAndCounter(b)
+            if timeA == timeB:
+                self.assertEqual((counterB - counterA) % (guid.MAX_COUNTER + 1), 1)
+            else:
+                self.assertTrue(timeB > timeA)
+
+    def testGenerateIsUnique( self ):
+        guids = [guid.generate() for i in range(2000)]
+        self.assertEqual(len(set(guids)), len(guids))
+        for g in guids:
+            self.assertTrue(LAYOUT.match(g), g)
+        self.assertFollowOn(guids)
+
+    def testBatchFollowsOnFromGenerate( self ):
+        for n in (1, 5, 300):
+            guids = [guid.generate()] + guid.generate_batch(n) + [guid.generate()]
+            self.assertEqual(len(set(guids)), n + 2)
+            for g in guids:
+                self.assertTrue(LAYOUT.match(g), g)
+            self.assertFollowOn(guids)
+            # a batch shares one millisecond
+            self.assertEqual(len(set([timeAndCounter(g)[0] for g in guids[1:-1]])), 1)
+
+    def testEmptyBatch( self ):
+        self.assertEqual(guid.generate_batch(0), [])
+
+    def testDerive( self ):
+        a = guid.derive('stroke-1')
+        self.assertTrue(LAYOUT.match(a))
+        self.assertEqual(guid.derive('stroke-1'), a)
+        self.assertNotEqual(guid.derive('stroke-2'), a)
+        self.assertNotEqual(guid.derive('stroke-1', 'x'), a)
+        self.assertEqual(guid.derive(u'stroke-1'), a)
+        unicodeId = guid.derive(u'stroke-\xe9\u4e2d')
+        self.assertTrue(LAYOUT.match(unicodeId))
+        self.assertEqual(guid.derive(u'stroke-\xe9\u4e2d'), unicodeId)
+        self.assertEqual(guid.derive(u'stroke-\xe9\u4e2d'.encode('utf-8')), unicodeId)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,439 @@
+''' Behaviour tests for the HMM decoders.  Run with
+
+        python -m unittest testHmm
+'''
+import itertools
+import logging
+import math
+import random
+import unittest
+
+import numpy
+
+import StrokeHMMbasic
+import StrokeHmm
+from StrokeHmm import HMM, CONTINUOUS, DISCRETE
+
+StrokeHmm.setVerbosity(logging.WARNING)
+
+
+def normalized( rand, n ):
+    ''' n random probabilities that sum to 1 '''
+    weights = [rand.uniform(0.05, 1.0) for i in range(n)]
+    total = sum(weights)
+    return [w / total for w in weights]
+
+def randomModel( rand, numStates = 3, numVals = (2, 3) ):
+    ''' Return (states, featureNames, contOrDisc, numVals, priors,
+        transitions, emissions) for a random all discrete model '''
+    states = ['s%d' % i for i in range(numStates)]
+    featureNames = ['f%d' % i for i in range(len(numVals))]
+    contOrDisc = dict((f, DISCRETE) for f in featureNames)
+    vals = dict(zip(featureNames, numVals))
+    priors = dict(zip(states, normalized(rand, numStates)))
+    transitions = dict((s, dict(zip(states, normalized(rand, numStates)))) for s in states)
+    emissions = dict((s, dict((f, normalized(rand, vals[f])) for f in featureNames)) for s in states)
+    return states, featureNames, contOrDisc, vals, priors, transitions, emissions
+
+def makeHmm( model, cls = HMM ):
+    ''' An HMM of class cls with the probabilities of model set directly '''
+    states, featureNames, contOrDisc, numVals, priors, transitions, emissions = model
+    hmm = cls(states, featureNames, contOrDisc, numVals)
+    hmm.priors, hmm.transitions, hmm.emissions = priors, transitions, emissions
+    return hmm
+
+def randomObservations( rand, model, length ):
+    featureNames, numVals = model[1], model[3]
+    return [dict((f, rand.randrange(numVals[f])) for f in featureNames) for t in range(length)]
+
+def pathScore( hmm, data, path ):
+    ''' log P(data, path) '''
+    total = math.log(hmm.priors[path[0]]) + math.log(hmm.getEmissionProb(path[0], data[0]))
+    for t in range(1, len(data)):
+        total += math.log(hmm.transitions[path[t-1]][path[t]])
+        total += math.log(hmm.getEmissionProb(path[t], data[t]))
+    return total
+
+def bruteForceLabels( hmm, data ):
+    ''' The most likely state sequence, by scoring every one of them '''
+    return list(max(itertools.product(hmm.states, repeat=len(data)),
+                    key=lambda path: pathScore(hmm, data, path)))
+
+
+class ViterbiTest(unittest.TestCase):
+
+    def assertBestPath( self, hmm, data, labels, expected ):
+        ''' labels must be expected, or another path with the same score
+            (paths that tie exactly may be broken either way by rounding) '''
+        self.assertEqual(len(labels), len(data))
+        if labels != expected:
+            self.assertAlmostEqual(pathScore(hmm, data, labels), pathScore(hmm, data, expected), 9)
+
+    def testWeatherExample( self ):
+        hmm = HMM()
+        self.assertEqual(hmm.testViterbi(), ['Sunny', 'Cloudy', 'Rainy'])
+        self.assertEqual(hmm.label([{'Evidence': 0}, {'Evidence': 2}, {'Evidence': 3}]),
+                         ['Sunny', 'Cloudy', 'Rainy'])
+
+    def testMatchesBruteForce( self ):
+        rand = random.Random(1)
+        for trial in range(40):
+            model = randomModel(rand)
+            data = randomObservations(rand, model, rand.randint(1, 6))
+            hmm = makeHmm(model)
+            self.assertBestPath(hmm, data, hmm.label(data), bruteForceLabels(hmm, data))
+
+    def testMatchesDictionaryViterbi( self ):
+        # the original dictionary based decoder
+        rand = random.Random(2)
+        for trial in range(40):
+            model = randomModel(rand, numStates = rand.randint(2, 6))
+            data = randomObservations(rand, model, rand.randint(1, 40))
+            hmm = makeHmm(model)
+            self.assertBestPath(hmm, data, hmm.label(data), makeHmm(model, StrokeHMMbasic.HMM).label(data))
+
+    def testLongSequence( self ):
+        rand = random.Random(3)
+        model = randomModel(rand)
+        data = randomObservations(rand, model, 3000)
+        hmm = makeHmm(model)
+        self.assertBestPath(hmm, data, hmm.label(data), makeHmm(model, StrokeHMMbasic.HMM).label(data))
+
+    def testEmptySequence( self ):
+        hmm = makeHmm(randomModel(random.Random(4)))
+        self.assertEqual(hmm.label([]), [])
+
+    def testTablesFollowRetraining( self ):
+        # replacing the model dictionaries must not decode with stale tables
+        rand = random.Random(5)
+        model = randomModel(rand)
+        data = randomObservations(rand, model, 10)
+        hmm = makeHmm(model)
+        hmm.label(data)
+        other = randomModel(rand)
+        hmm.priors, hmm.transitions, hmm.emissions = other[4:]
+        self.assertEqual(hmm.label(data), makeHmm(other).label(data))
+
+
+class BatchTest(unittest.TestCase):
+
+    def testLabelManyMatchesLabel( self ):
+        rand = random.Random(6)
+        for trial in range(10):
+            model = randomModel(rand, numStates = rand.randint(2, 5))
+            hmm = makeHmm(model)
+            dataList = [randomObservations(rand, model, rand.randint(0, 30)) for i in range(12)]
+            self.assertEqual(hmm.label_many(dataList), [hmm.label(data) for data in dataList])
+
+    def testLabelManyKeepsOrder( self ):
+        # sequences are decoded longest first but returned in input order
+        rand = random.Random(7)
+        model = randomModel(rand)
+        hmm = makeHmm(model)
+        dataList = [randomObservations(rand, model, n) for n in (1, 9, 0, 4, 9, 2)]
+        results = hmm.label_many(dataList)
+        self.assertEqual([len(labels) for labels in results], [1, 9, 0, 4, 9, 2])
+        self.assertEqual(results[3], hmm.label(dataList[3]))
+
+    def testEmptyBatch( self ):
+        hmm = makeHmm(randomModel(random.Random(8)))
+        self.assertEqual(hmm.label_many([]), [])
+        self.assertEqual(hmm.label_many([[], []]), [[], []])
+
+    def testChunks( self ):
+        rand = random.Random(10)
+        model = randomModel(rand)
+        hmm = makeHmm(model)
+        dataList = [randomObservations(rand, model, rand.randint(0, 30)) for i in range(40)]
+        expected = [hmm.label(data) for data in dataList]
+        saved = StrokeHmm.MAX_BATCH_STEPS
+        StrokeHmm.MAX_BATCH_STEPS = 25
+        try:
+            seen = []
+            for order, lengths, logEmissions in hmm.paddedBatches(dataList):
+                B, T, S = logEmissions.shape
+                self.assertTrue(B * T <= 25 or B == 1)
+                self.assertEqual(T, max(lengths))
+                seen.extend(order)
+            self.assertEqual(sorted(seen), [i for i in range(40) if dataList[i]])
+            self.assertEqual(hmm.label_many(dataList), expected)
+            labels, posteriors = hmm.label_many_with_posteriors(dataList)
+            self.assertEqual(labels, expected)
+        finally:
+            StrokeHmm.MAX_BATCH_STEPS = saved
+
+
+def sparseModel( rand, numStates ):
+    ''' A random model in which each state can only move to two states '''
+    model = randomModel(rand, numStates)
+    states, transitions = model[0], model[5]
+    for s in states:
+        allowed = rand.sample(states, 2)
+        weights = normalized(rand, 2)
+        transitions[s] = dict((s2, weights[allowed.index(s2)] if s2 in allowed else 0.0)
+                              for s2 in states)
+    return model
+
+class SparseTest(unittest.TestCase):
+
+    def denseLabels( self, hmm, dataList ):
+        ''' label_many with the sparse decoder turned off '''
+        saved = StrokeHmm.SPARSE_DENSITY
+        StrokeHmm.SPARSE_DENSITY = -1
+        try:
+            return hmm.label_many(dataList)
+        finally:
+            StrokeHmm.SPARSE_DENSITY = saved
+
+    def testSparseMatchesDense( self ):
+        rand = random.Random(13)
+        for trial in range(20):
+            model = sparseModel(rand, rand.randint(4, 6))
+            hmm = makeHmm(model)
+            dataList = [randomObservations(rand, model, rand.randint(0, 20)) for i in range(6)]
+            labels = hmm.label_many(dataList)
+            self.assertTrue(hmm.transitionDensity <= StrokeHmm.SPARSE_DENSITY)
+            self.assertEqual(labels, self.denseLabels(hmm, dataList))
+            self.assertEqual(labels, [hmm.label(data) for data in dataList])
+
+    def testFullTopKMatchesDense( self ):
+        rand = random.Random(14)
+        for trial in range(20):
+            model = sparseModel(rand, 4) if trial % 2 else randomModel(rand, 4)
+            hmm = makeHmm(model)
+            dataList = [randomObservations(rand, model, rand.randint(0, 20)) for i in range(6)]
+            expected = self.denseLabels(hmm, dataList)
+            hmm.topK = len(hmm.states)
+            self.assertEqual(hmm.label_many(dataList), expected)
+
+
+class PosteriorTest(unittest.TestCase):
+
+    def bruteForcePosteriors( self, hmm, data ):
+        ''' P(state at t|data) by summing P(data, path) over every path '''
+        ret = numpy.zeros((len(data), len(hmm.stateOrder)))
+        for path in itertools.product(hmm.states, repeat=len(data)):
+            p = math.exp(pathScore(hmm, data, path))
+            for t, s in enumerate(path):
+                ret[t, hmm.stateIndex[s]] += p
+        return ret / ret.sum(axis=1)[:, None]
+
+    def testMatchesBruteForce( self ):
+        rand = random.Random(11)
+        for trial in range(20):
+            model = randomModel(rand, numStates = rand.randint(2, 3))
+            hmm = makeHmm(model)
+            dataList = [randomObservations(rand, model, rand.randint(1, 6)) for i in range(3)]
+            labels, posteriors = hmm.label_many_with_posteriors(dataList)
+            self.assertEqual(labels, hmm.label_many(dataList))
+            for data, gamma in zip(dataList, posteriors):
+                self.assertEqual(gamma.shape, (len(data), len(hmm.states)))
+                self.assertTrue(numpy.allclose(gamma.sum(axis=1), 1))
+                self.assertTrue(numpy.allclose(gamma, self.bruteForcePosteriors(hmm, data)))
+
+    def testEmptySequence( self ):
+        hmm = makeHmm(randomModel(random.Random(12)))
+        labels, posteriors = hmm.label_with_posteriors([])
+        self.assertEqual(labels, [])
+        self.assertEqual(posteriors.shape, (0, len(hmm.states)))
+
+
+class CodebookTest(unittest.TestCase):
+
+    def testEncodeDecode( self ):
+        codebook = StrokeHmm.ObservationCodebook(['a', 'b', 'c'], {'a': 2, 'b': 3, 'c': 4})
+        self.assertEqual(codebook.size, 24)
+        codes = [codebook.encode({'a': a, 'b': b, 'c': c})
+                 for a in range(2) for b in range(3) for c in range(4)]
+        self.assertEqual(codes, range(24))
+        self.assertEqual(codebook.decode(17), {'a': 1, 'b': 1, 'c': 1})
+
+    def testTableMatchesEmissionProbabilities( self ):
+        hmm = makeHmm(randomModel(random.Random(9), 4, (2, 3, 2)))
+        hmm.compileLogTables()
+        for code in range(hmm.codebook.size):
+            features = hmm.codebook.decode(code)
+            for s in hmm.states:
+                self.assertAlmostEqual(hmm.logEmissionTable[code, hmm.stateIndex[s]],
+                                       math.log(hmm.getEmissionProb(s, features), 2), 9)
+
+    def testCodesAndDictionariesDecodeAlike( self ):
+        rand = random.Random(10)
+        model = randomModel(rand, 4)
+        hmm = makeHmm(model)
+        data = randomObservations(rand, model, 25)
+        codes = [hmm.codebook.encode(features) for features in data]
+        self.assertEqual(hmm.label(codes), hmm.label(data))
+        mixed = [codes[t] if t % 2 else data[t] for t in range(len(data))]
+        self.assertEqual(hmm.label(mixed), hmm.label(data))
+
+    def testLargeFeatureSpaceHasNoTable( self ):
+        # 13 binary features are more combinations than MAX_CODEBOOK_SIZE
+        rand = random.Random(11)
+        model = randomModel(rand, 3, (2,) * 13)
+        self.assertTrue(2**13 > StrokeHmm.MAX_CODEBOOK_SIZE)
+        hmm = makeHmm(model)
+        self.assertEqual(hmm.codebook, None)
+        data = randomObservations(rand, model, 30)
+        self.assertBestPathOf(hmm, data, makeHmm(model, StrokeHMMbasic.HMM).label(data))
+        self.assertEqual(hmm.logEmissionTable, None)
+
+    def assertBestPathOf( self, hmm, data, expected ):
+        labels = hmm.label(data)
+        self.assertAlmostEqual(pathScore(hmm, data, labels), pathScore(hmm, data, expected), 9)
+
+    def testLabelerCodesObservations( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        self.assertNotEqual(sl.codebook, None)
+        sl.numFVals = dict((f, 6) for f in sl.featureNames)
+        sl.useNeighborhoodFeatures()
+        self.assertEqual(sl.codebook, None)
+
+
+def randomTrainingData( rand, model, numSequences ):
+    ''' Labeled random sequences for the features of model, with a
+        continuous feature 'c' that is added when model has it '''
+    states, featureNames, contOrDisc, numVals = model[:4]
+    observations, labels = [], []
+    for i in range(numSequences):
+        n = rand.randint(1, 15)
+        labels.append([rand.choice(states) for t in range(n)])
+        sequence = []
+        for label in labels[-1]:
+            features = {}
+            for f in featureNames:
+                if contOrDisc[f] == DISCRETE:
+                    features[f] = rand.randrange(numVals[f])
+                else:
+                    # epoch millisecond sized values with a small spread
+                    features[f] = 1.7e12 + states.index(label) * 50 + rand.gauss(0, 3)
+            sequence.append(features)
+        observations.append(sequence)
+    return observations, labels
+
+def mixedModel( rand ):
+    model = randomModel(rand, 3, (2, 3))
+    states, featureNames, contOrDisc, numVals = model[:4]
+    return (states, featureNames + ['c'], dict(contOrDisc, c = CONTINUOUS), numVals)
+
+def trainedHmm( model, observations, labels ):
+    hmm = HMM(*model)
+    hmm.train(observations, labels)
+    return hmm
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def assertCountsEqual( self, a, b ):
+        # the continuous values are about 1.7e12 and so only exact to about
+        # 1e-4, which limits how exactly their moments can be undone
+        for name in ('priorCounts', 'numSequences', 'transitionCounts', 'featureCounts'):
+            self.assertEqual(a[name], b[name])
+        for s in a['emissionCounts']:
+            for f in a['emissionCounts'][s]:
+                for x, y in zip(a['emissionCounts'][s][f], b['emissionCounts'][s][f]):
+                    self.assertTrue(abs(x - y) <= 1e-4 * max(abs(x), abs(y), 1), (s, f, x, y))
+
+    def testPartialFitMatchesTrain( self ):
+        rand = random.Random(13)
+        model = mixedModel(rand)
+        observations, labels = randomTrainingData(rand, model, 20)
+        hmm = HMM(*model)
+        hmm.partial_fit(observations[:8], labels[:8])
+        hmm.partial_fit(observations[8:], labels[8:])
+        whole = trainedHmm(model, observations, labels)
+        self.assertCountsEqual(hmm.getCounts(), whole.getCounts())
+        data = observations[0] + observations[1]
+        self.assertEqual(hmm.label(data), whole.label(data))
+
+    def testForgetUndoesPartialFit( self ):
+        rand = random.Random(14)
+        model = mixedModel(rand)
+        observations, labels = randomTrainingData(rand, model, 20)
+        hmm = trainedHmm(model, observations[:12], labels[:12])
+        before = hmm.getCounts()
+        hmm.partial_fit(observations[12:], labels[12:])
+        hmm.forget(observations[12:], labels[12:])
+        self.assertCountsEqual(hmm.getCounts(), before)
+
+    def testForgetUnknownDataFails( self ):
+        rand = random.Random(15)
+        model = mixedModel(rand)
+        observations, labels = randomTrainingData(rand, model, 3)
+        hmm = trainedHmm(model, observations[:1], labels[:1])
+        before = hmm.getCounts()
+        self.assertRaises(ValueError, hmm.forget, observations[1:], labels[1:])
+        self.assertCountsEqual(hmm.getCounts(), before)
+
+    def testVarianceOfLargeValues( self ):
+        # E[x^2] - mean^2 loses everything at this size; the moments must not
+        rand = random.Random(16)
+        model = mixedModel(rand)
+        observations, labels = randomTrainingData(rand, model, 30)
+        hmm = HMM(*model)
+        for obs, lab in zip(observations, labels):
+            hmm.partial_fit([obs], [lab])
+        for s in hmm.states:
+            values = [features['c'] for obs, lab in zip(observations, labels)
+                      for features, label in zip(obs, lab) if label == s]
+            mean, sigma = hmm.emissions[s]['c']
+            self.assertAlmostEqual(mean, numpy.mean(values), 2)
+            self.assertAlmostEqual(sigma / numpy.std(values), 1.0, 4)
+
+    def testCombineCounts( self ):
+        rand = random.Random(17)
+        model = mixedModel(rand)
+        observations, labels = randomTrainingData(rand, model, 10)
+        hmm = trainedHmm(model, observations, labels)
+        rest = hmm.combineCounts(hmm.getCounts(), hmm.countsFor(observations[:4], labels[:4]), -1)
+        self.assertCountsEqual(rest, hmm.countsFor(observations[4:], labels[4:]))
+
+    def testMergeMoments( self ):
+        a = [3.0, 5.0, 11.0]
+        b = [2.0, 8.0]
+        def moments( values ):
+            return len(values), numpy.mean(values), numpy.var(values) * len(values)
+        n, mean, m2 = StrokeHmm.mergeMoments(moments(a), moments(b))
+        self.assertEqual(n, 5)
+        self.assertAlmostEqual(mean, numpy.mean(a + b))
+        self.assertAlmostEqual(m2, numpy.var(a + b) * 5)
+        n, mean, m2 = StrokeHmm.mergeMoments(moments(a + b), moments(b), -1)
+        self.assertEqual(n, 3)
+        self.assertAlmostEqual(mean, numpy.mean(a))
+        self.assertAlmostEqual(m2, numpy.var(a) * 3)
+
+
+class ContinuousTest(unittest.TestCase):
+
+    def mixedHmm( self, rand ):
+        ''' A mixed model with random Gaussians for the continuous feature '''
+        states, featureNames, contOrDisc, numVals, priors, transitions, emissions = \
+            randomModel(rand, 3, (2, 3))
+        for s in states:
+            emissions[s]['c'] = (rand.uniform(-5, 5), rand.uniform(0.5, 3))
+        return makeHmm((states, featureNames + ['c'], dict(contOrDisc, c = CONTINUOUS),
+                        numVals, priors, transitions, emissions))
+
+    def testMatchesEmissionProbabilities( self ):
+        rand = random.Random(15)
+        for trial in range(10):
+            hmm = self.mixedHmm(rand)
+            data = [{'f0': rand.randrange(2), 'f1': rand.randrange(3), 'c': rand.uniform(-8, 8)}
+                    for t in range(20)]
+            # features may be missing from an observation
+            data += [{'c': 1.5}, {'f0': 1}, {}]
+            hmm.compileLogTables()
+            expected = numpy.array([[math.log(hmm.getEmissionProb(s, features), 2)
+                                     for s in hmm.stateOrder] for features in data])
+            self.assertTrue(numpy.allclose(hmm.logEmissionMatrix(data), expected))
+
+    def testOutliersStayFinite( self ):
+        hmm = self.mixedHmm(random.Random(16))
+        hmm.compileLogTables()
+        logEmissions = hmm.logEmissionMatrix([{'f0': 0, 'f1': 2, 'c': 1e6}])
+        self.assertTrue(numpy.isfinite(logEmissions).all())
+        self.assertEqual(len(hmm.label([{'c': 1e6}, {'c': -1e6}])), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
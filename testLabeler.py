@@ -0,0 +1,574 @@
+''' Behaviour tests for loading, training and saving with StrokeLabeler on
+    a small synthetic corpus.  Run with
+
+        python -m unittest testLabeler
+'''
+import filecmp
+import httplib
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+import batchlabel
+import benchmark
+import labelserver
+import modelfile
+import StrokeHMMbasic
+import StrokeHmm
+
+StrokeHmm.setVerbosity(logging.WARNING)
+
+corpusDir = None
+files = []
+
+def setUpModule():
+    global corpusDir, files
+    corpusDir = tempfile.mkdtemp()
+    files = benchmark.generateCorpus(os.path.join(corpusDir, 'corpus'), 6, 25, 20)
+
+def tearDownModule():
+    shutil.rmtree(corpusDir)
+
+
+class LoaderTest(unittest.TestCase):
+
+    def testMatchesDomLoader( self ):
+        old = StrokeHMMbasic.StrokeLabeler()
+        new = StrokeHmm.StrokeLabeler()
+        for f in files:
+            oldStrokes, oldLabels = old.loadLabeledFile(f)
+            newStrokes, newLabels = new.loadLabeledFile(f)
+            self.assertEqual(newLabels, oldLabels)
+            self.assertEqual([s.strokeId for s in newStrokes], [s.strokeId for s in oldStrokes])
+            self.assertEqual([s.substrokeIds for s in newStrokes], [s.substrokeIds for s in oldStrokes])
+            self.assertEqual([s.points for s in newStrokes], [s.points for s in oldStrokes])
+            for newStroke, oldStroke in zip(newStrokes, oldStrokes):
+                self.assertAlmostEqual(newStroke.featureValues['length'], oldStroke.length())
+                self.assertAlmostEqual(newStroke.featureValues['sumOfCurvature'],
+                                       oldStroke.sumOfCurvature())
+
+    def testStrokeFileMatchesDomLoader( self ):
+        oldStrokes = StrokeHMMbasic.StrokeLabeler().loadStrokeFile(files[0])
+        newStrokes = StrokeHmm.StrokeLabeler().loadStrokeFile(files[0])
+        self.assertEqual([s.points for s in newStrokes], [s.points for s in oldStrokes])
+
+
+def splitEntropy( left, right ):
+    ''' The conditional entropy of the labels given the side of a split '''
+    total = float(len(left) + len(right))
+    ret = 0.0
+    for side in (left, right):
+        for label in set(side):
+            p = side.count(label) / float(len(side))
+            ret -= len(side) / total * p * math.log(p, 2)
+    return ret
+
+
+class ThresholdTest(unittest.TestCase):
+
+    def testBestSplitMatchesBruteForce( self ):
+        rand = random.Random(12)
+        sl = StrokeHmm.StrokeLabeler()
+        for trial in range(30):
+            values = [rand.randrange(20) for i in range(40)]
+            labels = [rand.choice(sl.labels) if v < 12 else 'text' for v in values]
+            strokes = []
+            for v in values:
+                s = StrokeHmm.Stroke('s')
+                s.featureValues['length'] = v
+                strokes.append(s)
+            sl.featureNames = ['length']
+            sl.generateFeatureIntervals([strokes], [labels])
+            threshold, = sl.featureIntervals['length']
+            distinct = sorted(set(values))
+            best = min([splitEntropy([l for v, l in zip(values, labels) if v < t],
+                                     [l for v, l in zip(values, labels) if v >= t])
+                        for t in distinct[1:]])
+            left = [l for v, l in zip(values, labels) if v < threshold]
+            right = [l for v, l in zip(values, labels) if v >= threshold]
+            self.assertAlmostEqual(splitEntropy(left, right), best)
+
+    def testMoreBins( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        sl.featureNames = ['length']
+        sl.numFVals['length'] = 3
+        strokes = []
+        for v in range(30):
+            s = StrokeHmm.Stroke('s')
+            s.featureValues['length'] = v
+            strokes.append(s)
+        labels = ['text'] * 10 + ['drawing'] * 10 + ['text'] * 10
+        sl.generateFeatureIntervals([strokes], [labels])
+        self.assertEqual(sl.featureIntervals['length'], [9.5, 19.5])
+
+
+class CompactStrokeTest(unittest.TestCase):
+
+    def testSameAsStroke( self ):
+        plain = StrokeHmm.StrokeLabeler()
+        compact = StrokeHmm.StrokeLabeler(True)
+        for f in files:
+            plainStrokes, plainLabels = plain.loadLabeledFile(f)
+            compactStrokes, compactLabels = compact.loadLabeledFile(f)
+            self.assertEqual(compactLabels, plainLabels)
+            for p, c in zip(plainStrokes, compactStrokes):
+                self.assertTrue(isinstance(c, StrokeHmm.CompactStroke))
+                self.assertEqual(c.points, p.points)
+                self.assertEqual(c.substrokeIds, p.substrokeIds)
+                self.assertEqual((c.startTime(), c.endTime()), (p.startTime(), p.endTime()))
+                for name, value in p.featureValues.items():
+                    self.assertAlmostEqual(c.featureValues[name], value)
+                self.assertAlmostEqual(c.sumOfCurvature(abs), p.sumOfCurvature(abs))
+
+    def testEpochMillisecondTimes( self ):
+        stroke = StrokeHmm.CompactStroke('s')
+        points = [(1, 2, 1700000000000), (5, 7, 1700000000123)]
+        stroke.setPoints(points)
+        stroke.computeFeatures()
+        self.assertEqual(stroke.points, points)
+        self.assertEqual(stroke.endTime(), 1700000000123)
+        self.assertEqual(stroke.timeDuration(), 123.0)
+        self.assertEqual(StrokeHmm.CompactStroke.fromData(stroke.toData()).points, points)
+
+    def testIdsAreShared( self ):
+        a = StrokeHmm.CompactStroke(''.join(['stroke', '-', '1']))
+        b = StrokeHmm.CompactStroke(''.join(['stroke', '-', '1']))
+        self.assertTrue(a.strokeId is b.strokeId)
+        self.assertEqual(StrokeHmm.internId(u'unicode id'), u'unicode id')
+
+
+class TrainingTest(unittest.TestCase):
+
+    def testValidateAll( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        sl.trainHMM(files)
+        table = sl.validateAll()
+        self.assertEqual(sorted(table), sorted(sl.labels))
+        self.assertEqual(sum([sum(row.values()) for row in table.values()]),
+                         sum([len(labels) for labels in sl.allLabels]))
+        self.assertEqual(table, sl.confusionTable(list(itertools.chain(*sl.allLabels)),
+                                                  list(itertools.chain(*sl.classifications))))
+
+    def testParallelLoadingMatchesSerial( self ):
+        serial = StrokeHmm.StrokeLabeler()
+        serial.trainHMM(files)
+        parallel = StrokeHmm.StrokeLabeler()
+        parallel.trainHMM(files, workers = 2)
+        self.assertEqual(parallel.allLabels, serial.allLabels)
+        self.assertEqual([[s.points for s in strokes] for strokes in parallel.allStrokes],
+                         [[s.points for s in strokes] for strokes in serial.allStrokes])
+        self.assertEqual(parallel.featureIntervals, serial.featureIntervals)
+        self.assertEqual(parallel.allObservations, serial.allObservations)
+        self.assertEqual(parallel.hmm.getCounts(), serial.hmm.getCounts())
+        self.assertEqual((parallel.hmm.priors, parallel.hmm.transitions, parallel.hmm.emissions),
+                         (serial.hmm.priors, serial.hmm.transitions, serial.hmm.emissions))
+
+    def testStreamMatchesTrainHMM( self ):
+        batch = StrokeHmm.StrokeLabeler()
+        batch.trainHMM(files)
+        stream = StrokeHmm.StrokeLabeler()
+        stream.trainHMMStream(stream.iterLabeledFiles(files))
+        self.assertEqual(stream.hmm.priors, batch.hmm.priors)
+        self.assertEqual(stream.hmm.transitions, batch.hmm.transitions)
+        # the thresholds are found on values rounded to 4 significant
+        # digits, which here does not move any stroke to another bin
+        for f, intervals in batch.featureIntervals.items():
+            for a, b in zip(stream.featureIntervals[f], intervals):
+                self.assertTrue(abs(a - b) <= 1e-3 * abs(b))
+        self.assertEqual(stream.hmm.emissions, batch.hmm.emissions)
+
+    def testCrossValidateMatchesRetraining( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        sl.trainHMM(files)
+        intervals = dict(sl.featureIntervals)
+        foldTables, pooled = sl.crossValidate(3)
+        self.assertEqual(len(foldTables), 3)
+        # the model and its thresholds are left as they were
+        self.assertEqual(sl.featureIntervals, intervals)
+        for k in range(3):
+            heldOut = range(k, len(files), 3)
+            retrained = StrokeHmm.StrokeLabeler()
+            retrained.trainHMM([f for i, f in enumerate(files) if i not in heldOut])
+            classifications = retrained.hmm.label_many([retrained.featurefy(sl.allStrokes[i])
+                                                        for i in heldOut])
+            trueLabels = list(itertools.chain(*[sl.allLabels[i] for i in heldOut]))
+            self.assertEqual(foldTables[k], sl.confusionTable(trueLabels,
+                                                              list(itertools.chain(*classifications))))
+        self.assertEqual(sl.crossValidate(3, workers = 2), (foldTables, pooled))
+
+
+class StreamingTest(unittest.TestCase):
+
+    def stream( self, labeler, strokes, lag ):
+        ''' Label strokes with a StreamingLabeler and return its labels '''
+        streaming = StrokeHmm.StreamingLabeler(labeler, lag)
+        committed = []
+        for stroke in strokes:
+            committed.extend(streaming.addStroke(stroke)[0])
+        committed.extend(streaming.finish())
+        self.assertEqual(committed, streaming.labels)
+        return committed
+
+    def testLargeLagMatchesLabel( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        sl.trainHMM(files[:4])
+        for f in files[4:]:
+            strokes = sl.loadStrokeFile(f)
+            streaming = StrokeHmm.StreamingLabeler(sl, 1000)
+            for stroke in strokes:
+                self.assertEqual(streaming.addStroke(stroke)[0], [])
+            # with nothing committed early, finishing is plain Viterbi over
+            # the features the strokes were streamed with
+            self.assertEqual(streaming.finish(), sl.hmm.label(sl.featurefy(strokes)))
+
+    def testNeighborhoodFeaturesOfStrokesSoFar( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        sl.useNeighborhoodFeatures()
+        sl.trainHMM(files[:4])
+        strokes = sl.loadStrokeFile(files[4])
+        labels = self.stream(sl, strokes, 2)
+        for k in range(len(strokes)):
+            # the features setNeighborhoodFeatures gives the last stroke of
+            # the sketch drawn so far
+            prefix = sl.loadStrokeFile(files[4])[:k + 1]
+            sl.setNeighborhoodFeatures(prefix)
+            for f in StrokeHmm.NEIGHBORHOOD_FEATURES:
+                self.assertEqual(strokes[k].featureValues[f], prefix[-1].featureValues[f])
+        # a stroke with no neighbours so far has the 'no neighbours' values
+        self.assertEqual(strokes[0].featureValues['nearestStroke'], -1.0)
+        self.assertNotEqual(len(set([s.featureValues['nearestStroke'] for s in strokes])), 1)
+        self.assertEqual(labels, sl.hmm.label(sl.featurefy(strokes)))
+
+
+class ModelFileTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def testSaveLoadRoundTrip( self ):
+        trained = StrokeHmm.StrokeLabeler()
+        trained.trainHMM(files[:4])
+        path = os.path.join(self.dir, 'model.skhmm')
+        trained.save_model(path)
+        for mmap in (True, False):
+            loaded = StrokeHmm.StrokeLabeler()
+            loaded.load_model(path, mmap)
+            self.assertEqual(loaded.featureIntervals, trained.featureIntervals)
+            self.assertEqual(loaded.hmm.priors, trained.hmm.priors)
+            self.assertEqual(loaded.hmm.getCounts(), trained.hmm.getCounts())
+            for f in files[4:]:
+                strokes = loaded.loadStrokeFile(f)
+                self.assertEqual(loaded.labelStrokes(strokes), trained.labelStrokes(strokes))
+            # the counts come back too, so the model can keep learning
+            strokes, labels = loaded.loadLabeledFile(files[4])
+            loaded.hmm.partial_fit([loaded.featurefy(strokes)], [labels])
+
+    def testArrays( self ):
+        path = os.path.join(self.dir, 'arrays.skhmm')
+        arrays = {'a': numpy.arange(7, dtype=numpy.int16),
+                  'b': numpy.random.RandomState(3).rand(5, 3),
+                  'empty': numpy.zeros((0, 4))}
+        modelfile.write(path, {'name': 'test'}, arrays)
+        for mmap in (True, False):
+            header, read = modelfile.read(path, mmap)
+            self.assertEqual(header, {'name': 'test'})
+            for name, a in arrays.items():
+                self.assertEqual(read[name].dtype, a.dtype)
+                self.assertTrue(numpy.array_equal(read[name], a))
+
+    def testNotAModelFile( self ):
+        path = os.path.join(self.dir, 'sketch.xml')
+        shutil.copy(files[0], path)
+        self.assertRaises(ValueError, modelfile.read, path)
+
+
+def namespaced( source, dest, prefix ):
+    ''' Copy a sketch file with its elements in a namespace, under prefix
+        (or as the default namespace if prefix is empty) '''
+    text = open(source).read()
+    if prefix:
+        text = re.sub(r'<(/?)(\w)', r'<\1%s:\2' % prefix, text)
+        text = text.replace('<%s:sketch ' % prefix, '<%s:sketch xmlns:%s="urn:sketch" ' % (prefix, prefix))
+    else:
+        text = text.replace('<sketch ', '<sketch xmlns="urn:sketch" ')
+    f = open(dest, 'w')
+    f.write(text)
+    f.close()
+
+
+class SaveFileTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.sl = StrokeHmm.StrokeLabeler()
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def relabel( self, original ):
+        ''' Save original with new labels and check they read back '''
+        strokes, labels = self.sl.loadLabeledFile(original)
+        # swap text and drawing, written as labels the loader maps back
+        newLabels = ['AND' if l == 'text' else 'Label' for l in labels]
+        out = os.path.join(self.dir, 'out.xml')
+        self.sl.saveFile(strokes, newLabels, original, out)
+        savedStrokes, savedLabels = self.sl.loadLabeledFile(out)
+        self.assertEqual(savedLabels, [self.sl.labelDict[l] for l in newLabels])
+        self.assertNotEqual(savedLabels, labels)
+        self.assertEqual([s.points for s in savedStrokes], [s.points for s in strokes])
+        self.assertEqual([s.substrokeIds for s in savedStrokes], [s.substrokeIds for s in strokes])
+        return open(out).read()
+
+    def testLabelsReadBack( self ):
+        text = self.relabel(files[0])
+        original = open(files[0]).read()
+        # the sketch is copied as it was, only the labels change
+        self.assertTrue(text.startswith(original[:original.index('<point')]))
+        self.assertEqual(text.count('<point '), original.count('<point '))
+        self.assertEqual(text.count('<shape '), original.count('<shape '))
+        self.assertTrue(text.endswith('</sketch>\n'))
+
+    def testNamespaces( self ):
+        plainStrokes = self.sl.loadStrokeFile(files[1])
+        for prefix in ('', 'sk'):
+            path = os.path.join(self.dir, 'namespaced.xml')
+            namespaced(files[1], path, prefix)
+            strokes = self.sl.loadStrokeFile(path)
+            self.assertEqual([s.points for s in strokes], [s.points for s in plainStrokes])
+            text = self.relabel(path)
+            if prefix:
+                self.assertTrue('<sk:shape id=' in text)
+                self.assertFalse('<shape ' in text)
+
+
+class BatchLabelTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.inputDir = os.path.join(self.dir, 'in')
+        os.makedirs(self.inputDir)
+        for f in files[4:]:
+            shutil.copy(f, self.inputDir)
+        sl = StrokeHmm.StrokeLabeler()
+        sl.trainHMM(files[:4])
+        self.model = os.path.join(self.dir, 'model.skhmm')
+        sl.save_model(self.model)
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def testLabelDirectory( self ):
+        for workers in (1, 2):
+            outputDir = os.path.join(self.dir, 'out%d' % workers)
+            report = batchlabel.labelDirectory(self.model, self.inputDir, outputDir, workers)
+            self.assertEqual((report['labeled'], report['failed']), (2, []))
+            self.assertEqual(sorted(os.listdir(outputDir)), sorted(os.listdir(self.inputDir)))
+            # the outputs are now up to date
+            report = batchlabel.labelDirectory(self.model, self.inputDir, outputDir, workers)
+            self.assertEqual((report['labeled'], report['skipped']), (0, 2))
+
+    def testRefusesToOverwriteInputs( self ):
+        same = os.path.join(self.inputDir, '.', '')
+        for force in (False, True):
+            self.assertRaises(ValueError, batchlabel.labelDirectory, self.model,
+                              self.inputDir, same, 1, force)
+
+    def testBadModelFailsBeforeThePool( self ):
+        outputDir = os.path.join(self.dir, 'out')
+        self.assertRaises(ValueError, batchlabel.labelDirectory, files[0],
+                          self.inputDir, outputDir, 2)
+        self.assertFalse(os.path.exists(outputDir))
+
+    def testWorkerWithoutModelReportsFailures( self ):
+        batchlabel.initBatchWorker(files[0], False, False, logging.WARNING)
+        try:
+            self.assertEqual(batchlabel.batchLabeler, None)
+            inPath, n, seconds, error = batchlabel.labelOne((files[4], os.path.join(self.dir, 'x'), 0))
+            self.assertTrue(error.startswith('model not loaded: ValueError'))
+        finally:
+            batchlabel.batchLabeler = batchlabel.batchError = None
+
+
+class LabelServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass( cls ):
+        labeler = StrokeHmm.StrokeLabeler()
+        labeler.trainHMM(files[:4])
+        cls.labeler = labeler
+        cls.server = labelserver.LabelServer(('127.0.0.1', 0), labeler)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, args = (0.05,))
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass( cls ):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.server.server_close()
+
+    def post( self, body, length = None ):
+        ''' POST body to /label and return (status, JSON answer) '''
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout = 10)
+        try:
+            conn.putrequest('POST', '/label')
+            conn.putheader('Content-Length', str(len(body)) if length is None else length)
+            conn.endheaders()
+            conn.send(body)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def testLabelsPoints( self ):
+        strokes = self.labeler.loadStrokeFile(files[4])
+        body = json.dumps({'strokes': [s.points for s in strokes]})
+        status, answer = self.post(body)
+        self.assertEqual(status, 200)
+        self.assertEqual(answer['labels'], self.labeler.labelStrokes(strokes))
+
+    def testLabelsXml( self ):
+        body = open(files[5]).read()
+        status, answer = self.post(body)
+        self.assertEqual(status, 200)
+        self.assertEqual(answer['labels'], self.labeler.labelStrokes(self.labeler.loadStrokeFile(files[5])))
+
+    def testBadContentLength( self ):
+        for length in ('abc', '-5'):
+            status, answer = self.post('{"strokes": []}', length)
+            self.assertEqual(status, 400)
+            self.assertEqual(answer, {'error': 'bad Content-Length'})
+
+    def testBadBody( self ):
+        status, answer = self.post('{"strokes": [[]]}')
+        self.assertEqual(status, 400)
+
+    def testConnectionLimit( self ):
+        server = labelserver.LabelServer(('127.0.0.1', 0), self.labeler, maxConnections = 1)
+        thread = threading.Thread(target = server.serve_forever, args = (0.05,))
+        thread.start()
+        idle = socket.create_connection(server.server_address, 10)
+        try:
+            # the idle connection holds the only slot
+            conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1], timeout = 10)
+            conn.request('GET', '/stats')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 503)
+            self.assertEqual(json.loads(response.read()), {'error': 'too many connections'})
+            conn.close()
+        finally:
+            idle.close()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class SlowHmm:
+    ''' Stands in for an HMM whose decode takes until release is set '''
+    def __init__( self ):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def label_many( self, observations ):
+        self.started.set()
+        self.release.wait(10)
+        return [[] for o in observations]
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def testBatches( self ):
+        labeler = StrokeHmm.StrokeLabeler()
+        labeler.trainHMM(files[:2])
+        batcher = labelserver.MicroBatcher(labeler.hmm, window = 0.05)
+        batcher.start()
+        try:
+            observations = [labeler.featurefy(labeler.loadStrokeFile(f)) for f in files[2:]]
+            results = [None] * len(observations)
+            def submit( i ):
+                results[i] = batcher.submit(observations[i], 10)
+            threads = [threading.Thread(target = submit, args = (i,)) for i in range(len(observations))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            batcher.stop()
+        self.assertEqual(results, labeler.hmm.label_many(observations))
+
+    def testStopWithFullQueue( self ):
+        hmm = SlowHmm()
+        batcher = labelserver.MicroBatcher(hmm, window = 0, maxQueue = 1)
+        batcher.start()
+        decoding = threading.Thread(target = batcher.submit, args = ([{}], 10))
+        decoding.start()
+        hmm.started.wait(10)
+        queued = labelserver.Job([{}])
+        batcher.queue.put_nowait(queued)
+        stopping = threading.Thread(target = batcher.stop)
+        stopping.start()
+        hmm.release.set()
+        stopping.join(10)
+        decoding.join(10)
+        self.assertFalse(stopping.isAlive())
+        self.assertTrue(queued.done.is_set())
+        self.assertTrue(isinstance(queued.error, RuntimeError))
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def testCorpusIsDeterministic( self ):
+        again = benchmark.generateCorpus(os.path.join(self.dir, 'again'), 6, 25, 20)
+        for a, b in zip(files, again):
+            self.assertTrue(filecmp.cmp(a, b, False))
+        other = benchmark.generateCorpus(os.path.join(self.dir, 'other'), 1, 25, 20, seed = 1)
+        self.assertFalse(filecmp.cmp(files[0], other[0], False))
+
+    def testCorpusLoads( self ):
+        sl = StrokeHmm.StrokeLabeler()
+        strokes, labels = sl.loadLabeledFile(files[0])
+        self.assertEqual(len(strokes), 25)
+        self.assertEqual(set(labels) - set(sl.labels), set())
+        for s in strokes:
+            self.assertTrue(0 < len(s.points) <= 20)
+
+    def testRunPipeline( self ):
+        report = benchmark.runPipeline(files[:2], self.dir)
+        self.assertEqual(report['strokes'], 50)
+        self.assertEqual(sorted(report['stages']),
+                         sorted(['parse', 'buildStroke', 'features', 'generateFeatureIntervals',
+                                 'featurefy', 'train', 'label', 'label_many', 'saveFile']))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'out'))),
+                         sorted([os.path.basename(f) for f in files[:2]]))
+
+    def testMain( self ):
+        output = os.path.join(self.dir, 'bench.json')
+        benchmark.main(['--files', '2', '--strokes', '5', '--points', '10', '--repeat', '1',
+                        '--startup-runs', '0', '--output', output])
+        report = json.load(open(output))
+        self.assertEqual(report['strokes'], 10)
+        self.assertEqual(report['startup'], None)
+        self.assertEqual(report['config']['files'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
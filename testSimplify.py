@@ -0,0 +1,94 @@
+''' Behaviour tests for stroke point reduction.  Run with
+
+        python -m unittest testSimplify
+'''
+import math
+import random
+import unittest
+
+import simplify
+
+
+def randomStroke( rand, n ):
+    ''' A random walk of n (x, y, time) integer points '''
+    points = [(rand.randint(0, 500), rand.randint(0, 500), 0)]
+    for i in range(1, n):
+        x, y, t = points[-1]
+        points.append((x + rand.randint(-6, 6), y + rand.randint(-6, 6), t + rand.randint(1, 20)))
+    return points
+
+def distanceToSegment( p, a, b ):
+    ''' The distance of p from the line through a and b (or from a, when
+        they are the same point) '''
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    norm = math.hypot(dx, dy)
+    if norm == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    return abs((p[0] - a[0])*dy - (p[1] - a[1])*dx) / norm
+
+
+class SimplifyTest(unittest.TestCase):
+
+    def assertIntegerPoints( self, points ):
+        for p in points:
+            self.assertEqual(type(p), tuple)
+            self.assertEqual([type(v) for v in p], [int, int, int])
+
+    def assertKeepsEndpoints( self, points, reduced ):
+        self.assertEqual(reduced[0], points[0])
+        self.assertEqual(reduced[-1][:2], points[-1][:2])
+        for a, b in zip(reduced, reduced[1:]):
+            self.assertNotEqual(a[:2], b[:2])
+
+    def testRdpKeepsEndpoints( self ):
+        rand = random.Random(1)
+        for trial in range(30):
+            points = randomStroke(rand, rand.randint(3, 200))
+            for tolerance in (0.5, 2, 10):
+                reduced = simplify.rdp(points, tolerance)
+                self.assertIntegerPoints(reduced)
+                self.assertKeepsEndpoints(points, reduced)
+                # a subset of the points, in order
+                kept = [points.index(p) for p in reduced]
+                self.assertEqual(kept, sorted(kept))
+
+    def testRdpTolerance( self ):
+        rand = random.Random(2)
+        for trial in range(30):
+            points = randomStroke(rand, rand.randint(3, 200))
+            reduced = simplify.rdp(points, 3)
+            kept = [points.index(p) for p in reduced]
+            for first, last in zip(kept, kept[1:]):
+                for p in points[first+1:last]:
+                    self.assertTrue(distanceToSegment(p, points[first], points[last]) <= 3)
+
+    def testRdpZeroToleranceKeepsCorners( self ):
+        # no three points of a parabola are on a line
+        points = [(x, x*x, 10*x) for x in range(-20, 21)]
+        self.assertEqual(simplify.rdp(points, 0), points)
+        line = [(x, 2*x, x) for x in range(10)]
+        self.assertEqual(simplify.rdp(line, 0), [line[0], line[-1]])
+
+    def testResampleKeepsEndpoints( self ):
+        rand = random.Random(3)
+        for trial in range(30):
+            points = randomStroke(rand, rand.randint(2, 200))
+            for spacing in (1, 4, 25):
+                reduced = simplify.resample(points, spacing)
+                self.assertIntegerPoints(reduced)
+                self.assertKeepsEndpoints(points, reduced)
+                # points are spacing apart, give or take the rounding
+                for a, b in zip(reduced, reduced[1:]):
+                    self.assertTrue(math.hypot(b[0] - a[0], b[1] - a[1]) <= spacing + 1.5)
+                times = [p[2] for p in reduced]
+                self.assertEqual(times, sorted(times))
+
+    def testShortStrokes( self ):
+        for method in simplify.METHODS.values():
+            self.assertEqual(method([], 2), [])
+            self.assertEqual(method([(1, 2, 3)], 2), [(1, 2, 3)])
+        self.assertEqual(simplify.rdp([(0, 0, 0), (5, 5, 1)], 2), [(0, 0, 0), (5, 5, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+''' Behaviour tests for the on-disk sketch cache.  Run with
+
+        python -m unittest testSketchCache
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import sketchcache
+
+
+class SketchCacheTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.dir, 'cache')
+        self.files = []
+        for i in range(6):
+            path = os.path.join(self.dir, 'sketch%d.xml' % i)
+            f = open(path, 'w')
+            f.write('<sketch id="%d"/>' % i)
+            f.close()
+            self.files.append(path)
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def entrySize( self ):
+        cache = sketchcache.SketchCache(os.path.join(self.dir, 'probe'))
+        cache.put(self.files[0], 'x' * 1000)
+        return cache.size
+
+    def age( self, cache, filename, mtime ):
+        ''' Pretend the entry for filename was last used at mtime '''
+        path = cache.entryPath(cache.key(filename))
+        os.utime(path, (mtime, mtime))
+
+    def testRoundTrip( self ):
+        cache = sketchcache.SketchCache(self.cacheDir)
+        self.assertEqual(cache.get(self.files[0]), None)
+        cache.put(self.files[0], {'strokes': [1, 2, 3]})
+        self.assertEqual(cache.get(self.files[0]), {'strokes': [1, 2, 3]})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def testChangedFileMisses( self ):
+        for keyBy in ('hash', 'mtime'):
+            cache = sketchcache.SketchCache(os.path.join(self.dir, keyBy), keyBy = keyBy)
+            cache.put(self.files[1], 'old')
+            f = open(self.files[1], 'a')
+            f.write('<!-- changed -->')
+            f.close()
+            os.utime(self.files[1], (1e9, 1e9))
+            self.assertEqual(cache.get(self.files[1]), None)
+
+    def testVariantsAreSeparate( self ):
+        cache = sketchcache.SketchCache(self.cacheDir)
+        cache.put(self.files[0], 'plain')
+        cache.put(self.files[0], 'simplified', "('rdp', 2)")
+        self.assertEqual(cache.get(self.files[0]), 'plain')
+        self.assertEqual(cache.get(self.files[0], "('rdp', 2)"), 'simplified')
+
+    def testEvictsLeastRecentlyUsed( self ):
+        size = self.entrySize()
+        cache = sketchcache.SketchCache(self.cacheDir, maxBytes = 3 * size)
+        for i in range(3):
+            cache.put(self.files[i], str(i) * 1000)
+            self.age(cache, self.files[i], 1000000 + i)
+        # a hit makes file 0 the most recently used
+        self.assertEqual(cache.get(self.files[0]), '0' * 1000)
+        cache.put(self.files[3], '3' * 1000)
+        self.assertEqual(cache.get(self.files[1]), None)
+        self.assertEqual(cache.get(self.files[0]), '0' * 1000)
+        self.assertEqual(cache.get(self.files[3]), '3' * 1000)
+        self.assertTrue(cache.size <= 3 * size)
+
+    def testScansOnlyWhenFull( self ):
+        cache = sketchcache.SketchCache(self.cacheDir, maxBytes = 1 << 30)
+        scans = []
+        evict = cache.evict
+        cache.evict = lambda: (scans.append(1), evict())
+        for i in range(6):
+            cache.put(self.files[i], 'x' * 100)
+        self.assertEqual(len(scans), 1)
+        size = cache.size
+        # rewriting an entry replaces its size
+        cache.put(self.files[0], 'x' * 100)
+        self.assertEqual(cache.size, size)
+
+    def testFailedWriteLeavesNoTemporaryFile( self ):
+        cache = sketchcache.SketchCache(self.cacheDir)
+        self.assertRaises(Exception, cache.put, self.files[0], lambda: None)
+        self.assertEqual(os.listdir(self.cacheDir), [])
+        self.assertEqual(cache.get(self.files[0]), None)
+
+    def testClear( self ):
+        cache = sketchcache.SketchCache(self.cacheDir)
+        cache.put(self.files[0], 'x')
+        cache.clear()
+        self.assertEqual(cache.get(self.files[0]), None)
+        self.assertEqual(cache.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
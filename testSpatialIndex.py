@@ -0,0 +1,79 @@
+''' Behaviour tests for the grid spatial index.  Run with
+
+        python -m unittest testSpatialIndex
+'''
+import math
+import random
+import unittest
+
+import spatialindex
+from spatialindex import GridIndex, boxDistance
+
+
+def randomBoxes( rand, n ):
+    ''' n boxes on a page, including points, lines and a few long ones '''
+    boxes = []
+    for i in range(n):
+        x, y = rand.randrange(0, 1000), rand.randrange(0, 800)
+        kind = rand.random()
+        if kind < 0.1:
+            w, h = 0, 0
+        elif kind < 0.2:
+            w, h = rand.randrange(1, 50), 0
+        elif kind < 0.3:
+            w, h = rand.randrange(300, 900), rand.randrange(0, 20)
+        else:
+            w, h = rand.randrange(1, 60), rand.randrange(1, 60)
+        boxes.append((x, y, x + w, y + h))
+    return boxes
+
+def bruteForce( boxes, radius ):
+    ''' (nearest distances, overlap counts, densities) by comparing every
+        pair of boxes '''
+    nearest, overlaps, densities = [], [], []
+    centers = [((b[0] + b[2]) / 2.0, (b[1] + b[3]) / 2.0) for b in boxes]
+    for i, box in enumerate(boxes):
+        others = [j for j in range(len(boxes)) if j != i]
+        nearest.append(min([boxDistance(box, boxes[j]) for j in others] or [float('inf')]))
+        overlaps.append(len([j for j in others if boxDistance(box, boxes[j]) == 0]))
+        densities.append(len([j for j in others
+                              if math.hypot(centers[j][0] - centers[i][0],
+                                            centers[j][1] - centers[i][1]) <= radius]))
+    return nearest, overlaps, densities
+
+
+class GridIndexTest(unittest.TestCase):
+
+    def assertMatchesBruteForce( self, index, boxes ):
+        nearest, overlaps, densities = bruteForce(boxes, 2 * index.cellSize)
+        for got, expected in zip(index.nearestDistances(), nearest):
+            self.assertAlmostEqual(got, expected)
+        self.assertEqual(index.overlapCounts(), overlaps)
+        self.assertEqual(index.densities(), densities)
+
+    def testMatchesBruteForce( self ):
+        rand = random.Random(1)
+        for trial in range(20):
+            boxes = randomBoxes(rand, rand.randint(1, 80))
+            self.assertMatchesBruteForce(GridIndex(boxes), boxes)
+            # the cell size changes only the speed
+            self.assertMatchesBruteForce(GridIndex(boxes, rand.uniform(5, 500), 16), boxes)
+
+    def testAddMatchesBuild( self ):
+        rand = random.Random(2)
+        boxes = randomBoxes(rand, 60)
+        index = GridIndex([], 40.0)
+        for box in boxes:
+            self.assertEqual(index.add(box), len(index.boxes) - 1)
+        self.assertMatchesBruteForce(index, boxes)
+
+    def testDegenerateBoxes( self ):
+        points = [(5, 5, 5, 5), (5, 5, 5, 5), (8, 9, 8, 9)]
+        self.assertTrue(spatialindex.defaultCellSize(points) >= 1.0)
+        self.assertMatchesBruteForce(GridIndex(points), points)
+        self.assertEqual(GridIndex([(1, 1, 2, 2)]).nearestDistances(), [float('inf')])
+        self.assertEqual(GridIndex([]).densities(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
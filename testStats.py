@@ -0,0 +1,58 @@
+''' Behaviour tests for the stage stats collector.  Run with
+
+        python -m unittest testStats
+'''
+import unittest
+
+import stats
+
+
+class StatsCollectorTest(unittest.TestCase):
+
+    def testRecord( self ):
+        collector = stats.StatsCollector()
+        collector.record('parse', 0.5, 100)
+        collector.record('parse', 0.25, 300)
+        collector.record('parse', 0.25, 200)
+        collector.record('save', 1e-7)
+        report = collector.report()['stages']
+        self.assertEqual(report['parse']['calls'], 3)
+        self.assertEqual(report['parse']['peakGrowthBytes'], 300)
+        self.assertEqual((report['parse']['min'], report['parse']['max']), (0.25, 0.5))
+        self.assertAlmostEqual(report['parse']['mean'], 1.0 / 3)
+        self.assertEqual(report['save']['peakGrowthBytes'], None)
+        self.assertEqual(report['save']['histogram'], {'0': 1})
+
+    def testStagesAndCounters( self ):
+        collector = stats.StatsCollector()
+        for i in range(3):
+            with collector.stage('decode'):
+                collector.count('strokes', 2)
+        report = collector.report()
+        self.assertEqual(report['counters'], {'strokes': 6})
+        self.assertEqual(report['stages']['decode']['calls'], 3)
+        self.assertEqual(report['stages']['decode']['peakGrowthBytes'], None)
+
+    @unittest.skipIf(stats.resource is None, "no resource module")
+    def testTrackMemory( self ):
+        collector = stats.StatsCollector(trackMemory = True)
+        self.assertTrue(collector.trackMemory)
+        size = 64 * 1024 * 1024
+        with collector.stage('big'):
+            block = 'x' * size
+        del block
+        with collector.stage('small'):
+            block = 'x' * 10
+        report = collector.report()['stages']
+        # a fresh high of 64 MB, give or take what the allocator keeps
+        self.assertTrue(report['big']['peakGrowthBytes'] > size / 2)
+        self.assertTrue(report['small']['peakGrowthBytes'] < size / 2)
+
+    def testNullStats( self ):
+        with stats.NULL_STATS.stage('decode'):
+            stats.NULL_STATS.count('strokes')
+        self.assertEqual(stats.NULL_STATS.report(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
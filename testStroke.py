@@ -1,4 +1,7 @@
-execfile("StrokeHMM.py")
+import logging
+import sys
+from StrokeHmm import *
+logging.basicConfig(level = logging.INFO, format = '%(message)s', stream = sys.stdout)
 sl = StrokeLabeler()
 sl.trainHMMDir("trainingFiles/")
 # sl.trainHMM(["trainingFiles/0128_1.6.1.labeled.xml"])